@@ -0,0 +1,73 @@
+"""Import-time benchmark for the credentialsManager client library.
+Runs `python -X importtime` in fresh interpreters, reports the median cumulative import time of
+credentialsManager and fails if it exceeds the budget or if heavy modules are loaded on the default path.
+
+Usage:
+    python bench_import.py [--budget MS] [--runs N]
+"""
+import sys
+import argparse
+import statistics
+import subprocess
+
+# Modules that must not be imported by `from credentialsManager import credentialsManager`
+FORBIDDEN = ("jsonschema", "ssl")
+
+
+def measureImport(python=sys.executable):
+    """Imports credentialsManager in a fresh interpreter and parses the importtime output.
+
+    Args:
+        python (str, optional): Python interpreter to use. Defaults to the current one.
+
+    Returns:
+        int: Cumulative import time of credentialsManager in microseconds.
+        set[str]: Names of all imported modules.
+    """
+    result = subprocess.run(
+        [python, "-X", "importtime", "-c", "from credentialsManager import credentialsManager"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    cumulative = 0
+    modules = set()
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulativeUs, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        modules.add(name)
+        if name in ("credentialsManager", "credentialsManager.credentialsManager"):
+            cumulative += int(cumulativeUs)
+    return cumulative, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="credentialsManager import-time benchmark")
+    parser.add_argument("--budget", type=float, default=25.0, help="budget in milliseconds")
+    parser.add_argument("--runs", type=int, default=7)
+    arguments = parser.parse_args()
+
+    timings = []
+    modules = set()
+    for _ in range(arguments.runs):
+        cumulative, modules = measureImport()
+        timings.append(cumulative / 1000)
+    median = statistics.median(timings)
+    print(f"credentialsManager import: median {median:.2f} ms over {arguments.runs} runs (budget {arguments.budget} ms)")
+
+    failed = False
+    for module in FORBIDDEN:
+        if module in modules:
+            print(f"FAIL: '{module}' is imported on the default path.")
+            failed = True
+    if median > arguments.budget:
+        print("FAIL: Import time exceeds budget.")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
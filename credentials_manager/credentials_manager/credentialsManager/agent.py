@@ -0,0 +1,210 @@
+"""This module implements the CM agent, a long-running local process for hosts that run many
+short-lived CM clients (e.g. CGI scripts). The agent holds one authenticated, persistent connection
+to the CM server and caches the server's answers in memory. Local processes talk to the agent over
+a permission-restricted unix domain socket, see credentialsManager.AgentClient.
+
+Start the agent with:
+    python -m credentialsManager.agent --config /opt/credentials_manager/cm_config.json
+"""
+import os
+import grp
+import json
+import time
+import signal
+import socket
+import argparse
+import threading
+from credentialsManager import credentialsManager as cm
+
+
+class TtlCache:
+    """Thread-safe in-memory cache for server answers. Every entry expires after a fixed time to live."""
+
+    def __init__(self, ttl: float, maxEntries: int = 1024):
+        """Constructor for TtlCache objects.
+
+        Args:
+            ttl (float): Time to live of an entry in seconds.
+            maxEntries (int, optional): Maximum number of cached entries. Defaults to 1024.
+        """
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value for a key, or None if there is no valid entry.
+
+        Args:
+            key (tuple): Cache key.
+
+        Returns:
+            str: Cached value.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            expires, value, _ = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def put(self, key, value, label=None):
+        """Stores a value in the cache.
+
+        Args:
+            key (tuple): Cache key.
+            value (str): Value to cache.
+            label (str, optional): Credentials label the value belongs to, used for invalidation.
+        """
+        with self._lock:
+            if len(self._entries) >= self.maxEntries and key not in self._entries:
+                # Drop the entry that expires first to make room
+                oldest = min(self._entries, key=lambda k: self._entries[k][0])
+                del self._entries[oldest]
+            self._entries[key] = (time.monotonic() + self.ttl, value, label)
+
+    def invalidate(self, label=None):
+        """Removes all entries for a label from the cache.
+
+        Args:
+            label (str, optional): Credentials label. Defaults to None, which clears the whole cache.
+        """
+        with self._lock:
+            if label is None:
+                self._entries.clear()
+                return
+            for key in [k for k, entry in self._entries.items() if entry[2] == label]:
+                del self._entries[key]
+
+
+class Agent:
+    """The CM agent. Serves cached CM answers to local processes over a unix domain socket."""
+
+    def __init__(self, client: cm.Client, agentSocket: str, ttl: float = 60, socketGroup: str = None):
+        """Constructor for Agent objects.
+
+        Args:
+            client (Client): Client with a persistent connection to the CM server.
+            agentSocket (str): Path of the unix domain socket to listen on.
+            ttl (float, optional): Time to live of cached answers in seconds. Defaults to 60.
+            socketGroup (str, optional): Group that may access the socket (e.g. the webserver's group).
+                Defaults to None, which restricts access to the agent's user.
+        """
+        self.client = client
+        self.agentSocket = agentSocket
+        self.socketGroup = socketGroup
+        self.cache = TtlCache(ttl)
+
+    def execute(self, request: str, args: dict) -> str:
+        """Answers a request from the cache or forwards it to the CM server.
+
+        Args:
+            request (str): CM request type.
+            args (dict): Request arguments.
+
+        Returns:
+            str: The server's answer.
+
+        Raises:
+            CmError: Error while executing request.
+        """
+        key = (request, json.dumps(args, sort_keys=True))
+        response = self.cache.get(key)
+        if response is not None:
+            return response
+
+        response = self.client.execute((request, args))
+        # Don't cache denied requests, a permission might be granted any time
+        if response != "null":
+            self.cache.put(key, response, label=args.get("label"))
+        return response
+
+    def _handle(self, connection):
+        """Serves a single local connection.
+
+        Args:
+            connection (socket): Accepted unix domain socket connection.
+        """
+        try:
+            message = json.loads(cm._recvAll(connection).decode())
+            request, args = message["cmRequest"], message.get("args", {})
+            if request == "INVALIDATE":
+                self.cache.invalidate(args.get("label"))
+                answer = {"status": "ok", "response": ""}
+            else:
+                answer = {"status": "ok", "response": self.execute(request, args)}
+        except Exception as e:
+            answer = {"status": "error", "error": str(e)}
+
+        try:
+            connection.sendall(json.dumps(answer).encode())
+        except OSError as e:
+            print(f"Error: {e}")
+        finally:
+            connection.close()
+
+    def _bind(self) -> socket.socket:
+        """Creates the agent's unix domain socket with restricted permissions.
+
+        Returns:
+            socket: Listening unix domain socket.
+        """
+        os.makedirs(os.path.dirname(self.agentSocket) or ".", exist_ok=True)
+        if os.path.exists(self.agentSocket):
+            os.unlink(self.agentSocket)
+
+        serverSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Never let the socket exist with looser permissions, not even for a moment
+        oldUmask = os.umask(0o177)
+        try:
+            serverSocket.bind(self.agentSocket)
+        finally:
+            os.umask(oldUmask)
+
+        if self.socketGroup:
+            os.chown(self.agentSocket, -1, grp.getgrnam(self.socketGroup).gr_gid)
+            os.chmod(self.agentSocket, 0o660)
+        serverSocket.listen(64)
+        return serverSocket
+
+    def serve(self):
+        """Runs the agent until it is interrupted."""
+        serverSocket = self._bind()
+        print(f"CM agent listening on {self.agentSocket}")
+
+        try:
+            while True:
+                connection, _ = serverSocket.accept()
+                threading.Thread(target=self._handle, args=(connection,), daemon=True).start()
+        finally:
+            serverSocket.close()
+            self.client.close()
+            os.unlink(self.agentSocket)
+
+
+def main():
+    """Starts a CM agent using the parameters inside the client config file."""
+    parser = argparse.ArgumentParser(description="Credentials Manager agent")
+    parser.add_argument("--config", default="/opt/credentials_manager/cm_config.json")
+    arguments = parser.parse_args()
+
+    data = cm.loadConfig(arguments.config)
+    agent = Agent(
+        client=cm.clientFromConfig(data, keepAlive=True),
+        agentSocket=data.get("agent_socket", cm.AGENTSOCKET),
+        ttl=data.get("agent_ttl", 60),
+        socketGroup=data.get("agent_socket_group"),
+    )
+    # SIGHUP clears the cache
+    signal.signal(signal.SIGHUP, lambda signum, frame: agent.cache.invalidate())
+    try:
+        agent.serve()
+    except KeyboardInterrupt:
+        print("Stopping CM agent...")
+
+
+if __name__ == "__main__":
+    main()
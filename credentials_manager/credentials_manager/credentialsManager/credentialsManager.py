@@ -1,9 +1,12 @@
 """This module implements functions and classes that can be used to create clients
 that use mutual authentication to connect & communicate with the CM server using secure SSL sockets."""
-import ssl
+import os
 import socket
+import stat
 import json
-from jsonschema import validate, ValidationError
+import struct
+import threading
+import time
 
 # Schema which specifies the client-server communication.
 PROTOCOLSCHEMA = {
@@ -12,11 +15,13 @@ PROTOCOLSCHEMA = {
         "header": {
             "type": "object",
             "properties": {
-                "cmUser": {"type": "string"},
+                "cmUser": {"type": "string", "maxLength": 255},
                 "cmPassword": {"type": "string"},
+                "cmToken": {"type": "string"},
                 "cmRequest": {"type": "string"},
+                "cmDeadline": {"type": "number"},
             },
-            "required": ["cmUser", "cmPassword", "cmRequest"],
+            "required": ["cmUser", "cmRequest"],
         },
         "payload": {
             "type": "object",
@@ -27,22 +32,308 @@ PROTOCOLSCHEMA = {
     "required": ["header", "payload"],
 }
 
+# Default path of the CM agent's unix domain socket.
+AGENTSOCKET = "/run/credentials_manager/agent.sock"
 
-def _validatePacket(packet: str) -> bool:
+# Load balancing strategies for clients with several CM servers
+BALANCING = ("least_latency", "least_outstanding")
+
+# Messages to and from the CM server are framed by their length, a 4 byte unsigned big-endian integer
+FRAMEHEADER = struct.Struct("!I")
+
+# Largest message a frame may carry, in bytes
+MAXFRAME = 1024 * 1024
+
+# Answer of a CM server that rejects the client's password or session token
+AUTHFAILED = "400 : Client authentication failed."
+
+# Maximum number of idle persistent connections per CM server
+MAXIDLE = 4
+
+# Longest wait (in seconds) an overloaded server may ask for before the client gives up instead of retrying
+RETRYAFTERCAP = 2.0
+
+
+# JSON types used in PROTOCOLSCHEMA
+_TYPES = {"object": dict, "string": str, "number": (int, float)}
+
+# Parsed client configurations, keyed by path
+_CONFIGS = {}
+
+
+def _checkSchema(instance, schema) -> bool:
+    """Checks an instance against the small subset of JSON schema used by PROTOCOLSCHEMA
+    (types, properties and required keys). This avoids importing a schema library on every client start.
+
+    Args:
+        instance: Instance to check.
+        schema (dict): JSON schema.
+
+    Returns:
+        bool: True if the instance matches the schema.
+    """
+    if not isinstance(instance, _TYPES[schema["type"]]):
+        return False
+    if isinstance(instance, dict):
+        if any(key not in instance for key in schema.get("required", [])):
+            return False
+        for key, subschema in schema.get("properties", {}).items():
+            if key in instance and not _checkSchema(instance[key], subschema):
+                return False
+    return True
+
+
+def _validatePacket(packet: dict) -> bool:
     """Validates if a message form follows protocol guidelines.
 
     Args:
-        message (dict): Message to validate, received from client.
+        packet (dict): Packet to validate, before it is sent to the server.
 
     Returns:
-        bool: True if the message is valid, else False.
+        bool: True if the message is valid.
+
+    Raises:
+        CmError: Packet validation failed.
     """
-    try:
-        packet = json.loads(packet)
-        validate(instance=packet, schema=PROTOCOLSCHEMA)
-        return True
-    except ValidationError as e:
-        raise CmError(f"Packet validation failed: {e}")
+    if not _checkSchema(packet, PROTOCOLSCHEMA):
+        raise CmError("Packet validation failed: Packet doesn't follow PROTOCOLSCHEMA.")
+    return True
+
+
+class _Call:
+    """An in-flight call of _SingleFlight."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _SingleFlight:
+    """Coalesces concurrent calls with the same key, so that only the first caller executes
+    the call while all others wait for its result."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, timeout: float = None):
+        """Executes function, unless a call with the same key is already in flight.
+
+        Args:
+            key (tuple): Key identifying the call.
+            function (callable): Function executing the call.
+            timeout (float, optional): Seconds a waiting caller waits for the call in flight. Defaults to None.
+
+        Returns:
+            The result of the call.
+
+        Raises:
+            Exception: The error raised by the call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise CmError("Deadline exceeded.")
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class _RetryBudget:
+    """Token bucket that limits retries and hedged requests to a fraction of all requests, so that
+    retries can't multiply the load on CM servers during an outage."""
+
+    def __init__(self, ratio: float = 0.2, maxTokens: float = 10):
+        """Constructor for _RetryBudget objects.
+
+        Args:
+            ratio (float, optional): Retries allowed per request. Defaults to 0.2.
+            maxTokens (float, optional): Maximum number of retries that can be saved up. Defaults to 10.
+        """
+        self.ratio = ratio
+        self.maxTokens = maxTokens
+        self._tokens = maxTokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        """Records a request, which earns the budget a fraction of a retry."""
+        with self._lock:
+            self._tokens = min(self.maxTokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """Takes one retry from the budget.
+
+        Returns:
+            bool: True if the budget allows another retry.
+        """
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class _Endpoint:
+    """A CM server together with the client's passive health information about it."""
+
+    def __init__(self, host: str, port: int):
+        """Constructor for _Endpoint objects.
+
+        Args:
+            host (str): Server's hostname or IP
+            port (int): Server's listen port
+        """
+        self.host = host
+        self.port = port
+        self.latency = None
+        self.outstanding = 0
+        self.failures = 0
+        self.ejectedUntil = 0.0
+        self.session = None
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return f"{self.host}:{self.port}"
+
+    def takeIdle(self):
+        """Returns an idle persistent connection to this server, or None if there is none."""
+        with self._lock:
+            return self._idle.pop() if self._idle else None
+
+    def putIdle(self, sslSocket):
+        """Keeps a connection to this server open for later requests.
+
+        Args:
+            sslSocket (SSLSocket): Connection to this server.
+        """
+        with self._lock:
+            if len(self._idle) < MAXIDLE:
+                self._idle.append(sslSocket)
+                return
+        sslSocket.close()
+
+    def closeIdle(self):
+        """Closes all idle connections to this server."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sslSocket in idle:
+            try:
+                sslSocket.close()
+            except OSError:
+                pass
+
+
+class _Balancer:
+    """Chooses the CM server for a request. The balancer sticks to the server it used last as long as that server
+    is healthy and not clearly worse than the best one, so that TLS sessions can be resumed. Servers that fail
+    several times in a row are ejected for a while (passive health tracking)."""
+
+    def __init__(self, endpoints: list, strategy: str = "least_latency", maxFailures: int = 3, ejectTime: float = 30):
+        """Constructor for _Balancer objects.
+
+        Args:
+            endpoints (list[_Endpoint]): CM servers.
+            strategy (str, optional): "least_latency" or "least_outstanding". Defaults to "least_latency".
+            maxFailures (int, optional): Consecutive failures after which a server is ejected. Defaults to 3.
+            ejectTime (float, optional): Seconds an ejected server isn't used. Defaults to 30.
+
+        Raises:
+            CmError: Unknown balancing strategy.
+        """
+        if strategy not in BALANCING:
+            raise CmError(f"Unknown balancing strategy '{strategy}'.")
+        self.endpoints = endpoints
+        self.strategy = strategy
+        self.maxFailures = maxFailures
+        self.ejectTime = ejectTime
+        self._current = None
+        self._lock = threading.Lock()
+
+    def _cost(self, endpoint: _Endpoint) -> float:
+        if self.strategy == "least_outstanding":
+            return endpoint.outstanding
+        # Servers without measurements are tried first
+        return endpoint.latency or 0.0
+
+    def _clearlyWorse(self, endpoint: _Endpoint, best: _Endpoint) -> bool:
+        if self.strategy == "least_outstanding":
+            return endpoint.outstanding > best.outstanding + 2
+        if endpoint.latency is None or best.latency is None:
+            return False
+        return endpoint.latency > 2 * best.latency + 0.005
+
+    def acquire(self, exclude=()) -> _Endpoint:
+        """Chooses a server and counts the request as outstanding on it.
+
+        Args:
+            exclude (list[_Endpoint], optional): Servers that must not be chosen.
+
+        Returns:
+            _Endpoint: The chosen server, or None if all servers are excluded.
+        """
+        with self._lock:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            if not candidates:
+                return None
+            now = time.monotonic()
+            # If all servers are ejected, use the one that comes back first
+            healthy = [e for e in candidates if e.ejectedUntil <= now]
+            healthy = healthy or [min(candidates, key=lambda e: e.ejectedUntil)]
+
+            best = min(healthy, key=self._cost)
+            if self._current in healthy and not self._clearlyWorse(self._current, best):
+                best = self._current
+            self._current = best
+            best.outstanding += 1
+            return best
+
+    def release(self, endpoint: _Endpoint, latency: float = None, failed: bool = False, expired: bool = False):
+        """Records the outcome of a request to a server.
+
+        Args:
+            endpoint (_Endpoint): The server the request was sent to.
+            latency (float, optional): Duration of the request in seconds.
+            failed (bool, optional): True if the server couldn't be reached or didn't answer.
+            expired (bool, optional): True if the caller's deadline expired first, which says nothing about the server.
+        """
+        with self._lock:
+            endpoint.outstanding -= 1
+            if expired:
+                return
+            if not failed:
+                endpoint.failures = 0
+                if latency is not None:
+                    # Exponentially weighted moving average
+                    endpoint.latency = latency if endpoint.latency is None else 0.8 * endpoint.latency + 0.2 * latency
+                return
+
+            endpoint.failures += 1
+            if endpoint.failures < self.maxFailures:
+                return
+            endpoint.failures = 0
+            endpoint.ejectedUntil = time.monotonic() + self.ejectTime
+            if self._current is endpoint:
+                self._current = None
+        print(f"CM server {endpoint} ejected for {self.ejectTime} seconds.")
+        endpoint.closeIdle()
 
 
 class Client:
@@ -50,6 +341,7 @@ class Client:
     with the Credentials Manager Server, by providing the necessary configuration information in form of SSLConfig objects.
     The methods used for communication with the server over raw sockets implement a json message format that both the client and server can understand.
     This allows them to interpret and respond to messages correctly.
+    If several CM servers are given, each request goes to one of them and fails over to the others.
     """
 
     def __init__(
@@ -61,6 +353,14 @@ class Client:
         serverPort: int,
         cmUser: str,
         cmPassword: str,
+        keepAlive: bool = False,
+        servers: list = None,
+        balancing: str = "least_latency",
+        timeout: float = None,
+        hedgeDelay: float = None,
+        retries: int = 2,
+        retryBudget: float = 0.2,
+        sessionTokens: bool = False,
     ):
         """Initializes SSLConfig objects
 
@@ -71,7 +371,17 @@ class Client:
             serverHost (str): Server's hostname or IP
             serverPort (int): Server's listen port
             cmUser (str): CM username
-            cmPassword(str) : CM user password
+            cmPassword(str) : CM user password (None for users in certificate auth mode)
+            keepAlive (bool, optional): Keep the TLS connections open between requests. Defaults to False.
+            servers (list[tuple], optional): (host, port) of all CM servers. Defaults to [(serverHost, serverPort)].
+            balancing (str, optional): "least_latency" or "least_outstanding". Defaults to "least_latency".
+            timeout (float, optional): Default deadline of a request in seconds. Defaults to None (no deadline).
+            hedgeDelay (float, optional): Seconds after which a duplicate request is sent to a second server.
+                Defaults to None (no hedging).
+            retries (int, optional): Retries after all servers have failed, with jittered backoff. Defaults to 2.
+            retryBudget (float, optional): Retries and hedged requests allowed per request. Defaults to 0.2.
+            sessionTokens (bool, optional): Verify the password once and authenticate with a session token afterwards.
+                Defaults to False.
         """
         self.caCert = caCert
         self.clientCert = clientCert
@@ -80,60 +390,93 @@ class Client:
         self.serverPort = serverPort
         self.cmUser = cmUser
         self.cmPassword = cmPassword
+        self.keepAlive = keepAlive
+        self._balancer = _Balancer(
+            [_Endpoint(host, port) for host, port in servers or [(serverHost, serverPort)]],
+            strategy=balancing,
+        )
+        self.timeout = timeout
+        self.hedgeDelay = hedgeDelay
+        self.retries = retries
+        self._budget = _RetryBudget(retryBudget)
+        self.sessionTokens = sessionTokens
+        self._token = None
+        self._tokenExpires = 0.0
+        self._context = None
+        self._inflight = _SingleFlight()
 
     def __str__(self):
-        return f"{self.caCert}, {self.clientCert}, {self.serverHost}, {self.serverPort}, {self.cmUser}"
+        servers = ", ".join(str(e) for e in self._balancer.endpoints)
+        return f"{self.caCert}, {self.clientCert}, {servers}, {self.cmUser}"
 
-    def _createSSLSocket(self):
+    def _createSSLSocket(self, endpoint: _Endpoint):
         """Establishes a SSL/TLS connection with the parameters specified in the instance.
         CM client (webapp) and CM Server use mutual authentication.
 
         Args:
-            self (Client): Client Object containing the SSL/TLS & Client configuration
+            endpoint (_Endpoint): The CM server to connect to. Its last TLS session is resumed if possible.
 
         Returns:
             SSLSocket: Socket wrapped in SSL/TLS context
         """
+        # ssl is only imported when it's needed, clients that talk to the CM agent never load it
+        import ssl
+
         try:
             client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-            context.load_verify_locations(self.caCert)
-            context.load_cert_chain(certfile=self.clientCert, keyfile=self.clientKey)
-            context.verify_mode = ssl.CERT_REQUIRED
-            context.minimum_version = ssl.TLSVersion.TLSv1_3
-            sslsock = context.wrap_socket(
-                client_socket, server_hostname=self.serverHost
+            # The context (and the certificates it loads) is created once per client
+            if self._context is None:
+                context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+                context.load_verify_locations(self.caCert)
+                context.load_cert_chain(certfile=self.clientCert, keyfile=self.clientKey)
+                context.verify_mode = ssl.CERT_REQUIRED
+                context.minimum_version = ssl.TLSVersion.TLSv1_3
+                self._context = context
+            sslsock = self._context.wrap_socket(
+                client_socket, server_hostname=endpoint.host, session=endpoint.session
             )
             return sslsock
         except Exception as e:
             raise CmError(f"Error building SSL socket: {e}")
 
-    def _createPacket(self, request):
+    def _createPacket(self, request, token: str = None, deadline: float = None):
         """Creates a CM packet to be sent to the server.
 
         Args:
             request (tuple): A request containing the Request type and arguments.
+            token (str, optional): Session token sent instead of the password. Defaults to None.
+            deadline (float, optional): time.monotonic() by which the request must be answered. The seconds left
+                are sent to the server, so that it can stop working on requests the client has given up on.
 
         Returns:
-            str: A CM packet.
+            dict: A CM packet.
         """
 
         packet = {
             "header": {
                 "cmUser": self.cmUser,
-                "cmPassword": self.cmPassword,
                 "cmRequest": request[0],
             },
             "payload": {"args": request[1]},
         }
+        if token:
+            packet["header"]["cmToken"] = token
+        elif self.cmPassword is not None:
+            # Users in certificate auth mode don't need a password
+            packet["header"]["cmPassword"] = self.cmPassword
+        if deadline is not None:
+            packet["header"]["cmDeadline"] = round(_remaining(deadline), 3)
 
-        return json.dumps(packet)
+        return packet
 
-    def execute(self, request):
+    def execute(self, request, timeout: float = None):
         """Executes a client request by sending a CM packet to the CM server and waiting for a response.
+        Concurrent calls with the same request and arguments are coalesced: only one of them is sent
+        to the server and all callers receive its response or error.
 
         Args:
             request (tuple): Request to be executed.
+            timeout (float, optional): Deadline of this request in seconds. Defaults to the client's timeout.
 
         Returns:
             response (str): The Server's response.
@@ -141,55 +484,552 @@ class Client:
         Raises:
             CmError: Error while executing request.
             CmError: Corrupt packet structure.
+            CmError: Deadline exceeded.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            key = (request[0], json.dumps(request[1], sort_keys=True))
+        except (TypeError, ValueError) as e:
+            raise CmError(f"Error while executing request: Corrupt packet structure. {e}")
+        return self._inflight.do(key, lambda: self._execute(request, deadline), timeout)
+
+    def _execute(self, request, deadline: float = None):
+        """Sends a single request to the CM servers, see execute(). With session tokens, the client
+        authenticates once and presents its token instead of its password. A rejected token is renewed once.
+
+        Args:
+            request (tuple): Request to be executed.
+            deadline (float, optional): time.monotonic() by which the request must be answered.
+
+        Returns:
+            response (str): The Server's response.
+        """
+        for renewed in (False, True):
+            token = self._sessionToken(deadline) if self.sessionTokens else None
+
+            # Create a packet following protocol format
+            packet = self._createPacket(request, token, deadline)
+            if not _validatePacket(packet):
+                raise CmError(f"Error while executing request: Corrupt packet structure.")
+
+            response = self._send(json.dumps(packet).encode(), deadline)
+            if token and response.startswith(AUTHFAILED) and not renewed:
+                # The token has expired or the server doesn't know its key anymore
+                self._token = None
+                continue
+            return _interpretResponse(response)
+
+    def _sessionToken(self, deadline: float = None) -> str:
+        """Returns a valid session token, sending an AUTH request with the password if necessary.
+
+        Args:
+            deadline (float, optional): time.monotonic() by which the token must be available.
+
+        Returns:
+            str: Session token.
+        """
+        if self._token and time.monotonic() < self._tokenExpires:
+            return self._token
+        return self._inflight.do(("AUTH",), lambda: self._authenticate(deadline), _remaining(deadline))
+
+    def _authenticate(self, deadline: float = None) -> str:
+        """Verifies the client's password once and stores the session token issued by the server.
+
+        Args:
+            deadline (float, optional): time.monotonic() by which the server must have answered.
+
+        Returns:
+            str: Session token.
+        """
+        packet = json.dumps(self._createPacket(("AUTH", {}), deadline=deadline)).encode()
+        answer = json.loads(_interpretResponse(self._send(packet, deadline)))
+        self._token = answer["token"]
+        # Renew the token a little before the server considers it expired
+        self._tokenExpires = time.monotonic() + 0.9 * answer["expires_in"]
+        return self._token
+
+    def _send(self, packet: bytes, deadline: float = None) -> str:
+        """Sends a packet to the CM servers. If a server can't be reached, doesn't answer or is overloaded,
+        the packet is sent to the next server. Once all servers have failed, it is retried after
+        a jittered backoff (at least as long as an overloaded server asked for), as long as
+        the retry budget and the deadline allow it.
+
+        Args:
+            packet (bytes): A CM packet.
+            deadline (float, optional): time.monotonic() by which the packet must be answered.
+
+        Returns:
+            str: The server's raw answer.
+        """
+        self._budget.deposit()
+        tried = []
+        retry = 0
+        while True:
+            try:
+                if self.hedgeDelay is None:
+                    return self._attempt(packet, deadline, tried)
+                return self._attemptHedged(packet, deadline, tried)
+            except _AttemptError as e:
+                error = e
+
+            # An overloaded server's answer is passed on once we give up, so that the caller learns when to retry
+            overloaded = error.response if isinstance(error, _Overloaded) else None
+            if _remaining(deadline) == 0:
+                if overloaded:
+                    return overloaded
+                raise CmError(f"Deadline exceeded. {error}")
+            if len(tried) == len(self._balancer.endpoints):
+                # All servers have failed, wait before trying them again
+                retryAfter = error.retryAfter if overloaded else 0.0
+                remaining = _remaining(deadline)
+                if retry == self.retries or retryAfter > RETRYAFTERCAP or (remaining is not None and retryAfter > remaining):
+                    if overloaded:
+                        return overloaded
+                    raise CmError(f"Error while executing request: {error}")
+                retry += 1
+                tried.clear()
+                _backoff(retry, deadline, minimum=retryAfter)
+            if not self._budget.withdraw():
+                if overloaded:
+                    return overloaded
+                raise CmError(f"Error while executing request: Retry budget exhausted. {error}")
+
+    def _attempt(self, packet: bytes, deadline: float, tried: list) -> str:
+        """Sends a packet to one CM server that hasn't been tried yet.
+
+        Args:
+            packet (bytes): A CM packet.
+            deadline (float): time.monotonic() by which the request must be answered, or None.
+            tried (list[_Endpoint]): Servers that have already been tried. The chosen server is added.
+
+        Returns:
+            str: The server's raw answer.
+
+        Raises:
+            _AttemptError: The server couldn't be reached, didn't answer or failed internally.
+            _Overloaded: The server is overloaded or rate limits the client.
+        """
+        endpoint = self._balancer.acquire(exclude=tried)
+        tried.append(endpoint)
+        start = time.monotonic()
+        try:
+            response = self._exchange(endpoint, packet, deadline)
+        except Exception as e:
+            # A timeout caused by the caller's own deadline isn't held against the server
+            expired = isinstance(e, _DeadlineExceeded) or (isinstance(e, socket.timeout) and _remaining(deadline) == 0)
+            self._balancer.release(endpoint, failed=not expired, expired=expired)
+            raise _AttemptError(f"{endpoint}: {e}")
+        # Only the server's own errors count against it, a rejected request (4xx) would fail on every server
+        if response.startswith("500"):
+            self._balancer.release(endpoint, failed=True)
+            raise _AttemptError(f"{endpoint}: {response}")
+        # An overloaded server is healthy, it isn't ejected but it isn't asked again right away either
+        self._balancer.release(endpoint, latency=time.monotonic() - start)
+        retryAfter = _retryAfter(response)
+        if retryAfter is not None:
+            raise _Overloaded(f"{endpoint}: {response}", response, retryAfter)
+        return response
+
+    def _attemptHedged(self, packet: bytes, deadline: float, tried: list) -> str:
+        """Sends a packet to one CM server and, if it hasn't answered after hedgeDelay seconds,
+        a duplicate to a second server. The first answer wins.
+
+        Args:
+            packet (bytes): A CM packet.
+            deadline (float): time.monotonic() by which the request must be answered, or None.
+            tried (list[_Endpoint]): Servers that have already been tried. The chosen servers are added.
+
+        Returns:
+            str: The first raw answer.
+
+        Raises:
+            _AttemptError: No server answered.
         """
-        # Create a packet following protocol format
-        packet = self._createPacket(request)
-        sslSocket = None
-        if _validatePacket(packet):
+        import queue
+
+        results = queue.Queue()
+
+        def attempt():
+            try:
+                results.put((True, self._attempt(packet, deadline, tried)))
+            except _AttemptError as e:
+                results.put((False, e))
+
+        threading.Thread(target=attempt, daemon=True).start()
+        pending = 1
+        hedged = False
+        while True:
+            wait = _remaining(deadline)
+            if not hedged:
+                wait = self.hedgeDelay if wait is None else min(wait, self.hedgeDelay)
             try:
-                sslSocket = self._createSSLSocket()
+                ok, result = results.get(timeout=wait)
+            except queue.Empty:
+                if hedged or _remaining(deadline) == 0:
+                    raise _AttemptError("Deadline exceeded.")
+                # Only hedge if there is another server and the retry budget allows it
+                hedged = True
+                if len(tried) < len(self._balancer.endpoints) and self._budget.withdraw():
+                    threading.Thread(target=attempt, daemon=True).start()
+                    pending += 1
+                continue
+
+            pending -= 1
+            if ok:
+                return result
+            if not pending:
+                raise result
+
+    def _exchange(self, endpoint: _Endpoint, packet: bytes, deadline: float = None) -> str:
+        """Sends a packet to a CM server and returns its raw answer. With keepAlive, an idle connection
+        to the server is reused. If the server has closed it in the meantime, a new connection is built.
+
+        Args:
+            endpoint (_Endpoint): The CM server.
+            packet (bytes): A CM packet.
+            deadline (float, optional): time.monotonic() by which the server must have answered.
 
-                # Open connection & exchange packets
-                sslSocket.connect((self.serverHost, self.serverPort))
-                sslSocket.sendall(packet.encode())
-                response = sslSocket.recv(1024)
-                return _interpretResponse(response.decode())
+        Returns:
+            str: The server's raw answer.
+        """
+        sslSocket = endpoint.takeIdle() if self.keepAlive else None
+        reused = sslSocket is not None
+        while True:
+            try:
+                if sslSocket is None:
+                    sslSocket = self._createSSLSocket(endpoint)
+                    sslSocket.settimeout(_socketTimeout(deadline))
+                    sslSocket.connect((endpoint.host, endpoint.port))
+                sslSocket.settimeout(_socketTimeout(deadline))
+                sslSocket.sendall(FRAMEHEADER.pack(len(packet)) + packet)
+                # Only a completely read answer leaves the connection clean for the next request
+                response = _recvFrame(sslSocket)
+                break
             except Exception as e:
-                raise CmError(f"Error while executing request: {e}")
-            finally:
-                # Close the connection
                 if sslSocket:
                     sslSocket.close()
+                sslSocket = None
+                # Only a stale persistent connection is worth a second attempt
+                if not reused or isinstance(e, _DeadlineExceeded):
+                    raise
+                reused = False
+
+        # Remember the TLS session, so that the next connection to this server can resume it
+        if sslSocket.session is not None:
+            endpoint.session = sslSocket.session
+        if self.keepAlive:
+            endpoint.putIdle(sslSocket)
         else:
-            raise CmError(f"Error while executing request: Corrupt packet structure.")
+            sslSocket.close()
+        return response.decode()
 
+    def close(self):
+        """Closes all persistent connections of this client."""
+        for endpoint in self._balancer.endpoints:
+            endpoint.closeIdle()
 
-def createClient(userConfigPath="/opt/credentials_manager/cm_config.json"):
-    """Returns a Client object using the parameters inside the config file.
+
+class AgentClient:
+    """Client endpoint that talks to a local CM agent over its unix domain socket instead of
+    connecting to the CM server directly. The agent answers from its cache or forwards the request
+    over its own persistent connection. If the agent can't be reached, requests fall back to direct TLS.
+    """
+
+    def __init__(self, agentSocket: str, fallback: Client):
+        """Initializes AgentClient objects.
+
+        Args:
+            agentSocket (str): Path to the agent's unix domain socket.
+            fallback (Client): Client used if the agent is not reachable.
+        """
+        self.agentSocket = agentSocket
+        self.fallback = fallback
+
+    def __str__(self):
+        return f"agent:{self.agentSocket}, fallback: {self.fallback}"
+
+    def _exchange(self, message: dict, timeout: float = None) -> dict:
+        """Sends a message to the agent and returns its answer.
+
+        Args:
+            message (dict): Agent message.
+            timeout (float, optional): Seconds to wait for the agent. Defaults to None.
+
+        Returns:
+            dict: The agent's answer.
+
+        Raises:
+            OSError: The agent is not reachable.
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as agentSocket:
+            agentSocket.settimeout(timeout)
+            agentSocket.connect(self.agentSocket)
+            agentSocket.sendall(json.dumps(message).encode())
+            agentSocket.shutdown(socket.SHUT_WR)
+            return json.loads(_recvAll(agentSocket).decode())
+
+    def execute(self, request, timeout: float = None):
+        """Executes a client request through the CM agent.
+
+        Args:
+            request (tuple): Request to be executed.
+            timeout (float, optional): Deadline of this request in seconds. Defaults to the fallback client's timeout.
+
+        Returns:
+            response (str): The Server's response.
+
+        Raises:
+            CmError: Error while executing request.
+        """
+        timeout = self.fallback.timeout if timeout is None else timeout
+        try:
+            answer = self._exchange({"cmRequest": request[0], "args": request[1]}, timeout)
+        except socket.timeout:
+            raise CmError("Deadline exceeded.")
+        except (OSError, ValueError):
+            # Agent not running or unusable, talk to the CM server directly
+            return self.fallback.execute(request, timeout)
+
+        if answer.get("status") != "ok":
+            raise CmError(answer.get("error", "Agent error."))
+        return answer["response"]
+
+    def invalidate(self, label=None):
+        """Drops cached answers for a label (or all cached answers) from the agent's cache.
+
+        Args:
+            label (str, optional): Credentials label. Defaults to None, which clears the whole cache.
+        """
+        args = {"label": label} if label else {}
+        try:
+            self._exchange({"cmRequest": "INVALIDATE", "args": args})
+        except (OSError, ValueError):
+            pass
+
+
+def _recvAll(sock) -> bytes:
+    """Reads from a socket until the peer closes its sending side.
+
+    Args:
+        sock (socket): Connected socket.
+
+    Returns:
+        bytes: All received data.
+    """
+    chunks = []
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def _recvFrame(sock) -> bytes:
+    """Reads exactly one framed message from a socket.
+
+    Args:
+        sock (socket): Connected socket.
+
+    Returns:
+        bytes: The message.
+
+    Raises:
+        ConnectionError: The connection was closed before the frame was complete, or the frame is too large.
+    """
+    header = _recvExactly(sock, FRAMEHEADER.size)
+    (length,) = FRAMEHEADER.unpack(header)
+    if length > MAXFRAME:
+        raise ConnectionError(f"Frame of {length} bytes exceeds the limit of {MAXFRAME} bytes.")
+    return _recvExactly(sock, length)
+
+
+def _recvExactly(sock, size: int) -> bytes:
+    """Reads exactly size bytes from a socket.
+
+    Raises:
+        ConnectionError: The connection was closed before all bytes were read.
+    """
+    chunks = []
+    received = 0
+    while received < size:
+        chunk = sock.recv(min(size - received, 16384))
+        if not chunk:
+            raise ConnectionError("Connection closed by server.")
+        chunks.append(chunk)
+        received += len(chunk)
+    return b"".join(chunks)
+
+
+def _remaining(deadline: float):
+    """Returns the seconds left until a deadline.
+
+    Args:
+        deadline (float): time.monotonic() of the deadline, or None.
+
+    Returns:
+        float: Seconds left (at least 0), or None if there is no deadline.
+    """
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def _socketTimeout(deadline: float):
+    """Returns the socket timeout for the time left until a deadline. A timeout of 0 would make the socket
+    non-blocking, so an expired deadline is raised instead.
+
+    Args:
+        deadline (float): time.monotonic() of the deadline, or None.
+
+    Returns:
+        float: Seconds left, or None if there is no deadline.
+
+    Raises:
+        _DeadlineExceeded: The deadline has already passed.
+    """
+    remaining = _remaining(deadline)
+    if remaining == 0:
+        raise _DeadlineExceeded("Deadline exceeded.")
+    return remaining
+
+
+def _retryAfter(response: str):
+    """Returns the seconds an overloaded server asked the client to wait.
+
+    Args:
+        response (str): Server response.
+
+    Returns:
+        float: Seconds to wait, or None if the response isn't an overloaded status code.
+    """
+    if not response.startswith(("503 :", "429 :")):
+        return None
+    _, _, after = response.partition("Retry after ")
+    try:
+        return float(after.split(" ")[0])
+    except ValueError:
+        return 1.0
+
+
+def _backoff(retry: int, deadline: float = None, base: float = 0.05, cap: float = 2.0, minimum: float = 0.0):
+    """Sleeps for an exponentially growing, randomly jittered time ("full jitter"), but never past the deadline.
+
+    Args:
+        retry (int): Number of the retry, starting at 1.
+        deadline (float, optional): time.monotonic() of the deadline, or None.
+        base (float, optional): Backoff of the first retry in seconds. Defaults to 0.05.
+        cap (float, optional): Maximum backoff in seconds. Defaults to 2.0.
+        minimum (float, optional): Minimum backoff in seconds, e.g. the time an overloaded server asked for. Defaults to 0.
+    """
+    import random
+
+    delay = minimum + random.uniform(0, min(cap, base * 2 ** retry))
+    remaining = _remaining(deadline)
+    time.sleep(delay if remaining is None else min(delay, remaining))
+
+
+def _isAgentRunning(agentSocket: str) -> bool:
+    """Checks if a CM agent socket exists at the given path.
+
+    Args:
+        agentSocket (str): Path to the agent's unix domain socket.
+
+    Returns:
+        bool: True if there is a socket at the given path.
+    """
+    try:
+        return stat.S_ISSOCK(os.stat(agentSocket).st_mode)
+    except OSError:
+        return False
+
+
+def loadConfig(userConfigPath="/opt/credentials_manager/cm_config.json") -> dict:
+    """Loads the CM client configuration. The returned dictionary is shared, don't modify it.
 
     Args:
         userConfigPath (str): Path to the cm_config.json
 
     Returns:
-        Client : Client object.
+        dict: Client configuration.
 
     Raises:
         CmError : Error loading client configuration.
     """
+    # The file is parsed once per process, a changed file is detected by its modification time
     try:
+        mtime = os.stat(userConfigPath).st_mtime_ns
+        cached = _CONFIGS.get(userConfigPath)
+        if cached and cached[0] == mtime:
+            return cached[1]
         with open(userConfigPath, "r") as f:
             data = json.load(f)
-            return Client(
-                caCert=data["ca_cert"],
-                clientCert=data["client_cert"],
-                clientKey=data["client_key"],
-                serverHost=data["server_host"],
-                serverPort=data["server_port"],
-                cmUser=data["client_username"],
-                cmPassword=data["client_password"],
-            )
     except Exception as e:
         raise CmError(f"Can't load CM client configuration: {e}")
+    _CONFIGS[userConfigPath] = (mtime, data)
+    return data
+
+
+def clientFromConfig(data: dict, keepAlive=False) -> Client:
+    """Returns a Client object that connects directly to the CM server.
+
+    Args:
+        data (dict): Client configuration.
+        keepAlive (bool, optional): Keep the TLS connection open between requests. Defaults to False.
+
+    Returns:
+        Client : Client object.
+
+    Raises:
+        CmError : Invalid client configuration.
+    """
+    try:
+        # Either a list of servers or a single server_host & server_port
+        servers = [(server["host"], server["port"]) for server in data.get("servers", [])]
+        servers = servers or [(data["server_host"], data["server_port"])]
+        return Client(
+            caCert=data["ca_cert"],
+            clientCert=data["client_cert"],
+            clientKey=data["client_key"],
+            serverHost=servers[0][0],
+            serverPort=servers[0][1],
+            cmUser=data["client_username"],
+            cmPassword=data.get("client_password"),
+            keepAlive=keepAlive,
+            servers=servers,
+            balancing=data.get("balancing", "least_latency"),
+            timeout=data.get("timeout"),
+            hedgeDelay=data.get("hedge_delay"),
+            retries=data.get("retries", 2),
+            retryBudget=data.get("retry_budget", 0.2),
+            sessionTokens=data.get("session_tokens", False),
+        )
+    except Exception as e:
+        raise CmError(f"Can't load CM client configuration: {e}")
+
+
+def createClient(userConfigPath="/opt/credentials_manager/cm_config.json", useAgent=True):
+    """Returns a Client object using the parameters inside the config file.
+    If a CM agent is running on this host, the returned client talks to the agent and falls back
+    to a direct TLS connection if the agent becomes unavailable.
+
+    Args:
+        userConfigPath (str): Path to the cm_config.json
+        useAgent (bool, optional): Use a local CM agent if one is running. Defaults to True.
+
+    Returns:
+        Client : Client object.
+
+    Raises:
+        CmError : Error loading client configuration.
+    """
+    data = loadConfig(userConfigPath)
+    client = clientFromConfig(data)
+
+    agentSocket = data.get("agent_socket", AGENTSOCKET)
+    if useAgent and agentSocket and _isAgentRunning(agentSocket):
+        return AgentClient(agentSocket, fallback=client)
+    return client
 
 
 def _interpretResponse(response):
@@ -201,17 +1041,23 @@ def _interpretResponse(response):
         response (str): Server response.
 
     Raises:
-        CmError: Invalid packet structure.
-        CmError: Client authentication failed.
+        CmError: The request has been rejected (invalid packet, failed authentication, unknown request).
+        CmError: Server error.
+        CmError: Deadline exceeded.
+        CmOverloaded: Server overloaded or too many requests.
 
     Returns:
         str: response
     """
     # Error messages
     if response.startswith("500"):
-        raise CmError("Invalid packet structure.")
+        raise CmError("Server error.")
     elif response.startswith("400"):
-        raise CmError("Client authentication failed.")
+        raise CmError(response.split(" : ", 1)[-1])
+    elif response.startswith("504"):
+        raise CmError("Deadline exceeded.")
+    elif _retryAfter(response) is not None:
+        raise CmOverloaded(response.split(" : ", 1)[1], _retryAfter(response))
     # Valid response
     else:
         return response
@@ -221,3 +1067,33 @@ class CmError(Exception):
     """Exception raised for errors in the SSL connection."""
 
     pass
+
+
+class CmOverloaded(CmError):
+    """Exception raised if the CM servers are overloaded or rate limit the client.
+    retryAfter holds the seconds the client should wait before sending its next request."""
+
+    def __init__(self, message: str, retryAfter: float):
+        super().__init__(message)
+        self.retryAfter = retryAfter
+
+
+class _AttemptError(CmError):
+    """Exception raised if a single CM server couldn't be reached or didn't answer."""
+
+    pass
+
+
+class _DeadlineExceeded(_AttemptError):
+    """Exception raised if the caller's deadline passed before a CM server could be asked."""
+
+    pass
+
+
+class _Overloaded(_AttemptError):
+    """Exception raised if a single CM server answered with an overloaded status code."""
+
+    def __init__(self, message: str, response: str, retryAfter: float):
+        super().__init__(message)
+        self.response = response
+        self.retryAfter = retryAfter
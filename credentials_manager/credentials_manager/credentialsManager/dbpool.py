@@ -0,0 +1,196 @@
+"""This module implements managed MySQL/MariaDB connection pools for credentials stored in the CM server.
+A pool fetches its credentials once and keeps its connections open. If a connection is refused with
+"access denied" after the credentials have been rotated, the credentials are fetched again and the pool
+is rebuilt in the background, while connections that are already in use keep working.
+
+Requires the mysql-connector-python package (pip install credentials_manager[pool]).
+"""
+import re
+import json
+import threading
+from contextlib import contextmanager
+from credentialsManager import credentialsManager as cm
+
+# MySQL error code for ER_ACCESS_DENIED_ERROR
+ACCESSDENIED = 1045
+
+
+class ManagedPool:
+    """Connection pool for the database credentials with a given CM label."""
+
+    def __init__(self, label: str, client=None, poolSize: int = 5, refreshTimeout: float = 30):
+        """Constructor for ManagedPool objects. Fetches the credentials and opens the pool's connections.
+
+        Args:
+            label (str): Label of the credentials in the CM server.
+            client (Client, optional): CM client used to fetch the credentials. Defaults to createClient().
+            poolSize (int, optional): Number of connections kept open. Defaults to 5.
+            refreshTimeout (float, optional): Seconds a caller waits for a rebuilt pool after a rotation. Defaults to 30.
+
+        Raises:
+            CmError: Can't fetch the credentials.
+        """
+        self.label = label
+        self.client = client or cm.createClient()
+        self.poolSize = poolSize
+        self.refreshTimeout = refreshTimeout
+        self._lock = threading.Lock()
+        self._generation = 1
+        self._refreshing = None
+        self._error = None
+        # Replaced pools and the number of their connections that have been closed so far
+        self._retired = []
+        self._pool = self._buildPool(self._fetchConfig(), self._generation)
+
+    def _fetchConfig(self, invalidate=False) -> dict:
+        """Fetches the database configuration for this pool's label.
+
+        Args:
+            invalidate (bool, optional): Drop cached credentials (e.g. in the CM agent) first. Defaults to False.
+
+        Returns:
+            dict: Database configuration for mysql.connector.
+
+        Raises:
+            CmError: Can't fetch the credentials.
+        """
+        if invalidate and hasattr(self.client, "invalidate"):
+            self.client.invalidate(self.label)
+        config = json.loads(self.client.execute(("GET_CR", {"label": self.label})))
+        if not config:
+            raise cm.CmError(f"No access to credentials '{self.label}'.")
+        return config
+
+    def _buildPool(self, config: dict, generation: int):
+        """Creates a new connection pool from a database configuration.
+
+        Args:
+            config (dict): Database configuration for mysql.connector.
+            generation (int): Generation of the new pool, used to give every pool a unique name.
+
+        Returns:
+            MySQLConnectionPool: The new pool.
+        """
+        from mysql.connector import pooling
+
+        # Pool names may only contain a restricted set of characters
+        poolName = re.sub(r"[^a-zA-Z0-9._:\-*$#]", "_", self.label)[:48]
+        return pooling.MySQLConnectionPool(
+            pool_name=f"{poolName}-{generation}",
+            pool_size=self.poolSize,
+            **config,
+        )
+
+    def _rebuild(self, done: threading.Event):
+        """Fetches fresh credentials and swaps in a new pool. Runs in a background thread.
+
+        Args:
+            done (Event): Event that is set when the rebuild has finished.
+        """
+        try:
+            pool = self._buildPool(self._fetchConfig(invalidate=True), self._generation + 1)
+            with self._lock:
+                self._retired.append([self._pool, 0])
+                self._pool = pool
+                self._generation += 1
+                self._error = None
+        except Exception as e:
+            with self._lock:
+                self._error = e
+            print(f"Error: Can't rebuild pool for '{self.label}': {e}")
+        finally:
+            with self._lock:
+                self._refreshing = None
+            done.set()
+        self._closeRetired()
+
+    def _closeRetired(self):
+        """Closes the idle connections of replaced pools. Connections that were in use during the swap are
+        returned to their old pool, so they are closed on a later call. A replaced pool is dropped once all of
+        its connections have been closed."""
+        with self._lock:
+            retired = list(self._retired)
+        for entry in retired:
+            pool = entry[0]
+            entry[1] += pool._remove_connections()
+            if entry[1] >= pool.pool_size:
+                with self._lock:
+                    self._retired = [other for other in self._retired if other is not entry]
+
+    def _refresh(self, generation: int) -> threading.Event:
+        """Starts a background rebuild of the pool, unless one is already running or
+        the pool has already been rebuilt since the given generation.
+
+        Args:
+            generation (int): Pool generation that refused a connection.
+
+        Returns:
+            Event: Event that is set when the rebuild has finished.
+        """
+        with self._lock:
+            if self._generation != generation:
+                done = threading.Event()
+                done.set()
+                return done
+            if self._refreshing is None:
+                self._refreshing = threading.Event()
+                threading.Thread(target=self._rebuild, args=(self._refreshing,), daemon=True).start()
+            return self._refreshing
+
+    def getConnection(self):
+        """Returns a connection from the pool. Calling close() on it returns it to the pool.
+
+        Returns:
+            PooledMySQLConnection: Open database connection.
+
+        Raises:
+            mysql.connector.Error: Can't get a connection.
+        """
+        import mysql.connector
+
+        with self._lock:
+            pool, generation = self._pool, self._generation
+            retired = bool(self._retired)
+        if retired:
+            self._closeRetired()
+        try:
+            return pool.get_connection()
+        except mysql.connector.Error as e:
+            if e.errno != ACCESSDENIED:
+                raise
+            error = e
+
+        # The credentials were probably rotated. Wait for a pool with fresh credentials.
+        if not self._refresh(generation).wait(self.refreshTimeout):
+            raise error
+        with self._lock:
+            newPool, lastError = self._pool, self._error
+        if newPool is pool:
+            raise lastError or error
+        return newPool.get_connection()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that borrows a connection from the pool and returns it afterwards."""
+        connection = self.getConnection()
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+
+def createPool(label: str, poolSize: int = 5, userConfigPath="/opt/credentials_manager/cm_config.json") -> ManagedPool:
+    """Returns a managed connection pool for the credentials with the given label.
+
+    Args:
+        label (str): Label of the credentials in the CM server.
+        poolSize (int, optional): Number of connections kept open. Defaults to 5.
+        userConfigPath (str): Path to the cm_config.json
+
+    Returns:
+        ManagedPool: Connection pool.
+
+    Raises:
+        CmError: Can't fetch the credentials.
+    """
+    return ManagedPool(label, cm.createClient(userConfigPath), poolSize=poolSize)
@@ -9,9 +9,13 @@ setup(
     description="A module that allows a client to connect and communicate with a Credentials Manager Server.",
     packages=find_packages(),
     include_package_data=True,
-    install_requires=[
-        "jsonschema",
-    ],
+    install_requires=[],
+    extras_require={
+        "pool": ["mysql-connector-python>=8.1.0"],
+    },
+    entry_points={
+        "console_scripts": ["cm-agent=credentialsManager.agent:main"],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "Operating System :: OS Independent",
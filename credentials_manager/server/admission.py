@@ -0,0 +1,142 @@
+"""This module implements admission control for the CM server. It runs before a client is authenticated,
+so that a misbehaving client (e.g. one that keeps sending a wrong password) is turned away before it costs
+a bcrypt hash. Every client certificate has a token bucket limiting its request rate, checked before authentication,
+and every authenticated user has one as well. Clients that failed to authenticate have to wait for an exponentially
+growing backoff before they may try again."""
+import time
+import threading
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """Token bucket rate limiter. Not thread-safe, AdmissionControl holds a lock while using it."""
+
+    def __init__(self, rate: float, burst: float):
+        """Constructor for TokenBucket objects.
+
+        Args:
+            rate (float): Tokens added per second.
+            burst (float): Maximum number of tokens.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """Takes a token from the bucket.
+
+        Args:
+            now (float): Current time.monotonic().
+
+        Returns:
+            float: 0 if a token was taken, else the seconds until the next token is available.
+        """
+        # A bucket created after now was taken hasn't lost any tokens
+        self.tokens = min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = max(self.updated, now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class _LruTable(OrderedDict):
+    """Dictionary that forgets its least recently used entries beyond a maximum size,
+    so that clients sending random usernames can't exhaust the server's memory."""
+
+    def __init__(self, maxEntries: int):
+        super().__init__()
+        self.maxEntries = maxEntries
+
+    def touch(self, key, default):
+        """Returns the entry for key (creating it with default() if necessary) and marks it as recently used."""
+        if key in self:
+            self.move_to_end(key)
+            return self[key]
+        value = self[key] = default()
+        if len(self) > self.maxEntries:
+            self.popitem(last=False)
+        return value
+
+
+class AdmissionControl:
+    """Decides whether a packet is admitted before its client is authenticated."""
+
+    def __init__(
+        self,
+        certRate: float = 50,
+        userRate: float = 50,
+        burst: float = 100,
+        failureBackoff: float = 0.5,
+        maxBackoff: float = 60,
+        maxEntries: int = 10000,
+    ):
+        """Constructor for AdmissionControl objects.
+
+        Args:
+            certRate (float, optional): Packets per second per client certificate. Defaults to 50.
+            userRate (float, optional): Packets per second per username. Defaults to 50.
+            burst (float, optional): Packets a client may send at once. Defaults to 100.
+            failureBackoff (float, optional): Seconds a client has to wait after its first failed authentication,
+                doubled with every further failure. Defaults to 0.5.
+            maxBackoff (float, optional): Maximum backoff in seconds. Defaults to 60.
+            maxEntries (int, optional): Maximum number of entries per table. Defaults to 10000.
+        """
+        self.certRate = certRate
+        self.userRate = userRate
+        self.burst = burst
+        self.failureBackoff = failureBackoff
+        self.maxBackoff = maxBackoff
+        self._certBuckets = _LruTable(maxEntries)
+        self._userBuckets = _LruTable(maxEntries)
+        self._failures = _LruTable(maxEntries)
+        self._lock = threading.Lock()
+
+    def admit(self, fingerprint: str, username: str) -> float:
+        """Checks if a packet may be authenticated. Only the certificate's bucket is charged, as the username
+        hasn't been verified yet and a client mustn't drain another user's bucket by claiming their name.
+
+        Args:
+            fingerprint (str): Fingerprint of the client's certificate.
+            username (str): Username claimed in the packet's header.
+
+        Returns:
+            float: 0 if the packet is admitted, else the seconds the client should wait before retrying.
+        """
+        now = time.monotonic()
+        with self._lock:
+            failures = self._failures.get((fingerprint, username))
+            if failures and failures[1] > now:
+                return failures[1] - now
+            return self._certBuckets.touch(fingerprint, lambda: TokenBucket(self.certRate, self.burst)).take(now)
+
+    def admitUser(self, username: str) -> float:
+        """Checks if a packet of an authenticated user may be processed.
+
+        Args:
+            username (str): The authenticated username.
+
+        Returns:
+            float: 0 if the packet is admitted, else the seconds the client should wait before retrying.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return self._userBuckets.touch(username, lambda: TokenBucket(self.userRate, self.burst)).take(now)
+
+    def recordAuthentication(self, fingerprint: str, username: str, success: bool):
+        """Records the outcome of an authentication, which resets or extends the client's backoff.
+
+        Args:
+            fingerprint (str): Fingerprint of the client's certificate.
+            username (str): Username claimed in the packet's header.
+            success (bool): True if the client was authenticated.
+        """
+        key = (fingerprint, username)
+        with self._lock:
+            if success:
+                self._failures.pop(key, None)
+                return
+            count, _ = self._failures.touch(key, lambda: (0, 0.0))
+            backoff = min(self.maxBackoff, self.failureBackoff * 2 ** min(count, 16))
+            self._failures[key] = (count + 1, time.monotonic() + backoff)
@@ -0,0 +1,213 @@
+"""This module keeps an audit log of credential access: which user requested which label with which client
+certificate, the outcome and how long it took. Events are queued in memory and written in batches by a background
+thread, either to the cm.audit_log table or appended to a local JSON lines file, so that requests don't wait for
+the audit log. The queue is bounded, events that don't fit under overload are dropped and counted."""
+import json
+import time
+import queue
+import threading
+import mysql.connector
+import connector as cn
+import metrics
+
+# Outcomes of audited requests
+GRANTED = "granted"
+DENIED = "denied"
+AUTH_FAILED = "auth_failed"
+RATE_LIMITED = "rate_limited"
+ERROR = "error"
+
+# Lengths of the cm.audit_log columns, longer values are truncated
+USERNAMELENGTH = 255
+LABELLENGTH = 255
+FINGERPRINTLENGTH = 64
+
+
+class AuditLog:
+    """Bounded queue of audit events with a background writer."""
+
+    def __init__(self, maxQueue: int = 10000, batchSize: int = 500, flushInterval: float = 1, path: str = None):
+        """Constructor for AuditLog objects.
+
+        Args:
+            maxQueue (int, optional): Maximum number of queued events. Defaults to 10000.
+            batchSize (int, optional): Maximum number of events written at once. Defaults to 500.
+            flushInterval (float, optional): Seconds the writer waits for a batch to fill up. Defaults to 1.
+            path (str, optional): JSON lines file the events are appended to. Defaults to the cm.audit_log table.
+        """
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.path = path
+        self._events = queue.Queue(maxsize=maxQueue)
+        self._writeLock = threading.Lock()
+
+    def record(self, username: str, label: str, fingerprint: str, outcome: str, latency: float):
+        """Queues an audit event. Never blocks, the event is dropped if the queue is full.
+
+        Args:
+            username (str): Username of the client.
+            label (str): Requested credentials label, or None.
+            fingerprint (str): Fingerprint of the client's certificate.
+            outcome (str): Outcome of the request (GRANTED, DENIED, AUTH_FAILED, RATE_LIMITED or ERROR).
+            latency (float): Seconds it took to handle the request.
+        """
+        try:
+            # Values of unauthenticated clients must not make the event, or its whole batch, fail to be written
+            username = _truncate(username, USERNAMELENGTH) or ""
+            label = _truncate(label, LABELLENGTH)
+            fingerprint = _truncate(fingerprint, FINGERPRINTLENGTH)
+            self._events.put_nowait((time.time(), username, label, fingerprint, outcome, round(latency * 1000, 3)))
+        except queue.Full:
+            metrics.COUNTERS.increment("audit_dropped")
+
+    def flush(self):
+        """Writes all queued events."""
+        while self._write(self._take(wait=False)):
+            pass
+
+    def start(self):
+        """Starts writing the queued events in a background thread."""
+
+        def write():
+            while True:
+                self._write(self._take(wait=True))
+
+        threading.Thread(target=write, daemon=True).start()
+
+    def _take(self, wait: bool) -> list:
+        """Takes a batch of events from the queue.
+
+        Args:
+            wait (bool): Wait up to flushInterval seconds for the first event and for the batch to fill up.
+
+        Returns:
+            list[tuple]: Up to batchSize events.
+        """
+        batch = []
+        if wait:
+            batch.append(self._events.get())
+            end = time.monotonic() + self.flushInterval
+        while len(batch) < self.batchSize:
+            try:
+                if wait:
+                    batch.append(self._events.get(timeout=max(0, end - time.monotonic())))
+                else:
+                    batch.append(self._events.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: list) -> int:
+        """Writes a batch of events. If the batch can't be inserted as a whole, its events are inserted one by one,
+        so that a single bad event doesn't take the others with it. Events that can't be written are counted as dropped.
+
+        Args:
+            batch (list[tuple]): Events.
+
+        Returns:
+            int: Number of events in the batch.
+        """
+        if not batch:
+            return 0
+        with self._writeLock:
+            written = 0
+            try:
+                if self.path:
+                    self._append(batch)
+                else:
+                    self._insert(batch)
+                written = len(batch)
+            except (OSError, mysql.connector.Error) as e:
+                print(f"Error: {e}")
+                if not self.path and len(batch) > 1:
+                    written = self._insertEach(batch)
+            if written:
+                metrics.COUNTERS.increment("audit_written", written)
+            if written < len(batch):
+                metrics.COUNTERS.increment("audit_dropped", len(batch) - written)
+        return len(batch)
+
+    def _append(self, batch: list):
+        with open(self.path, "a") as f:
+            f.writelines(
+                json.dumps(
+                    {
+                        "time": timestamp,
+                        "user": username,
+                        "label": label,
+                        "fingerprint": fingerprint,
+                        "outcome": outcome,
+                        "latency_ms": latency,
+                    }
+                )
+                + "\n"
+                for timestamp, username, label, fingerprint, outcome, latency in batch
+            )
+
+    def _insert(self, batch: list):
+        connection = None
+        cursor = None
+        try:
+            connection = cn.connect()
+            cursor = connection.cursor()
+            cursor.executemany(
+                "INSERT INTO audit_log (created_at, username, label, fingerprint, outcome, latency_ms) "
+                "VALUES (FROM_UNIXTIME(%s), %s, %s, %s, %s, %s)",
+                batch,
+            )
+            connection.commit()
+        finally:
+            # Close connection gracefully
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
+    def _insertEach(self, batch: list) -> int:
+        """Inserts the events of a batch one by one, skipping the ones that fail.
+
+        Returns:
+            int: Number of inserted events.
+        """
+        written = 0
+        connection = None
+        cursor = None
+        try:
+            connection = cn.connect()
+            cursor = connection.cursor()
+            for event in batch:
+                try:
+                    cursor.execute(
+                        "INSERT INTO audit_log (created_at, username, label, fingerprint, outcome, latency_ms) "
+                        "VALUES (FROM_UNIXTIME(%s), %s, %s, %s, %s, %s)",
+                        event,
+                    )
+                    connection.commit()
+                    written += 1
+                except mysql.connector.Error as e:
+                    print(f"Error: {e}")
+                    if not connection.is_connected():
+                        # The database isn't available anymore, the remaining events are dropped
+                        break
+                    connection.rollback()
+        except mysql.connector.Error as e:
+            # The database isn't available, the remaining events are dropped
+            print(f"Error: {e}")
+        finally:
+            # Close connection gracefully
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+        return written
+
+
+def _truncate(value, length: int):
+    """Returns a value as a string of at most length characters, or None."""
+    if value is None:
+        return None
+    return str(value)[:length]
+
+
+# Audit log of this process, configured by the CM server at startup
+LOG = AuditLog()
@@ -0,0 +1,250 @@
+"""This module backs up and restores the CM store: users, credentials, data keys, permissions and roles.
+Nothing is decrypted, credentials and data keys are copied as they are stored, so a backup can only be used with
+the same HSM root key. Rows are streamed in chunks, so backups and restores need constant memory.
+
+A backup archive starts with MAGIC, followed by frames. Every frame consists of its kind (1 byte), the length of its
+payload (4 bytes), the payload (zlib compressed JSON) and the CRC32 of the payload (4 bytes). A TABLE frame starts
+a table and names its columns, ROWS frames contain up to CHUNKSIZE of its rows, and the END frame lists the number
+of rows of every table, so that a truncated archive is noticed as well."""
+import os
+import zlib
+import json
+import base64
+import struct
+import mysql.connector
+import connector as cn
+import changes
+import identities
+import permissions
+import versions
+
+# First bytes of every backup archive, including the format version
+MAGIC = b"CMBACKUP1\n"
+
+# Backed up tables, in an order that satisfies their foreign keys
+TABLES = [
+    "users",
+    "credentials",
+    "data_keys",
+    "permissions",
+    "permission_patterns",
+    "roles",
+    "role_grants",
+    "role_members",
+]
+
+# Number of rows per frame, and per bulk insert when restoring
+CHUNKSIZE = 5000
+
+# Kinds of frames
+TABLE = b"T"
+ROWS = b"R"
+END = b"E"
+
+_HEADER = struct.Struct(">cI")
+_CRC = struct.Struct(">I")
+
+
+def exportStore(path: str, chunkSize: int = CHUNKSIZE) -> dict:
+    """Writes a backup of the CM store. All tables are read in one transaction, so the backup is consistent.
+    Only the CLI's user may read the archive.
+
+    Args:
+        path (str): Path of the backup archive.
+        chunkSize (int, optional): Number of rows per frame. Defaults to CHUNKSIZE.
+
+    Returns:
+        dict: Number of backed up rows by table, None if the backup failed.
+    """
+    connection = None
+    cursor = None
+    temporary = f"{path}.tmp"
+    try:
+        # Connect to the MariaDB database
+        connection = cn.connect()
+        connection.start_transaction(consistent_snapshot=True, readonly=True)
+        # Unbuffered cursor, rows are streamed from the server as they are fetched
+        cursor = connection.cursor(buffered=False)
+
+        counts = {}
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC)
+            for table in TABLES:
+                cursor.execute(f"SELECT * FROM {table}")
+                _writeFrame(f, TABLE, {"table": table, "columns": list(cursor.column_names)})
+                counts[table] = 0
+                while True:
+                    rows = cursor.fetchmany(chunkSize)
+                    if not rows:
+                        break
+                    _writeFrame(f, ROWS, [[_encodeValue(value) for value in row] for row in rows])
+                    counts[table] += len(rows)
+            _writeFrame(f, END, counts)
+        connection.commit()
+        os.replace(temporary, path)
+        print(f"Exported {sum(counts.values())} rows to '{path}'.")
+        return counts
+    except (mysql.connector.Error, OSError) as e:
+        print(f"Error: {e}")
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        return None
+    finally:
+        # Close connection gracefully
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+
+def restoreStore(path: str) -> dict:
+    """Replaces the CM store with a backup, in a single transaction. The archive is verified completely
+    before anything is changed. All CM servers drop their cached data keys and reload their permissions.
+
+    Args:
+        path (str): Path of the backup archive.
+
+    Returns:
+        dict: Number of restored rows by table, None if the restore failed.
+    """
+    try:
+        counts = verifyArchive(path)
+    except (OSError, ArchiveError) as e:
+        print(f"Invalid backup: {e}")
+        return None
+
+    connection = None
+    cursor = None
+    try:
+        # Connect to the MariaDB database
+        connection = cn.connect()
+        cursor = connection.cursor()
+
+        # The rows come from a consistent backup, their foreign keys don't need to be checked one by one
+        cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+        for table in reversed(TABLES):
+            cursor.execute(f"DELETE FROM {table}")
+
+        query = None
+        with open(path, "rb") as f:
+            for kind, payload in _readFrames(f):
+                if kind == TABLE:
+                    columns = ", ".join(f"`{column}`" for column in payload["columns"])
+                    placeholders = ", ".join(["%s"] * len(payload["columns"]))
+                    query = f"INSERT INTO {payload['table']} ({columns}) VALUES ({placeholders})"
+                elif kind == ROWS:
+                    cursor.executemany(query, [tuple(_decodeValue(value) for value in row) for row in payload])
+        cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+
+        # Servers reload their indexes and drop all cached data keys
+        versions.bumpVersion(cursor, identities.VERSIONNAME)
+        versions.bumpVersion(cursor, permissions.VERSIONNAME)
+        changes.record(cursor, changes.CREDENTIALS, None)
+        changes.record(cursor, changes.PERMISSIONS, None)
+        connection.commit()
+        print(f"Restored {sum(counts.values())} rows from '{path}'.")
+        return counts
+    except (mysql.connector.Error, OSError, ArchiveError) as e:
+        # Nothing has been changed
+        if connection:
+            connection.rollback()
+        print(f"Error: {e}")
+        return None
+    finally:
+        # Close connection gracefully
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+
+def verifyArchive(path: str) -> dict:
+    """Verifies the checksums and the structure of a backup archive.
+
+    Args:
+        path (str): Path of the backup archive.
+
+    Returns:
+        dict: Number of rows by table.
+
+    Raises:
+        ArchiveError: The archive is corrupted or incomplete.
+    """
+    counts = {}
+    table = None
+    with open(path, "rb") as f:
+        for kind, payload in _readFrames(f):
+            if kind == TABLE:
+                table = payload.get("table")
+                if table not in TABLES or table in counts:
+                    raise ArchiveError(f"Unexpected table {table!r}.")
+                if not all(isinstance(column, str) and column.isidentifier() for column in payload.get("columns", [])):
+                    raise ArchiveError(f"Invalid columns of table {table!r}.")
+                counts[table] = 0
+            elif kind == ROWS:
+                if table is None:
+                    raise ArchiveError("Rows without a table.")
+                counts[table] += len(payload)
+            elif kind == END:
+                if payload != counts or set(counts) != set(TABLES):
+                    raise ArchiveError("Row counts don't match.")
+                return counts
+            else:
+                raise ArchiveError(f"Unknown frame {kind!r}.")
+    raise ArchiveError("Archive is incomplete.")
+
+
+def _writeFrame(f, kind: bytes, payload):
+    data = zlib.compress(json.dumps(payload, separators=(",", ":")).encode())
+    f.write(_HEADER.pack(kind, len(data)))
+    f.write(data)
+    f.write(_CRC.pack(zlib.crc32(data)))
+
+
+def _readFrames(f):
+    """Reads the frames of a backup archive.
+
+    Args:
+        f (file): Archive opened in binary mode.
+
+    Yields:
+        tuple: (kind, payload) of every frame.
+
+    Raises:
+        ArchiveError: A frame is truncated or its checksum doesn't match.
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ArchiveError("Not a CM backup.")
+    while True:
+        header = f.read(_HEADER.size)
+        if not header:
+            return
+        if len(header) < _HEADER.size:
+            raise ArchiveError("Truncated frame.")
+        kind, length = _HEADER.unpack(header)
+        data = f.read(length)
+        crc = f.read(_CRC.size)
+        if len(data) < length or len(crc) < _CRC.size:
+            raise ArchiveError("Truncated frame.")
+        if _CRC.unpack(crc)[0] != zlib.crc32(data):
+            raise ArchiveError("Checksum mismatch.")
+        yield kind, json.loads(zlib.decompress(data))
+
+
+def _encodeValue(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {"b": base64.b64encode(value).decode()}
+    return value
+
+
+def _decodeValue(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value["b"])
+    return value
+
+
+class ArchiveError(Exception):
+    """Exception raised for corrupted or incomplete backup archives."""
+
+    pass
@@ -0,0 +1,192 @@
+"""This module implements the change log of the CM database (the cm.cm_changes table). Every process that
+changes credentials, users or permissions records what it has changed in the same transaction. CM servers tail
+the log and invalidate exactly the affected cache entries (e.g. the data key of a rotated label, or the
+sessions of a deleted user), so that a change made on one node reaches all others within a bounded delay.
+
+Change ids are assigned when a change is inserted, but become visible when its transaction commits, so a change
+may appear below ids that have already been read. Ids that were skipped are therefore read again on every poll,
+until they show up or are older than the gap timeout (ids of rolled back transactions never show up)."""
+import time
+import threading
+import mysql.connector
+import connector as cn
+
+# Kinds of changes, the subject is a credentials label, a username or a role name
+CREDENTIALS = "credentials"
+USER = "user"
+PERMISSIONS = "permissions"
+
+# Changes older than this many days are pruned from the log
+RETENTION = 1
+
+# Maximum number of changes deleted per statement when pruning the log
+PRUNEBATCH = 1000
+
+
+def record(cursor, kind: str, subject: str):
+    """Records a change. Call this with the cursor of the transaction that makes the change.
+
+    Args:
+        cursor (MySQLCursor): Cursor of the changing transaction.
+        kind (str): Kind of the change (CREDENTIALS, USER or PERMISSIONS).
+        subject (str): Changed label, username or role.
+    """
+    cursor.execute("INSERT INTO cm_changes (kind, subject) VALUES (%s, %s)", (kind, subject))
+
+
+def prune() -> int:
+    """Deletes changes older than RETENTION days from the log, in small batches so that the writers
+    of new changes are never blocked for long.
+
+    Returns:
+        int: Number of deleted changes.
+    """
+    connection = None
+    cursor = None
+    deleted = 0
+    try:
+        connection = cn.connect()
+        cursor = connection.cursor()
+        while True:
+            cursor.execute(
+                "DELETE FROM cm_changes WHERE created_at < NOW() - INTERVAL %s DAY LIMIT %s",
+                (RETENTION, PRUNEBATCH),
+            )
+            connection.commit()
+            deleted += cursor.rowcount
+            if cursor.rowcount < PRUNEBATCH:
+                return deleted
+    except mysql.connector.Error as e:
+        print(f"Error: {e}")
+        return deleted
+    finally:
+        # Close connection gracefully
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+
+class ChangeFeed:
+    """Tails the change log and calls the subscribed callbacks for every new change."""
+
+    def __init__(
+        self,
+        pollInterval: float = 1,
+        batchSize: int = 1000,
+        gapTimeout: float = 300,
+        maxGaps: int = 10000,
+        pruneInterval: float = 3600,
+    ):
+        """Constructor for ChangeFeed objects.
+
+        Args:
+            pollInterval (float, optional): Seconds between two polls of the change log. Defaults to 1.
+            batchSize (int, optional): Maximum number of changes read per poll. Defaults to 1000.
+            gapTimeout (float, optional): Seconds a skipped change id is read again. Defaults to 300.
+            maxGaps (int, optional): Maximum number of skipped change ids that are read again. Defaults to 10000.
+            pruneInterval (float, optional): Seconds between two prunings of the log. Defaults to 3600.
+        """
+        self.pollInterval = pollInterval
+        self.batchSize = batchSize
+        self.gapTimeout = gapTimeout
+        self.maxGaps = maxGaps
+        self.pruneInterval = pruneInterval
+        self._subscribers = {}
+        self._lastId = None
+        # Skipped change ids below _lastId, by time.monotonic() at which they were first skipped
+        self._gaps = {}
+
+    def subscribe(self, kind: str, callback):
+        """Subscribes to a kind of changes.
+
+        Args:
+            kind (str): Kind of the changes.
+            callback (function): Called with the subject of every change of that kind.
+        """
+        self._subscribers.setdefault(kind, []).append(callback)
+
+    def poll(self):
+        """Reads the changes made since the last poll, and the skipped changes that have been committed since,
+        and dispatches them to the subscribers. The first poll only notes the log's current position."""
+        connection = None
+        cursor = None
+        try:
+            # The log is read from the primary (an indexed range read), so replication lag never delays an invalidation
+            connection = cn.connect()
+            cursor = connection.cursor()
+            if self._lastId is None:
+                cursor.execute("SELECT COALESCE(MAX(change_id), 0) FROM cm_changes")
+                self._lastId = cursor.fetchone()[0]
+                return
+            self._pollGaps(cursor)
+            while True:
+                cursor.execute(
+                    "SELECT change_id, kind, subject FROM cm_changes WHERE change_id > %s ORDER BY change_id LIMIT %s",
+                    (self._lastId, self.batchSize),
+                )
+                rows = cursor.fetchall()
+                now = time.monotonic()
+                for changeId, kind, subject in rows:
+                    # Ids in between may belong to transactions that haven't committed yet
+                    for skipped in range(max(self._lastId + 1, changeId - self.maxGaps), changeId):
+                        self._gaps[skipped] = now
+                    self._dispatch(kind, subject)
+                    self._lastId = changeId
+                if len(self._gaps) > self.maxGaps:
+                    for skipped in sorted(self._gaps)[: len(self._gaps) - self.maxGaps]:
+                        del self._gaps[skipped]
+                if len(rows) < self.batchSize:
+                    return
+        except mysql.connector.Error as e:
+            print(f"Error: {e}")
+        finally:
+            # Close connection gracefully
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
+    def _pollGaps(self, cursor):
+        """Reads the skipped changes that have been committed since the last poll, and forgets the skipped ids
+        that are older than gapTimeout.
+
+        Args:
+            cursor (MySQLCursor): Cursor of the poll.
+        """
+        now = time.monotonic()
+        self._gaps = {changeId: skipped for changeId, skipped in self._gaps.items() if now - skipped < self.gapTimeout}
+        gaps = sorted(self._gaps)
+        for i in range(0, len(gaps), self.batchSize):
+            chunk = gaps[i : i + self.batchSize]
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute(
+                f"SELECT change_id, kind, subject FROM cm_changes WHERE change_id IN ({placeholders}) ORDER BY change_id",
+                tuple(chunk),
+            )
+            for changeId, kind, subject in cursor.fetchall():
+                del self._gaps[changeId]
+                self._dispatch(kind, subject)
+
+    def _dispatch(self, kind: str, subject: str):
+        for callback in self._subscribers.get(kind, ()):
+            try:
+                callback(subject)
+            except Exception as e:
+                print(f"Error: {e}")
+
+    def start(self):
+        """Starts tailing the change log in a background thread, which also prunes the log every pruneInterval
+        seconds."""
+        self.poll()
+
+        def tail():
+            pruned = time.monotonic()
+            while True:
+                time.sleep(self.pollInterval)
+                self.poll()
+                if time.monotonic() - pruned >= self.pruneInterval:
+                    prune()
+                    pruned = time.monotonic()
+
+        threading.Thread(target=tail, daemon=True).start()
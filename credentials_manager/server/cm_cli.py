@@ -1,10 +1,24 @@
 """This module contains the code for the Credentials Manager CLI application.
 CM CLI is a command line program which acts as a server-admin interface."""
+import os
+import sys
+import json
+import queue
+import argparse
+import threading
+import mysql.connector
+import connector as cn
 import credentials as cr
 import users
 import permissions as perms
+import roles
 import getpass
 import rotator
+import identities
+import importer
+import backup
+import masterkey
+import listing
 
 
 # Executable functions for different commands
@@ -18,8 +32,22 @@ def cliDeleteUser(username):
     user.deleteUser()
 
 
-def cliListUsers():
-    users.printUsers()
+def cliListUsers(*options):
+    users.printUsers(listing.parseOptions(options, ("USER",)))
+
+
+def cliEnableCertAuth(username, certfile, match="fingerprint"):
+    fingerprint, subject = identities.loadCertificate(certfile)
+    user = users.cmUser(username, None)
+    if match == "subject":
+        user.setAuthMode("certificate", subject=subject)
+    else:
+        user.setAuthMode("certificate", fingerprint=fingerprint)
+
+
+def cliDisableCertAuth(username):
+    user = users.cmUser(username, None)
+    user.setAuthMode("password")
 
 
 def cliCreatePermission(label, username):
@@ -30,8 +58,36 @@ def cliDeletePermission(label, username):
     perms.deletePermission(label, username)
 
 
-def cliListPermissions():
-    perms.printPermissions()
+def cliListPermissions(*options):
+    perms.printPermissions(listing.parseOptions(options, ("USER", "LABEL")))
+
+
+def cliCreateRole(name):
+    roles.createRole(name)
+
+
+def cliDeleteRole(name):
+    roles.deleteRole(name)
+
+
+def cliListRoles():
+    roles.printRoles()
+
+
+def cliGrantRole(name, *labels):
+    roles.grantRole(name, list(labels))
+
+
+def cliRevokeRole(name, *labels):
+    roles.revokeRole(name, list(labels))
+
+
+def cliAddMembers(name, *usernames):
+    roles.addMembers(name, list(usernames))
+
+
+def cliRemoveMembers(name, *usernames):
+    roles.removeMembers(name, list(usernames))
 
 
 def cliCreateCredentials(label, filepath):
@@ -40,13 +96,17 @@ def cliCreateCredentials(label, filepath):
     credentials.createCredentials()
 
 
+def cliImportCredentials(source):
+    importer.importCredentials(source)
+
+
 def cliDeleteCredentials(label):
     credentials = cr.Credentials(label, None)
     credentials.deleteCredentials()
 
 
-def cliListCredentials():
-    cr.printCredentials()
+def cliListCredentials(*options):
+    cr.printCredentials(listing.parseOptions(options, ("LABEL",)))
 
 
 def cliRotateCredentials(label):
@@ -59,6 +119,18 @@ def cliTestConnection(label):
         print("Connection Test failed!")
 
 
+def cliExportBackup(filepath):
+    backup.exportStore(filepath)
+
+
+def cliRestoreBackup(filepath):
+    backup.restoreStore(filepath)
+
+
+def cliRotateMasterKey(oldKey, newKey):
+    masterkey.rotateMasterKey(oldKey, newKey)
+
+
 def cliHelp():
     print(
         """
@@ -68,15 +140,28 @@ def cliHelp():
           (Example: CREATE USER myuser mypassword)
           >>CREATE USER (username, password)
           >>DELETE USER (username)
-          >>LIST USERS ()
-          >>CREATE PERMISSION (CRlabel, username)
-          >>DELETE PERMISSION (CRlabel, username)
-          >>LIST PERMISSIONS ()
+          >>LIST USERS ([USER filter] [LIMIT n] [AFTER token] [STREAM])
+          >>ENABLE CERTAUTH (username, certfile, [fingerprint|subject])
+          >>DISABLE CERTAUTH (username)
+          >>CREATE PERMISSION (CRlabel|CRprefix*, username)
+          >>DELETE PERMISSION (CRlabel|CRprefix*, username)
+          >>LIST PERMISSIONS ([USER filter] [LABEL filter] [LIMIT n] [AFTER token] [STREAM])
+          >>CREATE ROLE (role)
+          >>DELETE ROLE (role)
+          >>LIST ROLES ()
+          >>GRANT ROLE (role, CRlabel|CRprefix* ...)
+          >>REVOKE ROLE (role, CRlabel|CRprefix* ...)
+          >>ADD MEMBERS (role, username ...)
+          >>REMOVE MEMBERS (role, username ...)
           >>CREATE CREDENTIALS (CRlabel, DBconfig)
+          >>IMPORT CREDENTIALS (directory|JSONLfile|-)
           >>DELETE CREDENTIALS (CRlabel)
-          >>LIST CREDENTIALS ()
+          >>LIST CREDENTIALS ([LABEL filter] [LIMIT n] [AFTER token] [STREAM])
           >>ROTATE CREDENTIALS (CRlabel)
           >>TEST CONNECTION (CRlabel)
+          >>EXPORT BACKUP (file)
+          >>RESTORE BACKUP (file)
+          >>ROTATE MASTERKEY (oldHSMkey, newHSMkey)
           """
     )
 
@@ -86,22 +171,301 @@ COMMANDS = {
     "CREATE USER": cliCreateUser,
     "DELETE USER": cliDeleteUser,
     "LIST USERS": cliListUsers,
+    "ENABLE CERTAUTH": cliEnableCertAuth,
+    "DISABLE CERTAUTH": cliDisableCertAuth,
     "CREATE PERMISSION": cliCreatePermission,
     "DELETE PERMISSION": cliDeletePermission,
     "LIST PERMISSIONS": cliListPermissions,
+    "CREATE ROLE": cliCreateRole,
+    "DELETE ROLE": cliDeleteRole,
+    "LIST ROLES": cliListRoles,
+    "GRANT ROLE": cliGrantRole,
+    "REVOKE ROLE": cliRevokeRole,
+    "ADD MEMBERS": cliAddMembers,
+    "REMOVE MEMBERS": cliRemoveMembers,
     "CREATE CREDENTIALS": cliCreateCredentials,
+    "IMPORT CREDENTIALS": cliImportCredentials,
     "DELETE CREDENTIALS": cliDeleteCredentials,
     "LIST CREDENTIALS": cliListCredentials,
     "ROTATE CREDENTIALS": cliRotateCredentials,
     "TEST CONNECTION": cliTestConnection,
+    "EXPORT BACKUP": cliExportBackup,
+    "RESTORE BACKUP": cliRestoreBackup,
+    "ROTATE MASTERKEY": cliRotateMasterKey,
     "HELP": cliHelp,
 }
 
 
+def executeCommand(commandInput) -> bool:
+    """Executes a single command line.
+
+    Args:
+        commandInput (str): Command with its arguments, separated by spaces.
+
+    Returns:
+        bool: False if the command doesn't exist or raised an exception, else True.
+    """
+    commandParts = commandInput.split()
+
+    # Assuming commands always consist of two words
+    command = " ".join(commandParts[:2]).upper()
+    args = commandParts[2:]
+
+    if command in COMMANDS:
+        try:
+            # Try executing the command with the provided arguments
+            COMMANDS[command](*args)
+            return True
+        except TypeError as e:
+            # Handle arguments gracefully
+            print(f"Error: Incorrect number of arguments for '{command}'.")
+        except Exception as e:
+            # Handle all other exceptions
+            print(f"Error: {e}")
+    else:
+        print("Invalid command structure.")
+    return False
+
+
+class CommandOutput:
+    """Stand-in for sys.stdout in batch mode, which collects the output of the command each thread is running."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            self.stream.write(text)
+        else:
+            buffer.append(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def capture(self):
+        """Starts collecting the output of the current thread."""
+        self._local.buffer = []
+
+    def collect(self) -> str:
+        """Stops collecting the output of the current thread.
+
+        Returns:
+            str: Everything the thread has printed since capture().
+        """
+        text = "".join(self._local.buffer)
+        self._local.buffer = None
+        return text
+
+
+def runBatchCommand(number, commandInput, output) -> dict:
+    """Executes a command of a batch and collects its result.
+
+    Args:
+        number (int): Line number of the command.
+        commandInput (str): Command with its arguments.
+        output (CommandOutput): Collects the command's output.
+
+    Returns:
+        dict: Line number, command, whether it succeeded and its output.
+    """
+    connection = cn.shared()
+    errors = connection.errors if connection else 0
+    output.capture()
+    try:
+        ok = executeCommand(commandInput)
+    finally:
+        text = output.collect()
+    if connection:
+        ok = ok and connection.errors == errors
+        try:
+            connection.release()
+        except mysql.connector.Error as e:
+            ok = False
+            text += f"Error: {e}\n"
+    # Commands report failures that they handle themselves with an error message
+    ok = ok and not any(line.startswith("Error") for line in text.splitlines())
+    return {"line": number, "command": commandInput, "ok": ok, "output": text.rstrip("\n")}
+
+
+def runBatch(lines, transaction=False, parallel=1) -> bool:
+    """Executes a batch of commands over one shared DB connection and prints one JSON line per command,
+    followed by a summary line.
+
+    Consecutive commands of the same kind (e.g. many CREATE USER commands) don't depend on each other.
+    With several parallel workers, each group of such commands is spread over the workers, each with a DB connection
+    of its own, while the groups still run in order.
+
+    Args:
+        lines (iterable[str]): Command lines, empty lines and lines starting with # are skipped.
+        transaction (bool, optional): Run all commands in a single transaction, which is rolled back if
+            any command fails. Defaults to False. Commands run one at a time in this mode.
+        parallel (int, optional): Number of parallel workers. Defaults to 1.
+
+    Returns:
+        bool: True if all commands succeeded and have been committed.
+    """
+    commands = [
+        (number, line.strip()) for number, line in enumerate(lines, start=1) if line.strip() and not line.lstrip().startswith("#")
+    ]
+    stdout = sys.stdout
+    output = CommandOutput(stdout)
+
+    def emit(result):
+        stdout.write(json.dumps(result) + "\n")
+        stdout.flush()
+
+    sys.stdout = output
+    try:
+        if transaction or parallel <= 1:
+            succeeded, committed = _runSequential(commands, transaction, output, emit)
+        else:
+            succeeded, committed = _runParallel(commands, parallel, output, emit), True
+    finally:
+        sys.stdout = stdout
+
+    emit({"commands": len(commands), "succeeded": succeeded, "committed": committed})
+    return committed and succeeded == len(commands)
+
+
+def _runSequential(commands, transaction, output, emit) -> tuple:
+    """Executes commands one after another over a single shared DB connection.
+
+    Args:
+        commands (list[tuple]): Line numbers and commands.
+        transaction (bool): Run all commands in a single transaction.
+        output (CommandOutput): Collects the commands' output.
+        emit (function): Prints the result of a command.
+
+    Returns:
+        int: Number of succeeded commands.
+        bool: True if the changes have been committed.
+    """
+    succeeded = 0
+    try:
+        connection = cn.share(transaction)
+    except mysql.connector.Error as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return succeeded, False
+    try:
+        for number, commandInput in commands:
+            result = runBatchCommand(number, commandInput, output)
+            emit(result)
+            if result["ok"]:
+                succeeded += 1
+            elif transaction:
+                # The whole transaction is rolled back, the remaining commands don't need to run
+                connection.failed = True
+                break
+    finally:
+        try:
+            committed = cn.unshare()
+        except mysql.connector.Error as e:
+            print(f"Error: {e}", file=sys.stderr)
+            committed = False
+    return succeeded, committed
+
+
+def _runParallel(commands, parallel, output, emit) -> int:
+    """Executes groups of consecutive commands of the same kind in parallel, the groups one after another.
+    Every worker shares a DB connection of its own between its commands.
+
+    Args:
+        commands (list[tuple]): Line numbers and commands.
+        parallel (int): Number of parallel workers.
+        output (CommandOutput): Collects the commands' output.
+        emit (function): Prints the result of a command.
+
+    Returns:
+        int: Number of succeeded commands.
+    """
+    tasks = queue.Queue()
+    results = {}
+
+    def work():
+        try:
+            cn.share()
+        except mysql.connector.Error as e:
+            # Without a shared connection, every command opens a connection of its own
+            print(f"Error: {e}", file=sys.stderr)
+        try:
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                number, commandInput = task
+                try:
+                    results[number] = runBatchCommand(number, commandInput, output)
+                except Exception as e:
+                    results[number] = _failure(number, commandInput, e)
+                finally:
+                    tasks.task_done()
+        finally:
+            cn.unshare()
+
+    workers = [threading.Thread(target=work, daemon=True) for _ in range(parallel)]
+    for worker in workers:
+        worker.start()
+
+    def kind(commandInput):
+        return " ".join(commandInput.split()[:2]).upper()
+
+    succeeded = 0
+    start = 0
+    while start < len(commands):
+        # Group of consecutive commands of the same kind
+        end = start
+        while end < len(commands) and kind(commands[end][1]) == kind(commands[start][1]):
+            end += 1
+        for task in commands[start:end]:
+            tasks.put(task)
+        tasks.join()
+        for number, commandInput in commands[start:end]:
+            # A command whose worker died without a result has failed
+            result = results.get(number) or _failure(number, commandInput, "No result.")
+            emit(result)
+            succeeded += result["ok"]
+        start = end
+
+    for _ in workers:
+        tasks.put(None)
+    return succeeded
+
+
+def _failure(number, commandInput, error) -> dict:
+    """Returns the result of a batch command that failed without reporting a result of its own."""
+    return {"line": number, "command": commandInput, "ok": False, "output": f"Error: {error}"}
+
+
 def main():
-    """Main method of the Credentials Manager (CM) CLI."""
+    """Main method of the Credentials Manager (CM) CLI. Without arguments, the CLI is interactive.
+    With --batch, it executes the commands of a file or stdin and prints their results as JSON lines."""
+    parser = argparse.ArgumentParser(description="Credentials Manager CLI")
+    parser.add_argument("--batch", metavar="FILE", help="execute the commands in FILE ('-' for stdin) and exit")
+    parser.add_argument("--user", help="CM username, the password is read from CM_PASSWORD or prompted for")
+    parser.add_argument("--transaction", action="store_true", help="run the whole batch in a single transaction")
+    parser.add_argument("--parallel", type=int, default=1, help="number of parallel workers for the batch")
+    arguments = parser.parse_args()
+    # The username can't be prompted for on stdin if the commands are read from it
+    if arguments.batch == "-" and not arguments.user:
+        parser.error("--user is required when the batch is read from stdin")
+
+    if arguments.batch:
+        username = arguments.user or input("Please enter your username: ")
+        password = os.environ.get("CM_PASSWORD") or getpass.getpass("Please enter your password: ")
+        if not users.cmUser(username, password).authenticateUser():
+            print("Authentication failed. Exiting...", file=sys.stderr)
+            sys.exit(2)
+        if arguments.batch == "-":
+            succeeded = runBatch(sys.stdin, arguments.transaction, arguments.parallel)
+        else:
+            with open(arguments.batch, "r") as f:
+                succeeded = runBatch(f, arguments.transaction, arguments.parallel)
+        sys.exit(0 if succeeded else 1)
+
     print("Welcome to the Credentials Manager monitor. For help check out the 'help' command")
-    username = input("Please enter your username: ")
+    username = arguments.user or input("Please enter your username: ")
     password = getpass.getpass("Please enter your password: ")
     USER = users.cmUser(username, password)
 
@@ -109,27 +473,10 @@ def main():
         print("Authentication successful!")
         while True:
             commandInput = input(f"CM [{username}]>> ")
-            commandParts = commandInput.split(" ")
-
-            # Assuming commands always consist of two words
-            command = " ".join(commandParts[:2]).upper()
-            args = commandParts[2:]
-
-            if command in COMMANDS:
-                try:
-                    # Try executing the command with the provided arguments
-                    COMMANDS[command](*args)
-                except TypeError as e:
-                    # Handle arguments gracefully
-                    print(f"Error: Incorrect number of arguments for '{command}'.")
-                except Exception as e:
-                    # Handle all other exceptions
-                    print(f"Error: {e}")
-            elif commandInput.upper() == "EXIT":
+            if commandInput.upper() == "EXIT":
                 print("Exiting CM monitor...")
                 break
-            else:
-                print("Invalid command structure.")
+            executeCommand(commandInput)
     else:
         print("Authentication failed. Exiting...")
 
@@ -15,6 +15,77 @@
 /*!40101 SET @OLD_SQL_MODE=@@SQL_MODE, SQL_MODE='NO_AUTO_VALUE_ON_ZERO' */;
 /*!40111 SET @OLD_SQL_NOTES=@@SQL_NOTES, SQL_NOTES=0 */;
 
+--
+-- Table structure for table `audit_log`
+--
+
+DROP TABLE IF EXISTS `audit_log`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `audit_log` (
+  `audit_id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `created_at` timestamp(3) NOT NULL DEFAULT current_timestamp(3),
+  `username` varchar(255) NOT NULL,
+  `label` varchar(255) DEFAULT NULL,
+  `fingerprint` varchar(64) DEFAULT NULL,
+  `outcome` varchar(32) NOT NULL,
+  `latency_ms` double NOT NULL,
+  PRIMARY KEY (`audit_id`),
+  KEY `created_at` (`created_at`),
+  KEY `label` (`label`,`created_at`),
+  KEY `username` (`username`,`created_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `audit_log`
+--
+
+LOCK TABLES `audit_log` WRITE;
+/*!40000 ALTER TABLE `audit_log` DISABLE KEYS */;
+/*!40000 ALTER TABLE `audit_log` ENABLE KEYS */;
+UNLOCK TABLES;
+
+--
+-- Table structure for table `cm_changes`
+--
+
+DROP TABLE IF EXISTS `cm_changes`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `cm_changes` (
+  `change_id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `kind` varchar(32) NOT NULL,
+  `subject` varchar(255) DEFAULT NULL,
+  `created_at` timestamp NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (`change_id`),
+  KEY `created_at` (`created_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `cm_changes`
+--
+
+LOCK TABLES `cm_changes` WRITE;
+/*!40000 ALTER TABLE `cm_changes` DISABLE KEYS */;
+/*!40000 ALTER TABLE `cm_changes` ENABLE KEYS */;
+UNLOCK TABLES;
+
+--
+-- Table structure for table `cm_versions`
+--
+
+DROP TABLE IF EXISTS `cm_versions`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `cm_versions` (
+  `name` varchar(64) NOT NULL,
+  `version` bigint(20) NOT NULL DEFAULT 0,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `credentials`
 --
@@ -54,8 +125,10 @@ CREATE TABLE `data_keys` (
   `data_key` blob NOT NULL,
   `key_iv` blob NOT NULL,
   `cr_iv` blob NOT NULL,
+  `master_key` varchar(255) DEFAULT NULL,
   PRIMARY KEY (`key_id`),
   KEY `cr_id` (`cr_id`),
+  KEY `master_key` (`master_key`,`key_id`),
   CONSTRAINT `data_keys_ibfk_1` FOREIGN KEY (`cr_id`) REFERENCES `credentials` (`cr_id`) ON DELETE CASCADE
 ) ENGINE=InnoDB AUTO_INCREMENT=19 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;
@@ -66,10 +139,61 @@ CREATE TABLE `data_keys` (
 
 LOCK TABLES `data_keys` WRITE;
 /*!40000 ALTER TABLE `data_keys` DISABLE KEYS */;
-INSERT INTO `data_keys` VALUES (18,26,'?mY\H+\l\\N#\Z;A*\\\_P\\MAt\hͼ','m\[/MIy,u','L۞\G^n\');
+INSERT INTO `data_keys` VALUES (18,26,'?mY\H+\l\\N#\Z;A*\\\_P\\MAt\hͼ','m\[/MIy,u','L۞\G^n\',NULL);
 /*!40000 ALTER TABLE `data_keys` ENABLE KEYS */;
 UNLOCK TABLES;
 
+--
+-- Table structure for table `label_stats`
+--
+
+DROP TABLE IF EXISTS `label_stats`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `label_stats` (
+  `label` varchar(255) NOT NULL,
+  `accesses` bigint(20) NOT NULL DEFAULT 0,
+  `last_access` timestamp NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (`label`),
+  KEY `accesses` (`accesses`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `label_stats`
+--
+
+LOCK TABLES `label_stats` WRITE;
+/*!40000 ALTER TABLE `label_stats` DISABLE KEYS */;
+/*!40000 ALTER TABLE `label_stats` ENABLE KEYS */;
+UNLOCK TABLES;
+
+--
+-- Table structure for table `permission_patterns`
+--
+
+DROP TABLE IF EXISTS `permission_patterns`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `permission_patterns` (
+  `pattern_id` int(11) NOT NULL AUTO_INCREMENT,
+  `uid` int(11) NOT NULL,
+  `pattern` varchar(255) NOT NULL,
+  PRIMARY KEY (`pattern_id`),
+  UNIQUE KEY `uid` (`uid`,`pattern`),
+  CONSTRAINT `permission_patterns_ibfk_1` FOREIGN KEY (`uid`) REFERENCES `users` (`uid`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `permission_patterns`
+--
+
+LOCK TABLES `permission_patterns` WRITE;
+/*!40000 ALTER TABLE `permission_patterns` DISABLE KEYS */;
+/*!40000 ALTER TABLE `permission_patterns` ENABLE KEYS */;
+UNLOCK TABLES;
+
 --
 -- Table structure for table `permissions`
 --
@@ -99,6 +223,82 @@ INSERT INTO `permissions` VALUES (8,11,26);
 /*!40000 ALTER TABLE `permissions` ENABLE KEYS */;
 UNLOCK TABLES;
 
+--
+-- Table structure for table `role_grants`
+--
+
+DROP TABLE IF EXISTS `role_grants`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `role_grants` (
+  `grant_id` int(11) NOT NULL AUTO_INCREMENT,
+  `role_id` int(11) NOT NULL,
+  `label` varchar(255) NOT NULL,
+  PRIMARY KEY (`grant_id`),
+  UNIQUE KEY `role_id` (`role_id`,`label`),
+  CONSTRAINT `role_grants_ibfk_1` FOREIGN KEY (`role_id`) REFERENCES `roles` (`role_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `role_grants`
+--
+
+LOCK TABLES `role_grants` WRITE;
+/*!40000 ALTER TABLE `role_grants` DISABLE KEYS */;
+/*!40000 ALTER TABLE `role_grants` ENABLE KEYS */;
+UNLOCK TABLES;
+
+--
+-- Table structure for table `role_members`
+--
+
+DROP TABLE IF EXISTS `role_members`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `role_members` (
+  `role_id` int(11) NOT NULL,
+  `uid` int(11) NOT NULL,
+  PRIMARY KEY (`role_id`,`uid`),
+  KEY `uid` (`uid`),
+  CONSTRAINT `role_members_ibfk_1` FOREIGN KEY (`role_id`) REFERENCES `roles` (`role_id`) ON DELETE CASCADE,
+  CONSTRAINT `role_members_ibfk_2` FOREIGN KEY (`uid`) REFERENCES `users` (`uid`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `role_members`
+--
+
+LOCK TABLES `role_members` WRITE;
+/*!40000 ALTER TABLE `role_members` DISABLE KEYS */;
+/*!40000 ALTER TABLE `role_members` ENABLE KEYS */;
+UNLOCK TABLES;
+
+--
+-- Table structure for table `roles`
+--
+
+DROP TABLE IF EXISTS `roles`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `roles` (
+  `role_id` int(11) NOT NULL AUTO_INCREMENT,
+  `name` varchar(255) NOT NULL,
+  PRIMARY KEY (`role_id`),
+  UNIQUE KEY `name` (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Dumping data for table `roles`
+--
+
+LOCK TABLES `roles` WRITE;
+/*!40000 ALTER TABLE `roles` DISABLE KEYS */;
+/*!40000 ALTER TABLE `roles` ENABLE KEYS */;
+UNLOCK TABLES;
+
 --
 -- Table structure for table `users`
 --
@@ -111,8 +311,12 @@ CREATE TABLE `users` (
   `username` varchar(255) NOT NULL,
   `password` blob NOT NULL,
   `salt` blob NOT NULL,
+  `auth_mode` enum('password','certificate') NOT NULL DEFAULT 'password',
+  `cert_fingerprint` char(64) DEFAULT NULL,
+  `cert_subject` varchar(1024) DEFAULT NULL,
   PRIMARY KEY (`uid`),
-  UNIQUE KEY `username` (`username`)
+  UNIQUE KEY `username` (`username`),
+  UNIQUE KEY `cert_fingerprint` (`cert_fingerprint`)
 ) ENGINE=InnoDB AUTO_INCREMENT=12 DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
@@ -122,7 +326,7 @@ CREATE TABLE `users` (
 
 LOCK TABLES `users` WRITE;
 /*!40000 ALTER TABLE `users` DISABLE KEYS */;
-INSERT INTO `users` VALUES (5,'cmAdmin','$2b$12$ujuc5Uue6vGzr.MBznv5cOWJnfcqGdKVzrsxHl7ezyZCFXefABhcG','$2b$12$ujuc5Uue6vGzr.MBznv5cO'),(11,'webapp','$2b$12$7VkLT6pCiIAgGXVE5s8RguXzrQyB2zjPv7/lg/cHA.m0Qw94XJRby','$2b$12$7VkLT6pCiIAgGXVE5s8Rgu');
+INSERT INTO `users` VALUES (5,'cmAdmin','$2b$12$ujuc5Uue6vGzr.MBznv5cOWJnfcqGdKVzrsxHl7ezyZCFXefABhcG','$2b$12$ujuc5Uue6vGzr.MBznv5cO','password',NULL,NULL),(11,'webapp','$2b$12$7VkLT6pCiIAgGXVE5s8RguXzrQyB2zjPv7/lg/cHA.m0Qw94XJRby','$2b$12$7VkLT6pCiIAgGXVE5s8Rgu','password',NULL,NULL);
 /*!40000 ALTER TABLE `users` ENABLE KEYS */;
 UNLOCK TABLES;
 /*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
@@ -0,0 +1,92 @@
+-- Schema migrations for existing Credentials Manager databases.
+-- New installations import cm_db.sql, which already contains all of these changes.
+-- Apply the statements below every migration you haven't applied yet, in order:
+--   mysql -u username -p credentials_manager < cm_db_migrations.sql
+
+-- Certificate auth mode (users in "certificate" mode authenticate by their client certificate)
+CREATE TABLE IF NOT EXISTS `cm_versions` (
+  `name` varchar(64) NOT NULL,
+  `version` bigint(20) NOT NULL DEFAULT 0,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+ALTER TABLE `users`
+  ADD COLUMN `auth_mode` enum('password','certificate') NOT NULL DEFAULT 'password',
+  ADD COLUMN `cert_fingerprint` char(64) DEFAULT NULL,
+  ADD COLUMN `cert_subject` varchar(1024) DEFAULT NULL,
+  ADD UNIQUE KEY `cert_fingerprint` (`cert_fingerprint`);
+
+-- Prefix permissions (grants on all labels starting with a prefix, e.g. billing/*)
+CREATE TABLE IF NOT EXISTS `permission_patterns` (
+  `pattern_id` int(11) NOT NULL AUTO_INCREMENT,
+  `uid` int(11) NOT NULL,
+  `pattern` varchar(255) NOT NULL,
+  PRIMARY KEY (`pattern_id`),
+  UNIQUE KEY `uid` (`uid`,`pattern`),
+  CONSTRAINT `permission_patterns_ibfk_1` FOREIGN KEY (`uid`) REFERENCES `users` (`uid`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- Roles (users that are members of a role get all of its grants)
+CREATE TABLE IF NOT EXISTS `roles` (
+  `role_id` int(11) NOT NULL AUTO_INCREMENT,
+  `name` varchar(255) NOT NULL,
+  PRIMARY KEY (`role_id`),
+  UNIQUE KEY `name` (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+CREATE TABLE IF NOT EXISTS `role_grants` (
+  `grant_id` int(11) NOT NULL AUTO_INCREMENT,
+  `role_id` int(11) NOT NULL,
+  `label` varchar(255) NOT NULL,
+  PRIMARY KEY (`grant_id`),
+  UNIQUE KEY `role_id` (`role_id`,`label`),
+  CONSTRAINT `role_grants_ibfk_1` FOREIGN KEY (`role_id`) REFERENCES `roles` (`role_id`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+CREATE TABLE IF NOT EXISTS `role_members` (
+  `role_id` int(11) NOT NULL,
+  `uid` int(11) NOT NULL,
+  PRIMARY KEY (`role_id`,`uid`),
+  KEY `uid` (`uid`),
+  CONSTRAINT `role_members_ibfk_1` FOREIGN KEY (`role_id`) REFERENCES `roles` (`role_id`) ON DELETE CASCADE,
+  CONSTRAINT `role_members_ibfk_2` FOREIGN KEY (`uid`) REFERENCES `users` (`uid`) ON DELETE CASCADE
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- Change log (CM servers tail it to invalidate their caches)
+CREATE TABLE IF NOT EXISTS `cm_changes` (
+  `change_id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `kind` varchar(32) NOT NULL,
+  `subject` varchar(255) DEFAULT NULL,
+  `created_at` timestamp NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (`change_id`),
+  KEY `created_at` (`created_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- Access statistics per label (used to prewarm the caches at startup)
+CREATE TABLE IF NOT EXISTS `label_stats` (
+  `label` varchar(255) NOT NULL,
+  `accesses` bigint(20) NOT NULL DEFAULT 0,
+  `last_access` timestamp NOT NULL DEFAULT current_timestamp(),
+  PRIMARY KEY (`label`),
+  KEY `accesses` (`accesses`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- Audit log of credential access
+CREATE TABLE IF NOT EXISTS `audit_log` (
+  `audit_id` bigint(20) NOT NULL AUTO_INCREMENT,
+  `created_at` timestamp(3) NOT NULL DEFAULT current_timestamp(3),
+  `username` varchar(255) NOT NULL,
+  `label` varchar(255) DEFAULT NULL,
+  `fingerprint` varchar(64) DEFAULT NULL,
+  `outcome` varchar(32) NOT NULL,
+  `latency_ms` double NOT NULL,
+  PRIMARY KEY (`audit_id`),
+  KEY `created_at` (`created_at`),
+  KEY `label` (`label`,`created_at`),
+  KEY `username` (`username`,`created_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_general_ci;
+
+-- Master key per data key (set by ROTATE MASTERKEY, NULL means the root key in hsm_config.json)
+ALTER TABLE `data_keys`
+  ADD COLUMN `master_key` varchar(255) DEFAULT NULL,
+  ADD KEY `master_key` (`master_key`,`key_id`);
@@ -1,5 +1,12 @@
 from jsonschema import validate, ValidationError
 import json
+import struct
+
+# Every message is sent as a frame: its length as a 4 byte unsigned big-endian integer, followed by the message
+FRAMEHEADER = struct.Struct("!I")
+
+# Largest message a frame may carry, in bytes
+MAXFRAME = 1024 * 1024
 
 # Schema which specifies the CM protocol structure used for client/server communication.
 PROTOCOLSCHEMA = {
@@ -8,11 +15,16 @@ PROTOCOLSCHEMA = {
         "header": {
             "type": "object",
             "properties": {
-                "cmUser": {"type": "string"},
+                # Usernames are stored in varchar(255) columns
+                "cmUser": {"type": "string", "maxLength": 255},
                 "cmPassword": {"type": "string"},
+                "cmToken": {"type": "string"},
                 "cmRequest": {"type": "string"},
+                # Seconds the client is still waiting for an answer
+                "cmDeadline": {"type": "number", "minimum": 0},
             },
-            "required": ["cmUser", "cmPassword", "cmRequest"],
+            # Clients authenticate with their password, a session token or their certificate
+            "required": ["cmUser", "cmRequest"],
         },
         "payload": {
             "type": "object",
@@ -38,4 +50,59 @@ def validatePacket(packet : str) -> bool:
         validate(instance=packet, schema=PROTOCOLSCHEMA)
         return True
     except ValidationError:
-        return False
\ No newline at end of file
+        return False
+
+
+def sendFrame(sock, message: bytes):
+    """Sends a message as a single frame.
+
+    Args:
+        sock (socket): Connected socket.
+        message (bytes): Message to send.
+    """
+    sock.sendall(FRAMEHEADER.pack(len(message)) + message)
+
+
+def recvFrame(sock) -> bytes:
+    """Reads exactly one frame from a socket, so that nothing of the next message is consumed.
+
+    Args:
+        sock (socket): Connected socket.
+
+    Returns:
+        bytes: The message, or None if the peer has closed the connection before a new frame.
+
+    Raises:
+        FramingError: The connection was closed in the middle of a frame, or the frame is too large.
+    """
+    header = _recvExactly(sock, FRAMEHEADER.size)
+    if header is None:
+        return None
+    (length,) = FRAMEHEADER.unpack(header)
+    if length > MAXFRAME:
+        raise FramingError(f"Frame of {length} bytes exceeds the limit of {MAXFRAME} bytes.")
+    message = _recvExactly(sock, length)
+    if message is None:
+        raise FramingError("Connection closed in the middle of a frame.")
+    return message
+
+
+def _recvExactly(sock, size: int) -> bytes:
+    """Reads exactly size bytes. Returns None if the connection is closed before the first byte."""
+    chunks = []
+    received = 0
+    while received < size:
+        chunk = sock.recv(min(size - received, 16384))
+        if not chunk:
+            if received:
+                raise FramingError("Connection closed in the middle of a frame.")
+            return None
+        chunks.append(chunk)
+        received += len(chunk)
+    return b"".join(chunks)
+
+
+class FramingError(Exception):
+    """Exception raised if a frame is incomplete or malformed."""
+
+    pass
\ No newline at end of file
@@ -1,10 +1,14 @@
+import time
 import credentials as cr
 import users
 import permissions as perms
+import stats
+import audit
 
 # Executable functions for different requests
 def getCr(user : users.cmUser, label : str):
     if perms.verifyPermission(user.cmUsername, label):
+        stats.STATS.record(label)
         credentials = cr.fetchCredentials(label)
         return credentials
 
@@ -15,12 +19,15 @@ REQUESTS = {
 }
 
 
-def requestHandler(packet):
+def requestHandler(packet, username, fingerprint=None, start=None):
     """Handles incoming CM packets depending on their request type
-    and executes the corresponding functions.
+    and executes the corresponding functions. Every request is added to the audit log.
 
     Args:
-        packet (_type_): _description_
+        packet (dict): CM packet of an authenticated client.
+        username (str): The client's authenticated username.
+        fingerprint (str, optional): Fingerprint of the client's certificate, for the audit log.
+        start (float, optional): time.monotonic() at which the packet was received, for the audit log.
 
     Raises:
         PacketError: _description_
@@ -34,20 +41,28 @@ def requestHandler(packet):
     header = packet["header"]
     payload = packet["payload"]
 
-    user = users.cmUser(cmUsername=header["cmUser"], cmPassword=header["cmPassword"])
+    # The client has already been authenticated, by password or session token
+    user = users.cmUser(cmUsername=username, cmPassword=None)
     requestType = header["cmRequest"]
     args = list(payload["args"].values())
 
     if requestType in REQUESTS:
+        start = time.monotonic() if start is None else start
+        label = args[0] if args else None
+        outcome = audit.ERROR
         try:
             # Try executing the request with the provided arguments
-            return REQUESTS[requestType](user, *args)
+            result = REQUESTS[requestType](user, *args)
+            outcome = audit.DENIED if result is None else audit.GRANTED
+            return result
         except TypeError as e:
             # Handle arguments gracefully
             raise PacketError(f"Error: Incorrect number of arguments for '{requestType}'. {e}")
         except Exception as e:
             # Handle all other exceptions
             raise PacketError(f"Error: {e}")
+        finally:
+            audit.LOG.record(username, label, fingerprint, outcome, time.monotonic() - start)
     else:
         raise PacketError("Error: Invalid packet structure.")
 
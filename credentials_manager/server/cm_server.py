@@ -1,9 +1,29 @@
+import atexit
+import signal
+import sys
 import socket
+import selectors
 import ssl
 import json
+import time
+import queue
+import threading
+from collections import OrderedDict
 import cm_protocol
+import connector as cn
 import users
 import cm_requests
+import sessions
+import identities
+import permissions
+import hashing
+import admission
+import metrics
+import changes
+import keys
+import stats
+import snapshot
+import audit
 
 
 # Server settings & certificates for TLS
@@ -15,76 +35,578 @@ with open("config/server_config.json", "r") as f:
     serverCert = config["server_cert"]
     serverKey = config["server_key"]
     caCert = config["ca_cert"]
+    sessionKeyFile = config.get("session_key_file", "config/session.key")
+    sessionTtl = config.get("session_ttl", 300)
+    hashingWorkers = config.get("hashing_workers")
+    hashingQueue = config.get("hashing_queue")
+    workers = config.get("workers", 32)
+    acceptQueue = config.get("accept_queue", 64)
+    ratePerCertificate = config.get("rate_per_certificate", 50)
+    ratePerUser = config.get("rate_per_user", 50)
+    rateBurst = config.get("rate_burst", 100)
+    handshakeTimeout = config.get("handshake_timeout", 5)
+    readTimeout = config.get("read_timeout", 5)
+    idleTimeout = config.get("idle_timeout", 60)
+    maxIdlePerClient = config.get("max_idle_per_client", 8)
+    maxIdleConnections = config.get("max_idle_connections", 1024)
+    connectionLifetime = config.get("connection_lifetime", 300)
+    requestTimeout = config.get("request_timeout", 30)
+    metricsInterval = config.get("metrics_interval", 60)
+    changePollInterval = config.get("change_poll_interval", 1)
+    prewarmLabels = config.get("prewarm_labels", 100)
+    statsInterval = config.get("stats_interval", 60)
+    cacheSnapshotFile = config.get("cache_snapshot_file")
+    cacheSnapshotTtl = config.get("cache_snapshot_ttl", 600)
+    auditFile = config.get("audit_file")
+    auditQueue = config.get("audit_queue", 10000)
+    auditBatch = config.get("audit_batch", 500)
+
+# Session tokens, so that clients only need to verify their password once
+SESSIONS = sessions.SessionManager(sessions.loadKey(sessionKeyFile), sessionTtl)
+
+# Users that are authenticated by their client certificate
+IDENTITIES = identities.IdentityMap()
+
+# Rate limits & failed authentication backoff, checked before clients are authenticated
+ADMISSION = admission.AdmissionControl(
+    certRate=ratePerCertificate, userRate=ratePerUser, burst=rateBurst
+)
+
+# Change log of the CM database, invalidates the caches of this server when another process changes their data
+CHANGES = changes.ChangeFeed(changePollInterval)
+
+# Answer for clients that can't be served right now
+OVERLOADED = "503 : Server overloaded. Retry after 1.00 seconds."
+
+# Answer for requests whose deadline has passed before they were executed
+DEADLINEEXCEEDED = "504 : Deadline exceeded."
+
+
+def createServerContext():
+    """Creates the TLS context used for all client connections.
+
+    Returns:
+        SSLContext: Server side TLS context which requires client certificates.
+    """
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_verify_locations(caCert)
+    context.load_cert_chain(certfile=serverCert, keyfile=serverKey)
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.minimum_version = ssl.TLSVersion.TLSv1_3
+    return context
+
+
+def authenticate(header: dict, fingerprint: str, subject: str):
+    """Authenticates the client of a packet by its session token, its certificate (for users in
+    certificate auth mode) or its password.
+
+    Args:
+        header (dict): Packet header.
+        fingerprint (str): Fingerprint of the client's certificate.
+        subject (str): Subject of the client's certificate.
+
+    Returns:
+        str: The authenticated username, or None if authentication failed.
+        str: The authentication method ("token", "certificate" or "password").
+        bool: True if authentication failed only because the client's session token has expired or been revoked.
+    """
+    if "cmToken" in header:
+        username, stale = SESSIONS.checkToken(header["cmToken"], fingerprint)
+        if username is not None and username != header["cmUser"]:
+            return None, "token", False
+        return username, "token", stale
+
+    if IDENTITIES.lookup(fingerprint, subject) == header["cmUser"]:
+        return header["cmUser"], "certificate", False
+
+    if "cmPassword" not in header:
+        return None, "password", False
+    user = users.cmUser(cmUsername=header["cmUser"], cmPassword=header["cmPassword"])
+    return (user.cmUsername if user.authenticateUser() else None), "password", False
+
+
+def expired(deadline: float) -> bool:
+    """Checks if a request's deadline has passed. Counts the request if so.
+
+    Args:
+        deadline (float): time.monotonic() by which the request must be answered, or None.
+
+    Returns:
+        bool: True if the deadline has passed, else False.
+    """
+    if deadline is None or time.monotonic() < deadline:
+        return False
+    metrics.COUNTERS.increment("deadline_exceeded")
+    print("Request deadline exceeded!")
+    return True
+
+
+def rateLimited(username: str, label: str, fingerprint: str, start: float, wait: float) -> str:
+    """Counts and audits a rate limited packet.
+
+    Args:
+        username (str): Username of the client.
+        label (str): Requested credentials label, or None.
+        fingerprint (str): Fingerprint of the client's certificate.
+        start (float): time.monotonic() at which the packet was received.
+        wait (float): Seconds the client should wait before retrying.
+
+    Returns:
+        str: The response that is sent back to the client.
+    """
+    metrics.COUNTERS.increment("rate_limited")
+    audit.LOG.record(username, label, fingerprint, audit.RATE_LIMITED, time.monotonic() - start)
+    print("Client rate limited!")
+    return f"429 : Too many requests. Retry after {wait:.2f} seconds."
+
+
+def handlePacket(packet: str, fingerprint: str, subject: str, deadline: float = None) -> str:
+    """Validates, authenticates and executes a single CM packet. Work is stopped as soon as the
+    request's deadline has passed, or the client's own deadline (cmDeadline, in seconds) if it is earlier.
+
+    Args:
+        packet (str): Raw CM packet received from the client.
+        fingerprint (str): Fingerprint of the client's certificate.
+        subject (str): Subject of the client's certificate.
+        deadline (float, optional): time.monotonic() by which the request must be answered.
+
+    Returns:
+        str: The response that is sent back to the client.
+    """
+    start = time.monotonic()
+    # Validate packet structure against PROTOCOLSCHEMA
+    if not cm_protocol.validatePacket(packet):
+        return "400 : Invalid packet structure."
+    print("Packet validity OK!")
+
+    packet = json.loads(packet)
+    header = packet["header"]
+    label = packet["payload"]["args"].get("label")
+
+    # The client won't use an answer it receives after its own deadline
+    if "cmDeadline" in header:
+        clientDeadline = time.monotonic() + max(0, header["cmDeadline"])
+        deadline = clientDeadline if deadline is None else min(deadline, clientDeadline)
+    if expired(deadline):
+        return DEADLINEEXCEEDED
+
+    # Admission control, turns away clients that send too many or failing packets before they cost a bcrypt hash
+    wait = ADMISSION.admit(fingerprint, header["cmUser"])
+    if wait:
+        return rateLimited(header["cmUser"], label, fingerprint, start, wait)
+
+    # Client authentication
+    try:
+        with cn.deadline(deadline):
+            username, method, stale = authenticate(header, fingerprint, subject)
+    except hashing.HashingBusy:
+        metrics.COUNTERS.increment("hashing_busy")
+        print("Password hashing queue is full!")
+        return OVERLOADED
+    # A client whose deadline ran out during authentication hasn't failed it
+    if username is None and expired(deadline):
+        return DEADLINEEXCEEDED
+    # An expired or revoked token is renewed by the client right away, that must not be delayed by a backoff
+    if not stale:
+        ADMISSION.recordAuthentication(fingerprint, header["cmUser"], username is not None)
+
+    if not username:
+        audit.LOG.record(header["cmUser"], label, fingerprint, audit.AUTH_FAILED, time.monotonic() - start)
+        print("Client authentication failed!")
+        return "400 : Client authentication failed."
+    print(f"Client authentication successful ({method})!")
+
+    # The user's own rate limit, only charged once the client has proven to be that user
+    wait = ADMISSION.admitUser(username)
+    if wait:
+        return rateLimited(username, label, fingerprint, start, wait)
+    if expired(deadline):
+        return DEADLINEEXCEEDED
+
+    # AUTH exchanges a verified password or certificate for a session token
+    if header["cmRequest"] == "AUTH":
+        if method == "token":
+            return "400 : Client authentication failed."
+        token = SESSIONS.issueToken(username, fingerprint)
+        return json.dumps({"token": token, "expires_in": SESSIONS.ttl})
+
+    # Handle request based on request type, database and HSM work is bounded by the deadline
+    try:
+        with cn.deadline(deadline):
+            result = cm_requests.requestHandler(packet, username, fingerprint, start)
+    except cm_requests.PacketError as e:
+        # The client's request can't be executed, that's no reason to drop its connection
+        print(e)
+        if expired(deadline):
+            return DEADLINEEXCEEDED
+        return f"400 : {str(e).replace('Error: ', '', 1)}"
+    if expired(deadline):
+        return DEADLINEEXCEEDED
+    return json.dumps(result)
+
+
+def evict(clientAddress, reason: str):
+    """Counts and logs a connection that is closed because its client was too slow.
+
+    Args:
+        clientAddress (tuple): Address of the client.
+        reason (str): Name of the eviction counter.
+    """
+    total = metrics.COUNTERS.increment(reason)
+    print(f"Evicted {clientAddress}: {reason} ({total} in total)")
+
+
+class ClientConnection:
+    """An authenticated TLS connection of a client, kept open between its packets."""
+
+    def __init__(self, sslSocket, address, fingerprint: str, subject: str):
+        """Constructor for ClientConnection objects.
+
+        Args:
+            sslSocket (SSLSocket): Connection after the TLS handshake.
+            address (tuple): Address of the client.
+            fingerprint (str): Fingerprint of the client's certificate.
+            subject (str): Subject of the client's certificate.
+        """
+        self.sslSocket = sslSocket
+        self.address = address
+        self.fingerprint = fingerprint
+        self.subject = subject
+        self.opened = self.idleSince = time.monotonic()
+
+    def close(self):
+        """Closes the connection."""
+        try:
+            self.sslSocket.close()
+        except OSError:
+            pass
+        print(f"Connection to {self.address} closed.")
+
+
+class ConnectionPoller:
+    """Watches the idle connections of all clients, so that a connection only occupies a worker while one of its
+    packets is being handled. A connection becomes ready (and is handed to the workers) as soon as its client has
+    sent data. Connections that stay idle for idleTimeout seconds are closed, and so are the least recently used
+    ones of clients (by certificate) that keep more than maxPerClient connections open."""
+
+    def __init__(self, ready: queue.Queue, idleTimeout: float = 60, maxPerClient: int = 8, maxIdle: int = 1024):
+        """Constructor for ConnectionPoller objects.
+
+        Args:
+            ready (Queue): Queue of the workers, ready connections are put into it.
+            idleTimeout (float, optional): Seconds a connection may stay idle. Defaults to 60.
+            maxPerClient (int, optional): Maximum number of idle connections per client certificate. Defaults to 8.
+            maxIdle (int, optional): Maximum number of idle connections in total. Defaults to 1024.
+        """
+        self.ready = ready
+        self.idleTimeout = idleTimeout
+        self.maxPerClient = maxPerClient
+        self.maxIdle = maxIdle
+        self._selector = selectors.DefaultSelector()
+        self._parked = queue.Queue()
+        # Idle connections, least recently used first, in total and by client certificate
+        self._idle = OrderedDict()
+        self._byClient = {}
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._waker.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ, None)
+
+    def park(self, connection: ClientConnection):
+        """Hands a connection whose packet has been answered back to the poller. Called by the workers.
+
+        Args:
+            connection (ClientConnection): Idle connection.
+        """
+        # Data that TLS has already read from the socket doesn't make it readable again
+        if connection.sslSocket.pending():
+            self.ready.put(connection)
+            return
+        connection.idleSince = time.monotonic()
+        self._parked.put(connection)
+        try:
+            self._waker.send(b"\0")
+        except BlockingIOError:
+            # The poller is going to wake up anyway
+            pass
+
+    def start(self):
+        """Starts watching the idle connections in a background thread."""
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            for key, _ in self._selector.select(timeout=1):
+                if key.data is None:
+                    try:
+                        while self._wakeup.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                self._remove(key.data)
+                self.ready.put(key.data)
+            while True:
+                try:
+                    self._add(self._parked.get_nowait())
+                except queue.Empty:
+                    break
+            self._closeIdle()
+
+    def _add(self, connection: ClientConnection):
+        try:
+            self._selector.register(connection.sslSocket, selectors.EVENT_READ, connection)
+        except (ValueError, OSError):
+            # The socket has been closed in the meantime
+            connection.close()
+            return
+        self._idle[connection] = True
+        clientConnections = self._byClient.setdefault(connection.fingerprint, OrderedDict())
+        clientConnections[connection] = True
+        if len(clientConnections) > self.maxPerClient:
+            self._evict(next(iter(clientConnections)), "idle_evictions")
+        if len(self._idle) > self.maxIdle:
+            self._evict(next(iter(self._idle)), "idle_evictions")
+
+    def _remove(self, connection: ClientConnection):
+        self._selector.unregister(connection.sslSocket)
+        self._idle.pop(connection, None)
+        clientConnections = self._byClient.get(connection.fingerprint)
+        if clientConnections is not None:
+            clientConnections.pop(connection, None)
+            if not clientConnections:
+                del self._byClient[connection.fingerprint]
+
+    def _evict(self, connection: ClientConnection, reason: str):
+        self._remove(connection)
+        evict(connection.address, reason)
+        connection.close()
+
+    def _closeIdle(self):
+        now = time.monotonic()
+        while self._idle:
+            connection = next(iter(self._idle))
+            if now - connection.idleSince < self.idleTimeout:
+                break
+            self._evict(connection, "idle_timeouts")
+
+
+def acceptConnection(context, clientSocket, clientAddress) -> ClientConnection:
+    """Completes the TLS handshake of an accepted connection. Clients that stall during the handshake are evicted.
+
+    Args:
+        context (SSLContext): Server side TLS context.
+        clientSocket (socket): Accepted client socket.
+        clientAddress (tuple): Address of the client.
+
+    Returns:
+        ClientConnection: The connection, or None if the handshake failed.
+    """
+    sslClientSocket = None
+    try:
+        # Wrap the socket with TLS, the handshake must be completed within handshakeTimeout
+        clientSocket.settimeout(handshakeTimeout)
+        sslClientSocket = context.wrap_socket(
+            clientSocket, server_side=True, do_handshake_on_connect=False
+        )
+        sslClientSocket.do_handshake()
+        fingerprint = sessions.certificateFingerprint(sslClientSocket)
+        subject = identities.certificateSubject(sslClientSocket.getpeercert(binary_form=True))
+        return ClientConnection(sslClientSocket, clientAddress, fingerprint, subject)
+    except socket.timeout:
+        evict(clientAddress, "handshake_timeouts")
+    except Exception as e:
+        print(f"Error: {e}")
+    (sslClientSocket or clientSocket).close()
+    print(f"Connection to {clientAddress} closed.")
+    return None
+
+
+def handleConnection(connection: ClientConnection, poller: ConnectionPoller):
+    """Serves one packet of a connection whose client has sent data, then hands the connection back to the poller,
+    so that long-running clients (e.g. the CM agent) can send several packets over the same authenticated
+    TLS connection without occupying a worker in between. Short-lived clients simply close the connection after
+    their first answer. Clients that stall while sending a packet or while receiving an answer are evicted,
+    and connections older than connectionLifetime are closed after their answer.
+
+    Args:
+        connection (ClientConnection): Connection with data to read.
+        poller (ConnectionPoller): Poller the connection is handed back to.
+    """
+    sslClientSocket = connection.sslSocket
+    clientAddress = connection.address
+    try:
+        sslClientSocket.settimeout(readTimeout)
+        try:
+            data = cm_protocol.recvFrame(sslClientSocket)
+        except socket.timeout:
+            evict(clientAddress, "read_timeouts")
+            connection.close()
+            return
+        except cm_protocol.FramingError as e:
+            # Without a complete frame, the next message can't be found, the connection can't be used anymore
+            print(f"Error: {e}")
+            connection.close()
+            return
+        if data is None:
+            connection.close()
+            return
+        print(f"Received packet from {clientAddress}")
+        deadline = time.monotonic() + requestTimeout
+        response = handlePacket(data.decode(), connection.fingerprint, connection.subject, deadline)
+        try:
+            cm_protocol.sendFrame(sslClientSocket, response.encode())
+        except socket.timeout:
+            evict(clientAddress, "write_timeouts")
+            connection.close()
+            return
+        print(f"Sent answer to {clientAddress}")
+    except Exception as e:
+        print(f"Error: {e}")
+        connection.close()
+        return
+    # Clients reconnect from time to time, so that no connection lives forever
+    if time.monotonic() - connection.opened > connectionLifetime:
+        evict(clientAddress, "lifetime_closes")
+        connection.close()
+        return
+    poller.park(connection)
+
+
+def rejectConnection(context, clientSocket, rejections):
+    """Answers a connection that can't be served right now with an overloaded status code.
+
+    Args:
+        context (SSLContext): Server side TLS context.
+        clientSocket (socket): Accepted client socket.
+        rejections (BoundedSemaphore): Semaphore limiting the number of concurrent rejections, released when done.
+    """
+    metrics.COUNTERS.increment("rejected_connections")
+    sslClientSocket = None
+    try:
+        clientSocket.settimeout(2)
+        sslClientSocket = context.wrap_socket(clientSocket, server_side=True)
+        # Read the client's packet first, so that closing the connection doesn't reset it
+        cm_protocol.recvFrame(sslClientSocket)
+        cm_protocol.sendFrame(sslClientSocket, OVERLOADED.encode())
+    except Exception:
+        pass
+    finally:
+        (sslClientSocket or clientSocket).close()
+        rejections.release()
+
+
+def worker(context, connections, poller):
+    """Completes the handshakes of accepted connections and serves the packets of ready connections, one at a time.
+
+    Args:
+        context (SSLContext): Server side TLS context.
+        connections (Queue): Accepted connections (socket, address) and ready ClientConnections.
+        poller (ConnectionPoller): Poller that watches the idle connections.
+    """
+    while True:
+        item = connections.get()
+        if isinstance(item, ClientConnection):
+            handleConnection(item, poller)
+            continue
+        connection = acceptConnection(context, *item)
+        if connection is not None:
+            poller.park(connection)
+
+
+def warmUp():
+    """Loads the server's caches before it accepts traffic: the certificate identities, the permission index
+    and the data keys of the most requested labels (restored from the cache snapshot of the previous run, the others
+    decrypted in a single HSM session). Reports how long it took."""
+    start = time.monotonic()
+    IDENTITIES.load()
+    permissions.INDEX.load()
+    indexesLoaded = time.monotonic()
+
+    restoredKeys = 0
+    if cacheSnapshotFile:
+        try:
+            restoredKeys = snapshot.restore(cacheSnapshotFile)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+    try:
+        warmedKeys = keys.prewarm(stats.topLabels(prewarmLabels))
+    except keys.HsmError as e:
+        print(f"Error: {e}")
+        warmedKeys = 0
+    done = time.monotonic()
+    print(
+        f"Warm-up took {done - start:.2f}s (indexes {indexesLoaded - start:.2f}s, "
+        f"{restoredKeys} data keys restored and {warmedKeys} decrypted {done - indexesLoaded:.2f}s)."
+    )
+
+
+def writeSnapshot():
+    """Writes the data key cache to the cache snapshot file, if configured. Called at shutdown."""
+    if not cacheSnapshotFile:
+        return
+    try:
+        print(f"Wrote {snapshot.write(cacheSnapshotFile, cacheSnapshotTtl)} data keys to the cache snapshot.")
+    except (OSError, keys.HsmError) as e:
+        print(f"Error: {e}")
 
 
 def main():
     """The Credentials Manager Server's main function."""
+    context = createServerContext()
+    audit.LOG = audit.AuditLog(maxQueue=auditQueue, batchSize=auditBatch, path=auditFile)
+    audit.LOG.start()
+    atexit.register(audit.LOG.flush)
+    warmUp()
+    hashing.start(hashingWorkers, hashingQueue)
+    metrics.startReporter(metricsInterval)
+    stats.STATS.start(statsInterval)
+    atexit.register(stats.STATS.flush)
+    atexit.register(writeSnapshot)
+    # Exit gracefully on SIGTERM, so that the exit handlers run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Invalidate exactly the cache entries affected by changes made on other nodes or with the CLI
+    # Changed credentials are read from the primary until the replicas have caught up, before the cache drops them
+    CHANGES.subscribe(changes.CREDENTIALS, cn.markWritten)
+    CHANGES.subscribe(changes.CREDENTIALS, keys.CACHE.invalidate)
+    CHANGES.subscribe(changes.USER, SESSIONS.revoke)
+    CHANGES.subscribe(changes.USER, IDENTITIES.invalidate)
+    CHANGES.subscribe(changes.USER, permissions.INDEX.invalidate)
+    CHANGES.subscribe(changes.PERMISSIONS, permissions.INDEX.invalidate)
+    CHANGES.start()
+
+    # A fixed number of workers serves new connections and packets of ready connections, idle connections are
+    # watched by the poller and don't occupy a worker
+    connections = queue.Queue()
+    poller = ConnectionPoller(connections, idleTimeout, maxIdlePerClient, maxIdleConnections)
+    poller.start()
+    for _ in range(workers):
+        threading.Thread(target=worker, args=(context, connections, poller), daemon=True).start()
+    rejections = threading.BoundedSemaphore(4)
+
     # Create a socket & listen on it
     serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     serverSocket.bind((serverHost, serverPort))
-    serverSocket.listen(5)
+    serverSocket.listen(128)
 
     print(f"CM Server listening on {serverHost}:{serverPort}")
-    sslClientSocket = None
 
     while True:
-        # Accept incoming connections
+        # Accept incoming connections and queue them for the workers
         clientSocket, clientAddress = serverSocket.accept()
         print(f"Accepted connection from {clientAddress}")
-
-        # Wrap the socket with TLS
-        try:
-            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            context.load_verify_locations(caCert)
-            context.load_cert_chain(certfile=serverCert, keyfile=serverKey)
-            context.verify_mode = ssl.CERT_REQUIRED
-            context.minimum_version = ssl.TLSVersion.TLSv1_3
-            sslClientSocket = context.wrap_socket(
-                clientSocket, server_side=True, do_handshake_on_connect=True
-            )
-        except Exception as e:
-            print(f"Error: {e}")
-
-        try:
-            # Receive and send data
-            data = sslClientSocket.recv(1024)
-            print(f"Received packet from {clientAddress}")
-            if data:
-                packet = data.decode()
-
-                # Validate packet structure against PROTOCOLSCHEMA
-                if not cm_protocol.validatePacket(packet):
-                    response = "500 : Invalid packet structure."
-                    sslClientSocket.sendall(response.encode())
-                    continue
-                print("Packet validity OK!")
-
-                # Client authentication
-                packet = json.loads(packet)
-                header = packet["header"]
-                user = users.cmUser(
-                    cmUsername=header["cmUser"], cmPassword=header["cmPassword"]
-                )
-
-                if not user.authenticateUser():
-                    print("Client authentication failed!")
-                    response = "400 : Client authentication failed."
-                    sslClientSocket.sendall(response.encode())
-                    continue
-                print("Client authentication successful!")
-
-                # Handle request based on request type
-                result = cm_requests.requestHandler(packet)
-                sslClientSocket.sendall(json.dumps(result).encode())
-                print(f"Sent answer to {clientAddress}")
-
-        except Exception as e:
-            print(f"Error: {e}")
-        finally:
-            # Close the connection gracefully
-            if sslClientSocket:
-                sslClientSocket.close()
-            print("Connection closed.")
+        if connections.qsize() < acceptQueue:
+            connections.put((clientSocket, clientAddress))
+        else:
+            # Tell the client to come back later, or just hang up if we are already busy rejecting others
+            print(f"Accept queue full, rejecting {clientAddress}")
+            if rejections.acquire(blocking=False):
+                threading.Thread(
+                    target=rejectConnection, args=(context, clientSocket, rejections), daemon=True
+                ).start()
+            else:
+                clientSocket.close()
 
 
 if __name__ == "__main__":
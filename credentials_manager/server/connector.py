@@ -1,4 +1,10 @@
 import json
+import math
+import time
+import threading
+import contextlib
+import mysql.connector
+from mysql.connector import pooling
 from jsonschema import validate
 
 # CONFIGURATION FILES
@@ -14,6 +20,23 @@ DBSCHEMA = {
         "password": {"type": "string"},
         "database": {"type": "string"},
         "port": {"type": "integer"},
+        "replicas": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "host": {"type": "string"},
+                    "user": {"type": "string"},
+                    "password": {"type": "string"},
+                    "port": {"type": "integer"},
+                },
+                "required": ["host"],
+                "additionalProperties": False,
+            },
+        },
+        "max_replica_lag": {"type": "number"},
+        "lag_check_interval": {"type": "number"},
+        "pool_size": {"type": "integer"},
     },
     "required": ["host", "user", "password"],
     "additionalProperties": False,
@@ -53,11 +76,11 @@ def validateDict(inputDict, schema):
         return False
 
 
-def getDBConfig():
-    """Returns a dictionary for database connection.
+def loadDBConfig() -> dict:
+    """Loads and validates the database configuration file.
 
     Returns:
-        dict : Dictionary containing all necessary information to connect to a mariaDB database.
+        dict : Content of the database configuration file.
 
     Raises:
         Exception: Failed to get database configuration.
@@ -66,20 +89,414 @@ def getDBConfig():
         with open(DBCONFIGFILE, "r") as f:
             data = json.load(f)
             if validateDict(data, DBSCHEMA):
-                config = {
-                    "user": data["user"],
-                    "password": data["password"],
-                    "host": data["host"],
-                    "database": data["database"],
-                    "raise_on_warnings": True,
-                }
-                return config
+                return data
             else:
                 raise Exception("Invalid DB configuration format.")
     except:
         raise FileNotFoundError("Failed to get database configuration.")
 
 
+def getDBConfig(data: dict = None):
+    """Returns a dictionary for database connection.
+
+    Args:
+        data (dict, optional): Content of the database configuration file, or of one of its replicas
+            (missing values are taken from the primary). Defaults to the primary.
+
+    Returns:
+        dict : Dictionary containing all necessary information to connect to a mariaDB database.
+
+    Raises:
+        Exception: Failed to get database configuration.
+    """
+    primary = loadDBConfig()
+    data = {**primary, **(data or {})}
+    config = {
+        "user": data["user"],
+        "password": data["password"],
+        "host": data["host"],
+        "database": primary["database"],
+        "raise_on_warnings": True,
+    }
+    if "port" in data:
+        config["port"] = data["port"]
+    return config
+
+
+# Seconds a replica lag check waits for a replica to accept its connection
+PROBETIMEOUT = 2
+
+# Error of SHOW SLAVE STATUS if the database user lacks the REPLICATION CLIENT privilege
+ER_SPECIFIC_ACCESS_DENIED_ERROR = 1227
+
+
+class Replicas:
+    """Read replicas of the CM database. Reads go to the healthy replica with the least replication lag.
+    The lag is checked at most every checkInterval seconds, in a background thread so that no request waits for
+    it; replicas that lag behind more than maxLag seconds, or can't be reached, aren't used until the next check."""
+
+    def __init__(self, configs: list, maxLag: float = 2, checkInterval: float = 5):
+        """Constructor for Replicas objects.
+
+        Args:
+            configs (list[dict]): Connection configurations of the replicas.
+            maxLag (float, optional): Maximum replication lag in seconds. Defaults to 2.
+            checkInterval (float, optional): Minimum seconds between two lag checks. Defaults to 5.
+        """
+        self.configs = configs
+        self.maxLag = maxLag
+        self.checkInterval = checkInterval
+        self._lags = [None] * len(configs)
+        self._checked = 0.0
+        self._denied = set()
+        self._lock = threading.Lock()
+
+    def _checkLags(self):
+        """Measures the replication lag of every replica. Runs in the background, see choose()."""
+        try:
+            for i, config in enumerate(self.configs):
+                self._lags[i] = self._checkLag(i, config)
+        finally:
+            self._lock.release()
+
+    def _checkLag(self, replica: int, config: dict):
+        """Measures the replication lag of a replica.
+
+        Returns:
+            int: Lag in seconds, or None if the replica can't be used.
+        """
+        connection = None
+        cursor = None
+        try:
+            connection = mysql.connector.connect(**{**config, "connection_timeout": PROBETIMEOUT})
+            cursor = connection.cursor(dictionary=True)
+            cursor.execute("SHOW SLAVE STATUS")
+            status = cursor.fetchone()
+            # No lag means replication isn't running
+            return status["Seconds_Behind_Master"] if status else None
+        except mysql.connector.Error as e:
+            if e.errno != ER_SPECIFIC_ACCESS_DENIED_ERROR:
+                print(f"Error: {e}")
+            elif replica not in self._denied:
+                # Logged once, the replica isn't going to be used until the privilege is granted
+                self._denied.add(replica)
+                print(
+                    f"Reads from replica {config['host']} disabled: the database user needs the "
+                    f"REPLICATION CLIENT privilege to read its lag. {e}"
+                )
+            return None
+        finally:
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
+    def choose(self) -> int:
+        """Chooses the replica with the least lag.
+
+        Returns:
+            int: Index of the replica, or None if no replica is fit to serve reads.
+        """
+        now = time.monotonic()
+        # Only one check runs at a time, requests use the last results in the meantime
+        if now - self._checked >= self.checkInterval and self._lock.acquire(blocking=False):
+            self._checked = now
+            try:
+                threading.Thread(target=self._checkLags, daemon=True).start()
+            except RuntimeError:
+                self._lock.release()
+        candidates = [(lag, i) for i, lag in enumerate(self._lags) if lag is not None and lag <= self.maxLag]
+        return min(candidates)[1] if candidates else None
+
+    def markFailed(self, replica: int):
+        """Stops using a replica that couldn't be reached until the next lag check."""
+        self._lags[replica] = None
+
+
+# Labels written by this process, by time.monotonic() of the write
+_WRITES = {}
+
+# Connections shared by all commands a thread runs, e.g. in the CLI's batch mode
+_SHARED = threading.local()
+
+
+class SharedConnection:
+    """A connection that is shared by several commands (see share()). Commands use it like a connection of their
+    own, but can't close it. In a single transaction, their commits are deferred to the end of the batch, and a
+    failed statement or rollback makes the whole batch roll back."""
+
+    def __init__(self, connection, transaction: bool = False):
+        """Constructor for SharedConnection objects.
+
+        Args:
+            connection (MySQLConnection): Connection to the CM database.
+            transaction (bool, optional): Run all commands in a single transaction. Defaults to False.
+        """
+        self.connection = connection
+        self.transaction = transaction
+        self.failed = False
+        self.errors = 0
+
+    def cursor(self, *args, **kwargs):
+        # Commands don't always read all rows, which would block an unbuffered cursor for the next command
+        kwargs.setdefault("buffered", True)
+        return _SharedCursor(self, self.connection.cursor(*args, **kwargs))
+
+    def commit(self):
+        if not self.transaction:
+            self.connection.commit()
+
+    def rollback(self):
+        if self.transaction:
+            self.failed = True
+        else:
+            self.connection.rollback()
+
+    def close(self):
+        pass
+
+    def release(self):
+        """Called after every command. Outside of a single transaction, changes a command hasn't committed
+        are rolled back, as if it had closed its own connection."""
+        if not self.transaction:
+            self.connection.rollback()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class _SharedCursor:
+    """Cursor of a SharedConnection, which counts failed statements."""
+
+    def __init__(self, shared: SharedConnection, cursor):
+        self._shared = shared
+        self._cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        try:
+            return self._cursor.execute(*args, **kwargs)
+        except mysql.connector.Error:
+            self._shared.errors += 1
+            self._shared.failed = True
+            raise
+
+    def executemany(self, *args, **kwargs):
+        try:
+            return self._cursor.executemany(*args, **kwargs)
+        except mysql.connector.Error:
+            self._shared.errors += 1
+            self._shared.failed = True
+            raise
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def share(transaction: bool = False) -> SharedConnection:
+    """Opens a connection to the primary that all following connect() calls of this thread return,
+    until unshare() is called.
+
+    Args:
+        transaction (bool, optional): Run everything in a single transaction, committed by unshare(). Defaults to False.
+
+    Returns:
+        SharedConnection: The shared connection.
+    """
+    _SHARED.connection = SharedConnection(mysql.connector.connect(**DBCONFIG), transaction)
+    return _SHARED.connection
+
+
+def shared() -> SharedConnection:
+    """Returns the shared connection of this thread.
+
+    Returns:
+        SharedConnection: The shared connection, or None.
+    """
+    return getattr(_SHARED, "connection", None)
+
+
+def unshare() -> bool:
+    """Closes the shared connection of this thread. A single transaction is committed, unless a command has failed.
+
+    Returns:
+        bool: True if the changes have been committed (always True outside of a single transaction).
+    """
+    connection = shared()
+    if connection is None:
+        return True
+    _SHARED.connection = None
+    try:
+        if connection.transaction and not connection.failed:
+            connection.connection.commit()
+            return True
+        connection.connection.rollback()
+        return not connection.transaction
+    finally:
+        connection.connection.close()
+
+
+def markWritten(label: str):
+    """Remembers that this process has changed the credentials with the given label, so that the
+    following reads of the label go to the primary until the replicas have caught up (read-your-writes).
+
+    Args:
+        label (str): Unique credentials label.
+    """
+    _WRITES[label] = time.monotonic()
+
+
+# Deadline of the request the current thread is handling, see deadline()
+_DEADLINE = threading.local()
+
+
+@contextlib.contextmanager
+def deadline(until: float):
+    """Bounds the database and HSM work of the current thread by a request's deadline: connections opened
+    within the block time out when the deadline passes, and no new work is started after it.
+
+    Args:
+        until (float): time.monotonic() by which the request must be answered, or None.
+    """
+    previous = getattr(_DEADLINE, "until", None)
+    _DEADLINE.until = until
+    try:
+        yield
+    finally:
+        _DEADLINE.until = previous
+
+
+def remaining() -> float:
+    """Returns the seconds left until the deadline of the current thread's request.
+
+    Returns:
+        float: Seconds left, or None if there is no deadline.
+
+    Raises:
+        DeadlineExceeded: The deadline has passed.
+    """
+    until = getattr(_DEADLINE, "until", None)
+    if until is None:
+        return None
+    left = until - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("Deadline exceeded.")
+    return left
+
+
+def _bounded(config: dict) -> dict:
+    """Adds the time left until the current request's deadline as timeout to a connection configuration."""
+    left = remaining()
+    if left is None:
+        return config
+    return {**config, "connection_timeout": max(1, math.ceil(left))}
+
+
+def connect(readOnly: bool = False, label: str = None):
+    """Opens a connection to the CM database. Read-only work goes to a read replica, if there is one
+    fit to serve it, everything else to the primary.
+
+    Args:
+        readOnly (bool, optional): True if the connection is only used for reading. Defaults to False.
+        label (str, optional): Credentials label that is read. If this process has changed it recently,
+            the primary is used instead of a replica.
+
+    Returns:
+        MySQLConnection: Connection to the CM database, or the shared connection of this thread.
+    """
+    # Commands that share a connection read their own, possibly uncommitted writes
+    if shared() is not None:
+        return shared()
+    if readOnly and REPLICAS.configs:
+        written = _WRITES.get(label) if label is not None else None
+        if written is None or time.monotonic() - written > REPLICAS.maxLag + REPLICAS.checkInterval:
+            replica = REPLICAS.choose()
+            if replica is not None:
+                try:
+                    return mysql.connector.connect(**_bounded(REPLICAS.configs[replica]))
+                except DeadlineExceeded:
+                    raise
+                except mysql.connector.Error as e:
+                    print(f"Error: {e}")
+                    REPLICAS.markFailed(replica)
+    return mysql.connector.connect(**_bounded(DBCONFIG))
+
+
+# Pool of connections to the primary for transactions, created on first use, and one slot per pooled connection
+_POOL = None
+_POOLSLOTS = None
+_POOLLOCK = threading.Lock()
+
+
+def _pool():
+    """Returns the pool of connections to the primary.
+
+    Returns:
+        MySQLConnectionPool: Connection pool.
+    """
+    global _POOL, _POOLSLOTS
+    with _POOLLOCK:
+        if _POOL is None:
+            _POOL = pooling.MySQLConnectionPool(
+                pool_name="cm", pool_size=_DBSETTINGS.get("pool_size", 5), **DBCONFIG
+            )
+            _POOLSLOTS = threading.Semaphore(_POOL.pool_size)
+        return _POOL
+
+
+def _pooledConnection():
+    """Returns a connection of the pool, and waits for one to be returned if all of them are in use
+    (the pool itself fails right away), but not beyond the deadline of the current thread's request.
+
+    Returns:
+        PooledMySQLConnection: Connection to the primary, returned to the pool by close().
+
+    Raises:
+        DeadlineExceeded: No connection has been returned before the deadline.
+    """
+    pool = _pool()
+    if not _POOLSLOTS.acquire(timeout=remaining()):
+        raise DeadlineExceeded("Deadline exceeded.")
+    try:
+        return pool.get_connection()
+    except BaseException:
+        _POOLSLOTS.release()
+        raise
+
+
+@contextlib.contextmanager
+def transaction():
+    """Runs a block of statements in a single transaction on a pooled connection to the primary
+    (or on the shared connection of this thread). The transaction is committed when the block ends,
+    and rolled back if it raises an exception, so a change is never written halfway. If all pooled connections
+    are in use, it waits for one to be returned.
+
+    Yields:
+        MySQLCursor: Cursor of the transaction.
+    """
+    connection = shared()
+    pooled = connection is None
+    if pooled:
+        connection = _pooledConnection()
+    try:
+        cursor = connection.cursor()
+        try:
+            yield cursor
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+    finally:
+        # Return the connection to the pool
+        connection.close()
+        if pooled:
+            _POOLSLOTS.release()
+
+
 def getHsmConfig():
     """Returns a dictionary for hsm connection.
 
@@ -105,3 +522,16 @@ def getHsmConfig():
 
 DBCONFIG = getDBConfig()
 HSMCONFIG = getHsmConfig()
+_DBSETTINGS = loadDBConfig()
+
+REPLICAS = Replicas(
+    [getDBConfig(replica) for replica in _DBSETTINGS.get("replicas", [])],
+    _DBSETTINGS.get("max_replica_lag", 2),
+    _DBSETTINGS.get("lag_check_interval", 5),
+)
+
+
+class DeadlineExceeded(mysql.connector.Error):
+    """Exception raised if database or HSM work would start after the current request's deadline."""
+
+    pass
@@ -3,7 +3,10 @@ import connector as cn
 import mysql.connector
 import crypto
 import keys
-from tabulate import tabulate
+import permissions
+import changes
+import versions
+import listing
 
 
 # JSON schema for the credentials structure
@@ -32,98 +35,118 @@ class Credentials:
         self.label = label
         self.credentials = credentials
 
-    def putCredentials(self):
-        """Puts credentials into the cm.credentials table."""
-        try:
-            # Connect to the MariaDB database
-            connection = mysql.connector.connect(**cn.DBCONFIG)
-            cursor = connection.cursor()
-
-            # Select credentials from the table & commit
-            insertQuery = "INSERT INTO credentials (credentials, label) VALUES (%s, %s)"
-            cursor.execute(insertQuery, (self.credentials, self.label))
-            connection.commit()
-        except mysql.connector.Error as e:
-            print(f"Error: {e}")
-        finally:
-            # Close connection gracefully
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
+    def putCredentials(self, cursor=None) -> int:
+        """Puts credentials into the cm.credentials table.
+
+        Args:
+            cursor (MySQLCursor, optional): Cursor of the current transaction. Defaults to a transaction of its own.
+
+        Returns:
+            int: Credentials ID of the inserted credentials, or None.
+        """
+        if cursor is None:
+            try:
+                with cn.transaction() as cursor:
+                    return self.putCredentials(cursor)
+            except mysql.connector.Error as e:
+                print(f"Error: {e}")
+                return None
+
+        # Insert the credentials
+        insertQuery = "INSERT INTO credentials (credentials, label) VALUES (%s, %s)"
+        cursor.execute(insertQuery, (self.credentials, self.label))
+        return cursor.lastrowid
 
     def createCredentials(self):
         """Creates encrypted credentials from a plaintext credentials object and puts them in the cm database,
-        if they don't already exist."""
-        # Check if credentials already exist
-        if fetchCredentials(self.label):
-            print(f"Credentials with label {self.label} already exist.")
-            return
-        # if they don't exist, check if the given input is valid
-        elif not cn.validateDict(self.credentials, CRSCHEMA):
+        if they don't already exist. The credentials and their data key are written in a single transaction,
+        which is only opened once they are encrypted, so it doesn't wait for the HSM."""
+        # Check if the given input is valid
+        if not cn.validateDict(self.credentials, CRSCHEMA):
             print("Invalid credentials format.")
             return
-        # if the input is valid & credentials dont exist, create credentials
-        else:
-            try:
-                # first, generate a data key for these specific credentials
-                dataKey = keys.generateDataKey()
+        try:
+            # first, generate a data key for these specific credentials
+            dataKey = keys.generateDataKey()
 
-                # second, encrypt the plaintext credentials using the datakey
-                ciphertext = crypto.encryptCredentials(dataKey, self.credentials)
-                encryptedCredentials = Credentials(self.label, ciphertext)
+            # second, encrypt the plaintext credentials using the datakey
+            ciphertext = crypto.encryptCredentials(dataKey, self.credentials)
+            encryptedCredentials = Credentials(self.label, ciphertext)
 
-                # third, encrypt the datakey
-                encryptedDataKey = dataKey.encryptDataKey()
+            # third, encrypt the datakey
+            encryptedDataKey = dataKey.encryptDataKey()
+
+            with cn.transaction() as cursor:
+                # Check if credentials already exist, without decrypting them
+                if credentialsExist(self.label, cursor):
+                    print(f"Credentials with label {self.label} already exist.")
+                    return
 
                 # fourth, put the encrypted credentials
-                encryptedCredentials.putCredentials()
+                crId = encryptedCredentials.putCredentials(cursor)
 
                 # fifth, put the encrypted datakey
-                encryptedDataKey.putKey(self.label)
-                print(f"Created credentials '{self.label}'.")
-            except Exception as e:
-                print(f"Error: {e}")
+                encryptedDataKey.insertKey(crId, cursor)
+
+            cn.markWritten(self.label)
+            print(f"Created credentials '{self.label}'.")
+        except (mysql.connector.Error, keys.HsmError) as e:
+            print(f"Error: {e}")
 
     def deleteCredentials(self):
         """Deletes credentials from the CM database."""
         try:
-            # Connect to the MariaDB database
-            connection = mysql.connector.connect(**cn.DBCONFIG)
-            cursor = connection.cursor()
-
-            if not fetchCredentials(self.label):
-                print(f"There are no credentials for label '{self.label}'")
-                return
-
-            # Delete credentials from the table & commit
-            deleteQuery = "DELETE FROM credentials WHERE label = %s"
-            cursor.execute(deleteQuery, (self.label,))
-            connection.commit()
+            with cn.transaction() as cursor:
+                # Delete credentials from the table, if they exist
+                deleteQuery = "DELETE FROM credentials WHERE label = %s"
+                cursor.execute(deleteQuery, (self.label,))
+                if not cursor.rowcount:
+                    print(f"There are no credentials for label '{self.label}'")
+                    return
+                # Permissions for the credentials are deleted along with them
+                version = versions.bumpVersion(cursor, permissions.VERSIONNAME)
+                changes.record(cursor, changes.CREDENTIALS, self.label)
+
+            cn.markWritten(self.label)
+            permissions.INDEX.removeLabel(self.label, version)
 
             print(f"Deleted credentials '{self.label}'")
         except mysql.connector.Error as e:
             print(f"Error: {e}")
-        finally:
-            # Close connection gracefully
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
+
+
+def credentialsExist(label, cursor) -> bool:
+    """Checks if credentials with the given label exist, without decrypting them.
+
+    Args:
+        label (str): Unique credentials label.
+        cursor (MySQLCursor): Cursor of the current transaction.
+
+    Returns:
+        bool: True if the credentials exist.
+    """
+    cursor.execute("SELECT 1 FROM credentials WHERE label = %s", (label,))
+    return cursor.fetchone() is not None
 
 
 def fetchCredentials(label):
     """Fetches credentials for a given label and decrypts them using the corresponding data key.
+    Both are read from a read replica, unless this process has just changed the credentials.
 
     Args:
         label (str): Unique credentials label.
 
     Returns:
         dict[str]: Plaintext credentials.
+
+    Raises:
+        DeadlineExceeded: The request's deadline has passed.
     """
+    connection = None
+    cursor = None
     try:
         # Connect to the MariaDB database
-        connection = mysql.connector.connect(**cn.DBCONFIG)
+        connection = cn.connect(readOnly=True, label=label)
         cursor = connection.cursor()
 
         # Select credentials from the table & commit
@@ -136,8 +159,8 @@ def fetchCredentials(label):
             return None
         encryptedCredentials, crId = result
 
-        # Fetch & decrypt the data keybytes
-        dataKey = keys.fetchDataKey(crId)
+        # Fetch & decrypt the data keybytes, from the same database as the credentials
+        dataKey = keys.fetchDataKey(crId, cursor, label)
         if not dataKey:
             return None
 
@@ -145,6 +168,9 @@ def fetchCredentials(label):
         decryptedCredentials = crypto.decryptCredentials(dataKey, encryptedCredentials)
         return decryptedCredentials
 
+    except cn.DeadlineExceeded:
+        # The client is told that it ran out of time, not that it isn't allowed to read the credentials
+        raise
     except mysql.connector.Error as e:
         print(f"Error: {e}")
         return None
@@ -177,30 +203,24 @@ def loadCredentials(filepath):
         return None
 
 
-def printCredentials():
-    try:
-        # Connect to the MariaDB database
-        connection = mysql.connector.connect(**cn.DBCONFIG)
-        cursor = connection.cursor()
-
-        # Get result & pretty print
-        cursor.execute("SELECT cr_id, label, credentials FROM credentials")
-        result = cursor.fetchall()
+def printCredentials(options: listing.ListOptions = None):
+    """Pretty prints the cm.credentials table, ordered by label.
 
-        # For pretty printing we truncate the long encrypted credentials string.
-        modifiedResult = []
-        for row in result:
-            crId, label, credentials = row
-            credentials = credentials[:16]
-            modifiedResult.append((crId, label, credentials))
+    Args:
+        options (ListOptions, optional): LABEL filter, page and output mode. Defaults to the first page.
+    """
 
-        fields = [i[0] for i in cursor.description]
-        print(tabulate(modifiedResult, headers=fields, tablefmt="psql"))
-    except mysql.connector.Error as e:
-        print(f"Error: {e}")
-    finally:
-        # Close connection gracefully
-        if cursor:
-            cursor.close()
-        if connection:
-            connection.close()
+    # For pretty printing we truncate the long encrypted credentials string.
+    def formatRow(row):
+        crId, label, credentials = row
+        return (crId, label, credentials[:16])
+
+    listing.printListing(
+        "LIST CREDENTIALS",
+        "SELECT cr_id, label, credentials FROM credentials",
+        ("label",),
+        {"LABEL": "label"},
+        options or listing.ListOptions(),
+        ["cr_id", "label", "credentials"],
+        formatRow,
+    )
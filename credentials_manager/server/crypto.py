@@ -3,6 +3,7 @@ from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 import json
 import bcrypt
+import hashing
 import keys
 
 
@@ -80,5 +81,5 @@ def hashAndSaltPassword(password):
         bytes: A salted and hashed password.
     """
     salt = bcrypt.gensalt()
-    hashedPassword = bcrypt.hashpw(password.encode("utf-8"), salt)
+    hashedPassword = hashing.hashpw(password.encode("utf-8"), salt)
     return salt, hashedPassword
@@ -0,0 +1,115 @@
+"""This module runs bcrypt password hashing on a dedicated pool of worker processes, sized to the available cores.
+Hashing is the most expensive part of a CM request. On the pool it scales with the cores, and threads doing
+database, HSM or socket work never wait behind it. The number of waiting hash jobs is bounded, so that a flood
+of authentication attempts is rejected quickly instead of piling up.
+
+Until start() is called (e.g. in the CM CLI), passwords are hashed in the calling thread."""
+import os
+import threading
+import multiprocessing
+import bcrypt
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+
+def _hashpw(password: bytes, salt: bytes) -> bytes:
+    """Hashes a password. Runs inside a worker process."""
+    return bcrypt.hashpw(password, salt)
+
+
+class HashingPool:
+    """Process pool with a bounded queue for bcrypt hashing."""
+
+    def __init__(self, workers: int = None, queueSize: int = None, timeout: float = 1):
+        """Constructor for HashingPool objects.
+
+        Args:
+            workers (int, optional): Number of worker processes. Defaults to the number of cores.
+            queueSize (int, optional): Number of hash jobs that may wait for a worker. Defaults to 4 per worker.
+            timeout (float, optional): Seconds a caller waits for a place in the queue. Defaults to 1.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.queueSize = self.workers * 4 if queueSize is None else queueSize
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.workers + self.queueSize)
+        # Worker processes are spawned, forking a multi-threaded server is not safe
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    def hashpw(self, password: bytes, salt: bytes, timeout: float = None) -> bytes:
+        """Hashes a password on a worker process.
+
+        Args:
+            password (bytes): Password.
+            salt (bytes): bcrypt salt.
+            timeout (float, optional): Seconds left until the caller's deadline. Defaults to no deadline.
+
+        Returns:
+            bytes: Salted and hashed password.
+
+        Raises:
+            HashingBusy: The queue is full.
+            TimeoutError: The hash wasn't ready before the deadline.
+        """
+        if not self._slots.acquire(timeout=self.timeout if timeout is None else min(self.timeout, timeout)):
+            raise HashingBusy("Password hashing queue is full.")
+        try:
+            future = self._executor.submit(_hashpw, password, salt)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The job keeps its place in the queue until a worker is done with it, even if the caller gives up
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            # A job that hasn't reached a worker yet isn't hashed anymore
+            future.cancel()
+            raise TimeoutError("Password hashing didn't finish before the deadline.")
+
+    def shutdown(self):
+        """Stops the worker processes."""
+        self._executor.shutdown()
+
+
+# The pool used by hashpw(), None until start() is called
+POOL = None
+
+
+def start(workers: int = None, queueSize: int = None):
+    """Starts the hashing pool. Afterwards, hashpw() runs on the pool's worker processes.
+
+    Args:
+        workers (int, optional): Number of worker processes. Defaults to the number of cores.
+        queueSize (int, optional): Number of hash jobs that may wait for a worker. Defaults to 4 per worker.
+    """
+    global POOL
+    POOL = HashingPool(workers, queueSize)
+    print(f"Password hashing on {POOL.workers} worker processes.")
+
+
+def hashpw(password: bytes, salt: bytes, timeout: float = None) -> bytes:
+    """Hashes a password with bcrypt, on the hashing pool if it has been started.
+
+    Args:
+        password (bytes): Password.
+        salt (bytes): bcrypt salt.
+        timeout (float, optional): Seconds left until the caller's deadline, only applies to the pool.
+            Defaults to no deadline.
+
+    Returns:
+        bytes: Salted and hashed password.
+
+    Raises:
+        HashingBusy: The hashing pool's queue is full.
+        TimeoutError: The hash wasn't ready before the deadline.
+    """
+    if POOL is None:
+        return _hashpw(password, salt)
+    return POOL.hashpw(password, salt, timeout)
+
+
+class HashingBusy(Exception):
+    """Exception raised if the hashing pool can't accept more jobs."""
+
+    pass
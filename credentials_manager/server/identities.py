@@ -0,0 +1,127 @@
+"""This module maps client certificates to CM users. Users in "certificate" auth mode are authenticated
+by the certificate they presented during the mutual TLS handshake, without a password and without bcrypt.
+A certificate is identified either by its SHA-256 fingerprint or by its subject (so that a renewed certificate
+with the same subject keeps working). The mapping is cached in memory and reloaded when it changes."""
+import time
+import hashlib
+import threading
+import mysql.connector
+import connector as cn
+import versions
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+
+# Name of the identities index in cm.cm_versions
+VERSIONNAME = "identities"
+
+# Auth modes of CM users
+AUTHMODES = ("password", "certificate")
+
+
+class IdentityMap:
+    """In-memory mapping of certificate fingerprints and subjects to users in certificate auth mode."""
+
+    def __init__(self, checkInterval: float = 2):
+        """Constructor for IdentityMap objects.
+
+        Args:
+            checkInterval (float, optional): Minimum seconds between two version checks against the database. Defaults to 2.
+        """
+        self.checkInterval = checkInterval
+        self._fingerprints = {}
+        self._subjects = {}
+        self._version = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Loads all users in certificate auth mode from the CM database."""
+        connection = None
+        cursor = None
+        try:
+            # The index and its version are read in one transaction, possibly from a replica
+            connection = cn.connect(readOnly=True)
+            cursor = connection.cursor()
+            version = versions.fetchVersion(VERSIONNAME, cursor)
+            cursor.execute(
+                "SELECT username, cert_fingerprint, cert_subject FROM users WHERE auth_mode = 'certificate'"
+            )
+            fingerprints, subjects = {}, {}
+            for username, fingerprint, subject in cursor.fetchall():
+                if fingerprint:
+                    fingerprints[fingerprint] = username
+                if subject:
+                    subjects[subject] = username
+        except mysql.connector.Error as e:
+            print(f"Error: {e}")
+            return
+        finally:
+            # Close connection gracefully
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
+        with self._lock:
+            self._fingerprints, self._subjects = fingerprints, subjects
+            self._version = version
+
+    def refresh(self):
+        """Reloads the mapping if it has changed. The version is checked at most every checkInterval seconds."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked < self.checkInterval:
+                return
+            self._checked = now
+        version = versions.fetchVersion(VERSIONNAME)
+        if version is not None and version != self._version:
+            self.load()
+
+    def invalidate(self, subject: str = None):
+        """Makes the next lookup check the version right away, e.g. because the change log reported a change.
+
+        Args:
+            subject (str, optional): The changed username or role. Unused, the version covers all changes.
+        """
+        self._checked = 0.0
+
+    def lookup(self, fingerprint: str, subject: str) -> str:
+        """Returns the user a certificate is mapped to.
+
+        Args:
+            fingerprint (str): SHA-256 fingerprint of the client's certificate.
+            subject (str): RFC 4514 subject of the client's certificate.
+
+        Returns:
+            str: Username, or None if the certificate isn't mapped to a user in certificate auth mode.
+        """
+        self.refresh()
+        return self._fingerprints.get(fingerprint) or self._subjects.get(subject)
+
+
+def certificateSubject(certificate: bytes) -> str:
+    """Returns the subject of a DER encoded certificate.
+
+    Args:
+        certificate (bytes): DER encoded certificate.
+
+    Returns:
+        str: RFC 4514 subject string.
+    """
+    return x509.load_der_x509_certificate(certificate).subject.rfc4514_string()
+
+
+def loadCertificate(filepath: str):
+    """Loads a PEM certificate file and returns its fingerprint and subject.
+
+    Args:
+        filepath (str): Path to the certificate.
+
+    Returns:
+        str: SHA-256 fingerprint.
+        str: RFC 4514 subject string.
+    """
+    with open(filepath, "rb") as f:
+        certificate = x509.load_pem_x509_certificate(f.read())
+    der = certificate.public_bytes(serialization.Encoding.DER)
+    return hashlib.sha256(der).hexdigest(), certificate.subject.rfc4514_string()
@@ -0,0 +1,166 @@
+"""This module imports many credentials at once, e.g. when onboarding a new environment. Entries are read as a
+stream from a directory of credentials files or a JSON lines file, and imported in chunks: the data keys of a chunk
+are encrypted in a single HSM session, and its credentials and data keys are inserted in a single transaction.
+Entries that can't be imported are reported one by one, without stopping the import."""
+import os
+import sys
+import json
+import mysql.connector
+import connector as cn
+import credentials as cr
+import crypto
+import keys
+
+# Number of entries imported per HSM session and transaction
+CHUNKSIZE = 500
+
+# Maximum length of a credentials label (cm.credentials.label)
+MAXLABEL = 255
+
+
+def importCredentials(source: str, chunkSize: int = CHUNKSIZE) -> tuple:
+    """Imports credentials from a directory or a JSON lines file and prints every entry that failed.
+
+    Args:
+        source (str): Directory of <label>.json credentials files, or JSON lines file with one
+            {"label": ..., "credentials": {...}} object per line ("-" reads them from stdin).
+        chunkSize (int, optional): Number of entries per HSM session and transaction. Defaults to CHUNKSIZE.
+
+    Returns:
+        int: Number of imported credentials.
+        list[tuple]: (label, error) for every entry that failed.
+    """
+    created = 0
+    failures = []
+    chunk = []
+    for entry in readEntries(source):
+        chunk.append(entry)
+        if len(chunk) == chunkSize:
+            created += _importChunk(chunk, failures)
+            chunk = []
+    if chunk:
+        created += _importChunk(chunk, failures)
+    print(f"Imported {created} credentials, {len(failures)} failed.")
+    return created, failures
+
+
+def readEntries(source: str):
+    """Reads credentials entries one at a time.
+
+    Args:
+        source (str): Directory, JSON lines file or "-" for stdin.
+
+    Yields:
+        tuple: (label, credentials, error), error is None if the entry could be read.
+    """
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if not name.endswith(".json"):
+                continue
+            label = name[: -len(".json")]
+            try:
+                with open(os.path.join(source, name), "r") as f:
+                    yield label, json.load(f), None
+            except (OSError, ValueError) as e:
+                yield label, None, f"Can't read credentials file: {e}"
+        return
+
+    f = sys.stdin if source == "-" else open(source, "r")
+    try:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                yield entry["label"], entry["credentials"], None
+            except (ValueError, TypeError, KeyError) as e:
+                yield f"line {number}", None, f"Invalid entry: {e!r}"
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _importChunk(entries: list, failures: list) -> int:
+    """Imports a chunk of entries in a single transaction.
+
+    Args:
+        entries (list[tuple]): (label, credentials, error) entries.
+        failures (list[tuple]): (label, error) of failed entries, appended to.
+
+    Returns:
+        int: Number of imported credentials.
+    """
+
+    def fail(label, error):
+        failures.append((label, error))
+        print(f"{label}: {error}")
+
+    # Validate the entries before they cost an HSM call
+    valid = {}
+    for label, credentials, error in entries:
+        if error is None and (not isinstance(label, str) or not label or len(label) > MAXLABEL):
+            error = "Invalid label."
+        elif error is None and not cn.validateDict(credentials, cr.CRSCHEMA):
+            error = "Invalid credentials format."
+        elif error is None and label in valid:
+            error = "Duplicate label."
+        if error is None:
+            valid[label] = credentials
+        else:
+            fail(label, error)
+    if not valid:
+        return 0
+
+    connection = None
+    cursor = None
+    try:
+        # Connect to the MariaDB database
+        connection = cn.connect()
+        cursor = connection.cursor()
+
+        # Existence check for the whole chunk with a single query, without decrypting anything
+        placeholders = ", ".join(["%s"] * len(valid))
+        cursor.execute(f"SELECT label FROM credentials WHERE label IN ({placeholders})", tuple(valid))
+        for (label,) in cursor.fetchall():
+            fail(label, "Credentials already exist.")
+            del valid[label]
+        if not valid:
+            return 0
+
+        # Encrypt the credentials with new data keys, and the data keys in a single HSM session
+        labels = list(valid)
+        dataKeys = [keys.generateDataKey() for _ in labels]
+        ciphertexts = [crypto.encryptCredentials(dataKey, valid[label]) for dataKey, label in zip(dataKeys, labels)]
+        encryptedKeys = keys.encryptDataKeys(dataKeys)
+
+        cursor.executemany(
+            "INSERT INTO credentials (credentials, label) VALUES (%s, %s)", list(zip(ciphertexts, labels))
+        )
+        cursor.execute(
+            f"SELECT label, cr_id FROM credentials WHERE label IN ({placeholders})", tuple(labels)
+        )
+        crIds = dict(cursor.fetchall())
+        cursor.executemany(
+            "INSERT INTO data_keys (cr_id, data_key, key_iv, cr_iv, master_key) VALUES (%s, %s, %s, %s, %s)",
+            [
+                (crIds[label], encryptedKey.dataKey, encryptedKey.keyIv, encryptedKey.crIv, encryptedKey.masterKey)
+                for label, encryptedKey in zip(labels, encryptedKeys)
+            ],
+        )
+        connection.commit()
+        for label in labels:
+            cn.markWritten(label)
+        return len(labels)
+    except (mysql.connector.Error, keys.HsmError) as e:
+        # Nothing of this chunk has been imported
+        if connection:
+            connection.rollback()
+        for label in valid:
+            fail(label, f"Error: {e}")
+        return 0
+    finally:
+        # Close connection gracefully
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
@@ -1,7 +1,9 @@
 from PyKCS11 import PyKCS11, PyKCS11Lib, CKM_AES_CBC_PAD, CKO_SECRET_KEY
 import mysql.connector
 import os
+import threading
 import connector as cn
+from collections import OrderedDict
 
 
 class DataKey:
@@ -10,65 +12,65 @@ class DataKey:
     in the credentials manager database.
     """
 
-    def __init__(self, dataKey: bytes, keyIv: bytes, crIv: bytes):
+    def __init__(self, dataKey: bytes, keyIv: bytes, crIv: bytes, masterKey: str = None):
         """Constructor for DataKey objects.
 
         Args:
             dataKey (bytes): A true random AES key used for encrypting credentials.
             keyIv (bytes): A true random initialization vector used for encrypting & decrypting the dataKey with the HSM master key.
             crIv (bytes): A true random initialization vector used for encrypting & decrypting credentials with the data key.
+            masterKey (str, optional): Label of the HSM master key the dataKey is encrypted with. Defaults to the configured root key.
         """
         self.dataKey = dataKey
         self.keyIv = keyIv
         self.crIv = crIv
+        self.masterKey = masterKey
 
-    def putKey(self, label):
+    def putKey(self, label, cursor=None):
         """Stores a data key for the credentials with given label in the cm.data_keys table.
 
         Args:
             label (str): Unique label of the credentials this key belongs to.
+            cursor (MySQLCursor, optional): Cursor of the current transaction. Defaults to a transaction of its own.
         """
-        try:
-            # Connect to the MariaDB database
-            connection = mysql.connector.connect(**cn.DBCONFIG)
-            cursor = connection.cursor()
+        if cursor is None:
+            try:
+                with cn.transaction() as cursor:
+                    return self.putKey(label, cursor)
+            except mysql.connector.Error as e:
+                print(e)
+                return
 
-            # Get the cr_id for the given label from the credentials table
-            selectQuery = "SELECT cr_id FROM credentials WHERE label = %s"
-            cursor.execute(selectQuery, (label,))
-            result = cursor.fetchone()
+        # Get the cr_id for the given label and check if it already has a data key, with a single query
+        selectQuery = (
+            "SELECT c.cr_id, d.key_id FROM credentials c LEFT JOIN data_keys d ON d.cr_id = c.cr_id WHERE c.label = %s"
+        )
+        cursor.execute(selectQuery, (label,))
+        result = cursor.fetchone()
 
-            if not result:
-                print("No credentials with this label exist.")
-                return
+        if not result:
+            print("No credentials with this label exist.")
+            return
 
-            crId = result[0]
+        crId, keyId = result
+        if keyId is not None:
+            print("These credentials already have a data key.")
+            return
 
-            # Check if a data key for this cr_id exists already.
-            selectQuery = "SELECT * FROM data_keys WHERE cr_id = %s"
-            cursor.execute(selectQuery, (crId,))
-            result = cursor.fetchone()
+        self.insertKey(crId, cursor)
 
-            if result:
-                print("These credentials already have a data key.")
-                return
+    def insertKey(self, crId, cursor):
+        """Inserts the encrypted data key, key_iv, cr_iv and master key of new credentials into the cm.data_keys table.
 
-            # Insert the  encrypted datakey, key_iv, and cr_id into the data_keys table
-            insertQuery = "INSERT INTO data_keys (cr_id, data_key, key_iv, cr_iv) VALUES (%s, %s, %s, %s)"
-            cursor.execute(
-                insertQuery,
-                (crId, self.dataKey, self.keyIv, self.crIv),
-            )
-            connection.commit()
-
-        except mysql.connector.Error as e:
-            print(e)
-        finally:
-            # Close the cursor and connection
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
+        Args:
+            crId (int): Credentials ID this key belongs to.
+            cursor (MySQLCursor): Cursor of the current transaction.
+        """
+        insertQuery = "INSERT INTO data_keys (cr_id, data_key, key_iv, cr_iv, master_key) VALUES (%s, %s, %s, %s, %s)"
+        cursor.execute(
+            insertQuery,
+            (crId, self.dataKey, self.keyIv, self.crIv, self.masterKey),
+        )
 
     def encryptDataKey(self):
         """Takes a data key as input and encrypts it using the HSM root key.
@@ -79,37 +81,7 @@ class DataKey:
         Returns:
             Datakey: The encrypted key.
         """
-        session = None
-        lib = None
-
-        try:
-            # Load the SoftHSM PKCS11 module & start session
-            lib = PyKCS11Lib()
-            lib.load(cn.HSMCONFIG["pkcs11"])
-            session = lib.openSession(cn.HSMCONFIG["slotId"])
-            session.login(cn.HSMCONFIG["password"])
-
-            # Find the AES Root key
-            aesKey = session.findObjects(
-                [
-                    (PyKCS11.CKA_LABEL, cn.HSMCONFIG["key"]),
-                    (PyKCS11.CKA_CLASS, CKO_SECRET_KEY),
-                ]
-            )[0]
-
-            # Encrypt the key using the AES Root key
-            mechanism = PyKCS11.Mechanism(CKM_AES_CBC_PAD, self.keyIv)
-            encryptedKey = session.encrypt(aesKey, self.dataKey, mechanism)
-
-            return DataKey(bytes(encryptedKey), self.keyIv, self.crIv)
-
-        except Exception as e:
-            raise HsmError(e)
-        finally:
-            # Close session gracefully
-            if session:
-                session.logout()
-                session.closeSession()
+        return encryptDataKeys([self])[0]
 
     def decryptDataKey(self):
         """Takes an encrypted key and an IV as input and decrypts it using the root key token that is stored in the HSM slot.
@@ -120,35 +92,161 @@ class DataKey:
         Returns:
             DataKey: Decrypted Datakey.
         """
-        session = None
-        lib = None
-        try:
-            # Load the SoftHSM PKCS11 module & start session
-            lib = PyKCS11Lib()
-            lib.load(cn.HSMCONFIG["pkcs11"])
-            session = lib.openSession(cn.HSMCONFIG["slotId"])
-            session.login(cn.HSMCONFIG["password"])
-
-            # Find the AES Root key
-            aesKey = session.findObjects(
-                [
-                    (PyKCS11.CKA_LABEL, cn.HSMCONFIG["key"]),
-                    (PyKCS11.CKA_CLASS, CKO_SECRET_KEY),
-                ]
-            )[0]
-
-            # Decrypt the key using the AES Root key
-            mechanism = PyKCS11.Mechanism(CKM_AES_CBC_PAD, self.keyIv)
-            decryptedKey = session.decrypt(aesKey, self.dataKey, mechanism)
-
-            return DataKey(bytes(decryptedKey), self.keyIv, self.crIv)
-        except Exception as e:
-            raise HsmError(e)
-        finally:
-            # Close session gracefully
-            if session:
-                session.logout()
-                session.closeSession()
+        return decryptDataKeys([self])[0]
+
+
+def openHsmSession():
+    """Opens a session with the HSM and finds the AES root key.
+
+    Returns:
+        Session: Logged in PKCS11 session.
+        CK_OBJECT_HANDLE: Handle of the AES root key.
+    """
+    # Don't start HSM work the current request can't wait for anymore
+    cn.remaining()
+
+    # Load the SoftHSM PKCS11 module & start session
+    lib = PyKCS11Lib()
+    lib.load(cn.HSMCONFIG["pkcs11"])
+    session = lib.openSession(cn.HSMCONFIG["slotId"])
+    session.login(cn.HSMCONFIG["password"])
+
+    # Find the AES Root key
+    aesKey = findMasterKey(session, cn.HSMCONFIG["key"])
+    return session, aesKey
+
+
+def findMasterKey(session, label: str):
+    """Finds an AES master key in the HSM.
+
+    Args:
+        session (Session): Logged in PKCS11 session.
+        label (str): Label of the master key, or None for the configured root key.
+
+    Returns:
+        CK_OBJECT_HANDLE: Handle of the master key.
+
+    Raises:
+        HsmError: There is no master key with this label.
+    """
+    label = label or cn.HSMCONFIG["key"]
+    handles = session.findObjects(
+        [
+            (PyKCS11.CKA_LABEL, label),
+            (PyKCS11.CKA_CLASS, CKO_SECRET_KEY),
+        ]
+    )
+    if not handles:
+        raise HsmError(f"There is no master key '{label}'.")
+    return handles[0]
+
+
+def closeHsmSession(session):
+    """Closes an HSM session gracefully.
+
+    Args:
+        session (Session): PKCS11 session, or None.
+    """
+    if session:
+        session.logout()
+        session.closeSession()
+
+
+def encryptDataKeys(dataKeys: list, masterKey: str = None) -> list:
+    """Encrypts several data keys with an HSM master key, in a single HSM session.
+
+    Args:
+        dataKeys (list[DataKey]): Plaintext data keys.
+        masterKey (str, optional): Label of the master key. Defaults to the configured root key.
+
+    Returns:
+        list[DataKey]: Encrypted data keys, in the same order.
+
+    Raises:
+        HsmError: Encryption failed.
+    """
+    session = None
+    masterKey = masterKey or cn.HSMCONFIG["key"]
+    try:
+        session, _ = openHsmSession()
+        aesKey = findMasterKey(session, masterKey)
+        encryptedKeys = []
+        for dataKey in dataKeys:
+            # Encrypt the key using the AES master key
+            mechanism = PyKCS11.Mechanism(CKM_AES_CBC_PAD, dataKey.keyIv)
+            encryptedKey = session.encrypt(aesKey, dataKey.dataKey, mechanism)
+            encryptedKeys.append(DataKey(bytes(encryptedKey), dataKey.keyIv, dataKey.crIv, masterKey))
+        return encryptedKeys
+    except Exception as e:
+        raise HsmError(e)
+    finally:
+        closeHsmSession(session)
+
+
+def decryptDataKeys(dataKeys: list) -> list:
+    """Decrypts several data keys with the HSM master keys they are encrypted with, in a single HSM session.
+
+    Args:
+        dataKeys (list[DataKey]): Encrypted data keys.
+
+    Returns:
+        list[DataKey]: Decrypted data keys, in the same order.
+
+    Raises:
+        HsmError: Decryption failed.
+    """
+    session = None
+    try:
+        session, _ = openHsmSession()
+        aesKeys = {}
+        decryptedKeys = []
+        for dataKey in dataKeys:
+            # Decrypt the key using the AES master key it is encrypted with
+            if dataKey.masterKey not in aesKeys:
+                aesKeys[dataKey.masterKey] = findMasterKey(session, dataKey.masterKey)
+            mechanism = PyKCS11.Mechanism(CKM_AES_CBC_PAD, dataKey.keyIv)
+            decryptedKey = session.decrypt(aesKeys[dataKey.masterKey], dataKey.dataKey, mechanism)
+            decryptedKeys.append(DataKey(bytes(decryptedKey), dataKey.keyIv, dataKey.crIv))
+        return decryptedKeys
+    except Exception as e:
+        raise HsmError(e)
+    finally:
+        closeHsmSession(session)
+
+
+def rewrapDataKeys(dataKeys: list, masterKey: str) -> list:
+    """Re-encrypts several data keys with another HSM master key, in a single HSM session. Every key gets a new
+    key_iv, the decrypted keys never leave this function.
+
+    Args:
+        dataKeys (list[DataKey]): Encrypted data keys.
+        masterKey (str): Label of the new master key.
+
+    Returns:
+        list[DataKey]: Data keys encrypted with the new master key, in the same order.
+
+    Raises:
+        HsmError: Decryption or encryption failed.
+    """
+    session = None
+    try:
+        session, _ = openHsmSession()
+        aesKeys = {masterKey: findMasterKey(session, masterKey)}
+        rewrappedKeys = []
+        for dataKey in dataKeys:
+            if dataKey.masterKey not in aesKeys:
+                aesKeys[dataKey.masterKey] = findMasterKey(session, dataKey.masterKey)
+            mechanism = PyKCS11.Mechanism(CKM_AES_CBC_PAD, dataKey.keyIv)
+            decryptedKey = session.decrypt(aesKeys[dataKey.masterKey], dataKey.dataKey, mechanism)
+            keyIv = generateIv()
+            mechanism = PyKCS11.Mechanism(CKM_AES_CBC_PAD, keyIv)
+            encryptedKey = session.encrypt(aesKeys[masterKey], bytes(decryptedKey), mechanism)
+            rewrappedKeys.append(DataKey(bytes(encryptedKey), keyIv, dataKey.crIv, masterKey))
+        return rewrappedKeys
+    except Exception as e:
+        raise HsmError(e)
+    finally:
+        closeHsmSession(session)
 
 
 def generateAesKey(length=32) -> bytes:
@@ -197,39 +295,163 @@ def generateDataKey() -> DataKey:
     return DataKey(dataKey, keyIv, crIv)
 
 
-def fetchDataKey(crId) -> DataKey:
+class DataKeyCache:
+    """Cache of decrypted data keys by credentials label, which saves an HSM session per request.
+    An entry is only used while the encrypted key in the database is unchanged, so a rotation that hasn't been
+    invalidated yet can't make the cache return a stale key. Entries are invalidated through the change log."""
+
+    def __init__(self, maxEntries: int = 1000):
+        """Constructor for DataKeyCache objects.
+
+        Args:
+            maxEntries (int, optional): Maximum number of cached keys, the least recently used are evicted. Defaults to 1000.
+        """
+        self.maxEntries = maxEntries
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, label: str, encryptedKey: DataKey) -> DataKey:
+        """Returns the cached decrypted data key for a label.
+
+        Args:
+            label (str): Unique credentials label.
+            encryptedKey (DataKey): The encrypted data key currently stored in the database.
+
+        Returns:
+            DataKey: The decrypted data key, or None if it isn't cached (or was cached for another encrypted key).
+        """
+        with self._lock:
+            entry = self._keys.get(label)
+            if entry is None or entry[0] != (encryptedKey.dataKey, encryptedKey.keyIv, encryptedKey.crIv):
+                return None
+            self._keys.move_to_end(label)
+            return entry[1]
+
+    def put(self, label: str, encryptedKey: DataKey, decryptedKey: DataKey):
+        """Caches a decrypted data key.
+
+        Args:
+            label (str): Unique credentials label.
+            encryptedKey (DataKey): The encrypted data key stored in the database.
+            decryptedKey (DataKey): The decrypted data key.
+        """
+        with self._lock:
+            self._keys[label] = ((encryptedKey.dataKey, encryptedKey.keyIv, encryptedKey.crIv), decryptedKey)
+            self._keys.move_to_end(label)
+            if len(self._keys) > self.maxEntries:
+                self._keys.popitem(last=False)
+
+    def entries(self) -> list:
+        """Returns all cached keys.
+
+        Returns:
+            list[tuple]: (label, encrypted DataKey, decrypted DataKey) for every cached key.
+        """
+        with self._lock:
+            return [
+                (label, DataKey(*encrypted), decrypted) for label, (encrypted, decrypted) in self._keys.items()
+            ]
+
+    def invalidate(self, label: str = None):
+        """Removes the key of a label from the cache, or all keys if no label is given.
+
+        Args:
+            label (str, optional): Unique credentials label.
+        """
+        with self._lock:
+            if label is None:
+                self._keys.clear()
+            else:
+                self._keys.pop(label, None)
+
+
+# Decrypted data keys of this process
+CACHE = DataKeyCache()
+
+
+def fetchDataKey(crId, cursor=None, label=None) -> DataKey:
     """Given a credentials id, fetches the corresponding data key object that has been used for encryption.
 
     Args:
         crId (str): credentials Id for the desired data key
+        cursor (MySQLCursor, optional): Cursor of the connection the credentials have been read with. Defaults to a new connection.
+        label (str, optional): Label of the credentials. If given, the decrypted key is cached under this label.
 
     Returns:
         DataKey: The decrypted datakey object.
     """
+    connection = None
     try:
-        connection = mysql.connector.connect(**cn.DBCONFIG)
-        cursor = connection.cursor()
+        if cursor is None:
+            connection = cn.connect(readOnly=True)
+            cursor = connection.cursor()
 
-        selectQuery = "SELECT data_key, key_iv, cr_iv FROM data_keys WHERE cr_id = %s"
+        selectQuery = "SELECT data_key, key_iv, cr_iv, master_key FROM data_keys WHERE cr_id = %s"
         cursor.execute(selectQuery, (crId,))
         result = cursor.fetchone()
         if not result:
             return None
 
         # Convert the fetched values into a DataKey object
-        dataKey, keyIv, crIv = result
-        dataKey = DataKey(dataKey, keyIv, crIv)
+        dataKey, keyIv, crIv, masterKey = result
+        dataKey = DataKey(dataKey, keyIv, crIv, masterKey)
+        if label is not None:
+            decryptedDataKey = CACHE.get(label, dataKey)
+            if decryptedDataKey is not None:
+                return decryptedDataKey
         decryptedDataKey = dataKey.decryptDataKey()
+        if label is not None:
+            CACHE.put(label, dataKey, decryptedDataKey)
         return decryptedDataKey
     except Exception:
         print("Can't fetch encrypted data key.")
     finally:
-        # Close the cursor and connection
+        # Close the cursor and connection, if they have been opened here
+        if connection:
+            cursor.close()
+            connection.close()
+
+
+def prewarm(labels: list) -> int:
+    """Loads the data keys of the given labels into the cache, decrypting all of them in one HSM session.
+
+    Args:
+        labels (list[str]): Credentials labels, e.g. the most requested ones.
+
+    Returns:
+        int: Number of keys that have been decrypted and cached.
+    """
+    if not labels:
+        return 0
+    connection = None
+    cursor = None
+    try:
+        connection = cn.connect(readOnly=True)
+        cursor = connection.cursor()
+        placeholders = ", ".join(["%s"] * len(labels))
+        cursor.execute(
+            "SELECT c.label, d.data_key, d.key_iv, d.cr_iv, d.master_key FROM credentials c "
+            f"JOIN data_keys d ON d.cr_id = c.cr_id WHERE c.label IN ({placeholders})",
+            tuple(labels),
+        )
+        rows = cursor.fetchall()
+    except mysql.connector.Error as e:
+        print(f"Error: {e}")
+        return 0
+    finally:
         if cursor:
             cursor.close()
         if connection:
             connection.close()
 
+    # Keys that are already cached (e.g. restored from a snapshot) don't need the HSM
+    rows = [(label, DataKey(*row)) for label, *row in rows]
+    rows = [(label, encryptedKey) for label, encryptedKey in rows if CACHE.get(label, encryptedKey) is None]
+    decryptedKeys = decryptDataKeys([encryptedKey for _, encryptedKey in rows]) if rows else []
+    for (label, encryptedKey), decryptedKey in zip(rows, decryptedKeys):
+        CACHE.put(label, encryptedKey, decryptedKey)
+    return len(rows)
+
 
 class HsmError(Exception):
     """Exception raised for errors in the hardware security module."""
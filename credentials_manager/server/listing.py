@@ -0,0 +1,216 @@
+"""This module implements the LIST commands of the CM CLI for large stores. Rows are filtered in the database and
+read with keyset pagination (WHERE key > last key ORDER BY key LIMIT n), so every page costs the same, no matter
+how far into the table it is. Listings that combine several queries (UNION ALL) apply the filters, the key and the
+limit to each of them, so that no page needs the whole union. A page is printed as a table together with the
+command for the next page; in streaming mode all rows are read with a single unbuffered query and printed as tab
+separated lines, one chunk at a time, in constant memory."""
+import json
+import base64
+import mysql.connector
+import connector as cn
+from tabulate import tabulate
+
+# Number of rows per page, if no LIMIT is given
+PAGESIZE = 100
+
+# Number of rows read per query in streaming mode
+CHUNKSIZE = 1000
+
+
+class ListOptions:
+    """Filters, page size, position and output mode of a LIST command."""
+
+    def __init__(self, filters: dict = None, limit: int = PAGESIZE, after: tuple = None, stream: bool = False):
+        """Constructor for ListOptions objects.
+
+        Args:
+            filters (dict, optional): Filter by keyword (e.g. LABEL), "*" matches any characters. Defaults to none.
+            limit (int, optional): Number of rows per page. Defaults to PAGESIZE.
+            after (tuple, optional): Key of the last row of the previous page. Defaults to the first page.
+            stream (bool, optional): Print all rows as tab separated lines instead of a page. Defaults to False.
+        """
+        self.filters = filters or {}
+        self.limit = limit
+        self.after = after
+        self.stream = stream
+
+
+def parseOptions(args, filters=()) -> ListOptions:
+    """Parses the arguments of a LIST command: [<filter> value ...] [LIMIT n] [AFTER token] [STREAM].
+
+    Args:
+        args (list[str]): Arguments of the command.
+        filters (tuple[str], optional): Filter keywords the command supports, e.g. ("USER", "LABEL").
+
+    Returns:
+        ListOptions: The parsed options.
+
+    Raises:
+        ValueError: Invalid arguments.
+    """
+    options = ListOptions()
+    args = list(args)
+    while args:
+        keyword = args.pop(0).upper()
+        if keyword == "STREAM":
+            options.stream = True
+            continue
+        if not args:
+            raise ValueError(f"Missing value for {keyword}.")
+        value = args.pop(0)
+        if keyword in filters:
+            options.filters[keyword] = value
+        elif keyword == "LIMIT":
+            options.limit = int(value)
+            if options.limit < 1:
+                raise ValueError("LIMIT must be at least 1.")
+        elif keyword == "AFTER":
+            options.after = decodeToken(value)
+        else:
+            raise ValueError(f"Unknown option {keyword}. Options: {', '.join([*filters, 'LIMIT', 'AFTER', 'STREAM'])}")
+    return options
+
+
+def printListing(command: str, query, keys: tuple, filters: dict, options: ListOptions, headers: list, formatRow=None):
+    """Prints a page of a listing, or all of it in streaming mode.
+
+    Args:
+        command (str): The LIST command, for the hint how to get the next page.
+        query (str | tuple[str]): SELECT statement of the listing, without WHERE, ORDER BY and LIMIT, or several
+            SELECT statements with the same columns, whose rows are combined.
+        keys (tuple[str]): Columns of the query that identify a row, in sort order.
+        filters (dict): Column of the query by filter keyword.
+        options (ListOptions): Options of the command.
+        headers (list[str]): Column headers.
+        formatRow (function, optional): Formats a row for printing.
+    """
+    formatRow = formatRow or (lambda row: row)
+    branches = [query] if isinstance(query, str) else list(query)
+    connection = None
+    cursor = None
+    try:
+        # Connect to the MariaDB database
+        connection = cn.connect()
+
+        if not options.stream:
+            cursor = connection.cursor()
+            rows = _fetchPage(cursor, branches, keys, filters, options, options.limit + 1)
+            print(tabulate([formatRow(row) for row in rows[: options.limit]], headers=headers, tablefmt="psql"))
+            if len(rows) > options.limit:
+                last = _key(cursor, keys, rows[options.limit - 1])
+                print(f"More rows: {command}{_describe(options)} AFTER {encodeToken(last)}")
+            return
+
+        # A single query, whose rows are streamed from the server as they are fetched
+        cursor = connection.cursor(buffered=False)
+        where, params = _where(keys, filters, options)
+        cursor.execute(
+            f"SELECT * FROM ({' UNION ALL '.join(branches)}) AS listing{where} ORDER BY {', '.join(keys)}", params
+        )
+        print("\t".join(headers))
+        while True:
+            rows = cursor.fetchmany(CHUNKSIZE)
+            if not rows:
+                return
+            for row in rows:
+                print("\t".join("" if value is None else str(value) for value in formatRow(row)))
+    except mysql.connector.Error as e:
+        print(f"Error: {e}")
+    finally:
+        # Close connection gracefully
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+
+def _fetchPage(cursor, branches, keys, filters, options, count) -> list:
+    """Fetches the rows of a page. The filters, the key and the limit are applied to every query of the listing,
+    so that each of them only returns the rows the page may need, using its indexes.
+
+    Returns:
+        list[tuple]: Up to count rows.
+    """
+    where, params = _where(keys, filters, options)
+    order = ", ".join(keys)
+    if len(branches) == 1:
+        cursor.execute(f"SELECT * FROM ({branches[0]}) AS listing{where} ORDER BY {order} LIMIT %s", (*params, count))
+        return cursor.fetchall()
+    union = " UNION ALL ".join(
+        f"(SELECT * FROM ({branch}) AS branch{where} ORDER BY {order} LIMIT %s)" for branch in branches
+    )
+    cursor.execute(
+        f"SELECT * FROM ({union}) AS listing ORDER BY {order} LIMIT %s", (*params, count) * len(branches) + (count,)
+    )
+    return cursor.fetchall()
+
+
+def _where(keys, filters, options) -> tuple:
+    """Builds the WHERE clause for the filters of the options and the rows following options.after.
+
+    Returns:
+        str: WHERE clause, or an empty string.
+        tuple: Its parameters.
+    """
+    conditions = []
+    params = []
+    for keyword, value in options.filters.items():
+        conditions.append(f"{filters[keyword]} LIKE %s")
+        params.append(likePattern(value))
+    if options.after is not None:
+        if len(options.after) != len(keys):
+            raise ValueError("Invalid AFTER token.")
+        # Written out column by column, so that the first key column can be used as a range on an index
+        condition = f"{keys[-1]} > %s"
+        afterParams = [options.after[-1]]
+        for key, value in zip(reversed(keys[:-1]), reversed(options.after[:-1])):
+            condition = f"{key} > %s OR ({key} = %s AND ({condition}))"
+            afterParams = [value, value] + afterParams
+        conditions.append(f"({condition})")
+        params.extend(afterParams)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, tuple(params)
+
+
+def _key(cursor, keys, row) -> tuple:
+    """Returns the key columns of a row."""
+    return tuple(row[cursor.column_names.index(key)] for key in keys)
+
+
+def likePattern(value: str) -> str:
+    """Converts a filter into a LIKE pattern, in which only "*" matches any characters.
+
+    Args:
+        value (str): Filter, e.g. billing/*.
+
+    Returns:
+        str: LIKE pattern, e.g. billing/%.
+    """
+    escaped = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped.replace("*", "%")
+
+
+def encodeToken(key: tuple) -> str:
+    """Encodes the key of a row as a token for AFTER."""
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+
+def decodeToken(token: str) -> tuple:
+    """Decodes a token for AFTER.
+
+    Raises:
+        ValueError: Invalid token.
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid AFTER token.")
+    if not isinstance(key, list):
+        raise ValueError("Invalid AFTER token.")
+    return tuple(key)
+
+
+def _describe(options: ListOptions) -> str:
+    """Formats the filters and page size of the options as command arguments."""
+    arguments = "".join(f" {keyword} {value}" for keyword, value in options.filters.items())
+    return arguments + (f" LIMIT {options.limit}" if options.limit != PAGESIZE else "")
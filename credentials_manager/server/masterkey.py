@@ -0,0 +1,133 @@
+"""This module rotates the HSM master key: every data key encrypted with the old master key is decrypted and
+encrypted again with the new one. Credentials themselves aren't touched, as their data keys stay the same.
+
+Data keys are read in batches ordered by key_id, and every batch is re-wrapped in an HSM session of its own by a
+pool of worker threads and updated in one transaction per batch. Every row records the master key it is encrypted with
+(data_keys.master_key), so CM servers keep decrypting every key with the right master key while the rotation runs,
+and an interrupted rotation can simply be started again: it only picks up the rows that still use the old key."""
+import threading
+import mysql.connector
+from concurrent.futures import ThreadPoolExecutor
+import connector as cn
+import keys
+
+# Number of data keys per HSM session and transaction
+BATCHSIZE = 500
+
+# Number of parallel HSM sessions (each worker writes with a pooled database connection, see pool_size)
+WORKERS = 4
+
+
+def rotateMasterKey(oldKey: str, newKey: str, batchSize: int = BATCHSIZE, workers: int = WORKERS) -> tuple:
+    """Re-wraps all data keys from the old master key to the new one. Both keys have to exist in the HSM.
+
+    Args:
+        oldKey (str): Label of the old master key. Rows without a master key use the root key in hsm_config.json.
+        newKey (str): Label of the new master key.
+        batchSize (int, optional): Number of data keys per HSM session and transaction. Defaults to BATCHSIZE.
+        workers (int, optional): Number of parallel HSM sessions. Defaults to WORKERS.
+
+    Returns:
+        int: Number of re-wrapped data keys.
+        int: Number of data keys that couldn't be re-wrapped, or changed while they were being re-wrapped.
+    """
+    if oldKey == newKey:
+        print("The old and the new master key are the same.")
+        return 0, 0
+    # Fail before the first batch if a master key is missing
+    session = None
+    try:
+        session, _ = keys.openHsmSession()
+        keys.findMasterKey(session, oldKey)
+        keys.findMasterKey(session, newKey)
+    except Exception as e:
+        print(f"Error: {e}")
+        return 0, 0
+    finally:
+        keys.closeHsmSession(session)
+
+    counts = {"rewrapped": 0, "skipped": 0}
+    lock = threading.Lock()
+
+    def work(batch):
+        rewrapped, skipped = _rewrapBatch(batch, newKey)
+        with lock:
+            counts["rewrapped"] += rewrapped
+            counts["skipped"] += skipped
+
+    connection = None
+    cursor = None
+    try:
+        # Connect to the MariaDB database
+        connection = cn.connect()
+        cursor = connection.cursor()
+
+        # Rows without a master key were written before master keys were recorded, with the configured root key
+        condition = "master_key = %s"
+        if oldKey == cn.HSMCONFIG["key"]:
+            condition = "(master_key = %s OR master_key IS NULL)"
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            lastId = 0
+            while True:
+                cursor.execute(
+                    "SELECT key_id, data_key, key_iv, cr_iv, master_key FROM data_keys "
+                    f"WHERE {condition} AND key_id > %s ORDER BY key_id LIMIT %s",
+                    (oldKey, lastId, batchSize),
+                )
+                rows = cursor.fetchall()
+                # End the read snapshot, so that keys created in the meantime are found as well
+                connection.commit()
+                if not rows:
+                    break
+                lastId = rows[-1][0]
+                futures.append(executor.submit(work, rows))
+
+                # Keep at most two batches per worker in memory
+                while len(futures) >= 2 * workers:
+                    futures.pop(0).result()
+            for future in futures:
+                future.result()
+    except mysql.connector.Error as e:
+        print(f"Error: {e}")
+    finally:
+        # Close connection gracefully
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+    print(f"Re-wrapped {counts['rewrapped']} data keys with master key '{newKey}', {counts['skipped']} skipped.")
+    if counts["skipped"]:
+        print("Run ROTATE MASTERKEY again to re-wrap the skipped data keys.")
+    return counts["rewrapped"], counts["skipped"]
+
+
+def _rewrapBatch(rows: list, newKey: str) -> tuple:
+    """Re-wraps a batch of data keys in one HSM session and updates them in one transaction. A row is only updated
+    if its data key hasn't changed in the meantime (e.g. by a credentials rotation).
+
+    Args:
+        rows (list[tuple]): (key_id, data_key, key_iv, cr_iv, master_key) of the data keys.
+        newKey (str): Label of the new master key.
+
+    Returns:
+        int: Number of re-wrapped data keys.
+        int: Number of skipped data keys.
+    """
+    try:
+        rewrappedKeys = keys.rewrapDataKeys([keys.DataKey(*row[1:]) for row in rows], newKey)
+        with cn.transaction() as cursor:
+            cursor.executemany(
+                "UPDATE data_keys SET data_key = %s, key_iv = %s, master_key = %s WHERE key_id = %s AND data_key = %s",
+                [
+                    (rewrappedKey.dataKey, rewrappedKey.keyIv, rewrappedKey.masterKey, row[0], row[1])
+                    for row, rewrappedKey in zip(rows, rewrappedKeys)
+                ],
+            )
+            rewrapped = cursor.rowcount
+        return rewrapped, len(rows) - rewrapped
+    except (mysql.connector.Error, keys.HsmError) as e:
+        print(f"Error: {e}")
+        return 0, len(rows)
@@ -0,0 +1,62 @@
+"""This module counts events of the CM server, e.g. connections that were evicted because a client was too slow.
+The counters are kept in memory and printed periodically, so that operators can tell stalled or misbehaving
+clients apart from an overloaded server."""
+import time
+import threading
+from collections import Counter
+
+
+class Counters:
+    """Thread-safe event counters."""
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, amount: int = 1) -> int:
+        """Increases a counter.
+
+        Args:
+            name (str): Name of the counter.
+            amount (int, optional): Amount to add. Defaults to 1.
+
+        Returns:
+            int: The counter's new value.
+        """
+        with self._lock:
+            self._counts[name] += amount
+            return self._counts[name]
+
+    def snapshot(self) -> dict:
+        """Returns the current value of all counters.
+
+        Returns:
+            dict: Counter values by name.
+        """
+        with self._lock:
+            return dict(self._counts)
+
+
+# Counters of the running server
+COUNTERS = Counters()
+
+
+def startReporter(interval: float = 60):
+    """Prints all counters every interval seconds, if they have changed.
+
+    Args:
+        interval (float, optional): Seconds between two reports. Defaults to 60. 0 disables the reports.
+    """
+    if not interval:
+        return
+
+    def report():
+        last = {}
+        while True:
+            time.sleep(interval)
+            counts = COUNTERS.snapshot()
+            if counts != last:
+                print("Counters: " + ", ".join(f"{name}={value}" for name, value in sorted(counts.items())))
+                last = counts
+
+    threading.Thread(target=report, daemon=True).start()
@@ -1,45 +1,142 @@
+import time
+import threading
 import mysql.connector
 import connector as cn
-from tabulate import tabulate
+import versions
+import changes
+import listing
 
+# Name of the permission index in cm.cm_versions
+VERSIONNAME = "permissions"
 
-class Permission:
-    """This class handles the creation of permission objects which grant user access to specific credentials."""
+# Wildcard that ends a prefix permission, e.g. billing/* grants access to all labels starting with billing/
+WILDCARD = "*"
 
-    def __init__(self, uId, crId):
-        """Constructor for permission objects
+
+def isPattern(label: str) -> bool:
+    """Checks if a permission is granted on a label pattern instead of a single label.
+
+    Args:
+        label (str): Credentials label or pattern.
+
+    Returns:
+        bool: True if label is a pattern.
+    """
+    return WILDCARD in label
+
+
+def patternPrefix(pattern: str) -> str:
+    """Returns the prefix of a label pattern.
+
+    Args:
+        pattern (str): Label pattern, e.g. billing/*.
+
+    Returns:
+        str: The prefix all matching labels start with, or None if the pattern is invalid
+            (the wildcard is only allowed once, at the end of the pattern).
+    """
+    if not pattern.endswith(WILDCARD) or pattern.count(WILDCARD) != 1:
+        return None
+    return pattern[: -len(WILDCARD)]
+
+
+class PrefixTrie:
+    """Trie of label prefixes. Checking a label costs O(label length), no matter how many prefixes it holds."""
+
+    # Key marking the end of a prefix, can't clash with a label's characters
+    _END = ""
+
+    def __init__(self, prefixes=()):
+        """Constructor for PrefixTrie objects.
 
         Args:
-            uId (int): User ID for the user that shall be granted access.
-            crId (int): Credentials ID for the credentials to be accessed.
+            prefixes (iterable, optional): Label prefixes. Defaults to ().
         """
-        self.uId = uId
-        self.crId = crId
+        self._root = {}
+        for prefix in prefixes:
+            node = self._root
+            for character in prefix:
+                node = node.setdefault(character, {})
+            node[self._END] = True
 
-    def putPermission(self):
-        try:
-            # Connect to the MariaDB database
-            connection = mysql.connector.connect(**cn.DBCONFIG)
-            cursor = connection.cursor()
+    def matches(self, label: str) -> bool:
+        """Checks if a label starts with one of the trie's prefixes.
 
-            # Check if permission already exists.
-            selectQuery = "SELECT * FROM permissions WHERE uid=%s AND cr_id=%s"
-            cursor.execute(selectQuery, (self.uId, self.crId))
-            result = cursor.fetchone()
-            if result:
-                print("Permission already exists.")
-                return
+        Args:
+            label (str): Credentials label.
+
+        Returns:
+            bool: True if a prefix matches.
+        """
+        node = self._root
+        for character in label:
+            if self._END in node:
+                return True
+            node = node.get(character)
+            if node is None:
+                return False
+        return self._END in node
+
+
+class PermissionIndex:
+    """In-memory index of the effective permissions of every user: the labels and label patterns granted
+    to the user directly or through one of their roles. Effective permissions are precomputed per user,
+    so a permission check is a set lookup plus a walk through the user's prefix trie.
+    Changes made by other processes (e.g. the CM CLI) are noticed by a version check against the database."""
+
+    def __init__(self, checkInterval: float = 2):
+        """Constructor for PermissionIndex objects.
 
-            # Else, Insert the permissions into the table
-            insertQuery = "INSERT INTO permissions (uid, cr_id) VALUES (%s, %s)"
+        Args:
+            checkInterval (float, optional): Minimum seconds between two version checks against the database. Defaults to 2.
+        """
+        self.checkInterval = checkInterval
+        # Direct grants by username
+        self._labels = {}
+        self._patterns = {}
+        # Grants (labels and patterns) and members by role, roles by username
+        self._roleGrants = {}
+        self._roleMembers = {}
+        self._userRoles = {}
+        # Effective permissions by username: (labels, PrefixTrie or None)
+        self._effective = {}
+        self._version = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        """True once the index has been loaded."""
+        return self._version is not None
+
+    def load(self):
+        """Loads all permissions and roles from the CM database."""
+        connection = None
+        cursor = None
+        try:
+            # The index and its version are read in one transaction, possibly from a replica
+            connection = cn.connect(readOnly=True)
+            cursor = connection.cursor()
+            version = versions.fetchVersion(VERSIONNAME, cursor)
             cursor.execute(
-                insertQuery,
-                (self.uId, self.crId),
+                "SELECT u.username, c.label FROM permissions p "
+                "JOIN users u ON u.uid = p.uid JOIN credentials c ON c.cr_id = p.cr_id"
             )
-            connection.commit()
-
+            labels = _group(cursor.fetchall())
+            cursor.execute(
+                "SELECT u.username, pp.pattern FROM permission_patterns pp JOIN users u ON u.uid = pp.uid"
+            )
+            patterns = _group(cursor.fetchall())
+            cursor.execute("SELECT r.name, g.label FROM role_grants g JOIN roles r ON r.role_id = g.role_id")
+            roleGrants = _group(cursor.fetchall())
+            cursor.execute(
+                "SELECT r.name, u.username FROM role_members m "
+                "JOIN roles r ON r.role_id = m.role_id JOIN users u ON u.uid = m.uid"
+            )
+            roleMembers = _group(cursor.fetchall())
         except mysql.connector.Error as e:
             print(f"Error: {e}")
+            return
         finally:
             # Close connection gracefully
             if cursor:
@@ -47,110 +144,412 @@ class Permission:
             if connection:
                 connection.close()
 
+        with self._lock:
+            self._labels, self._patterns = labels, patterns
+            self._roleGrants, self._roleMembers = roleGrants, roleMembers
+            self._userRoles = {}
+            for role, members in roleMembers.items():
+                for username in members:
+                    self._userRoles.setdefault(username, set()).add(role)
+            self._effective = {}
+            for username in set(labels) | set(patterns) | set(self._userRoles):
+                self._rebuild(username)
+            self._version = version
+
+    def refresh(self):
+        """Reloads the index if it has changed. The version is checked at most every checkInterval seconds."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._checked < self.checkInterval:
+                return
+            self._checked = now
+        version = versions.fetchVersion(VERSIONNAME)
+        if version is not None and version != self._version:
+            self.load()
+
+    def invalidate(self, subject: str = None):
+        """Makes the next lookup check the version right away, e.g. because the change log reported a change.
+
+        Args:
+            subject (str, optional): The changed username or role. Unused, the version covers all changes.
+        """
+        self._checked = 0.0
+
+    def check(self, username: str, label: str) -> bool:
+        """Checks if a user may access the credentials with the given label.
+
+        Args:
+            username (str): Unique CM username.
+            label (str): Unique credentials label.
+
+        Returns:
+            bool: True, if user has access.
+        """
+        self.refresh()
+        effective = self._effective.get(username)
+        if effective is None:
+            return False
+        labels, trie = effective
+        return label in labels or (trie is not None and trie.matches(label))
+
+    def _rebuild(self, username: str):
+        """Recomputes the effective permissions of a user. Must be called with the lock held."""
+        labels = set(self._labels.get(username, ()))
+        patterns = set(self._patterns.get(username, ()))
+        for role in self._userRoles.get(username, ()):
+            for grant in self._roleGrants.get(role, ()):
+                (patterns if isPattern(grant) else labels).add(grant)
+        if labels or patterns:
+            self._effective[username] = (frozenset(labels), _compile(patterns) if patterns else None)
+        else:
+            self._effective.pop(username, None)
+
+    def _apply(self, version: int, change):
+        """Applies a change this process has committed, so that it doesn't have to wait for the next reload.
+        Only the effective permissions of the users affected by the change are recomputed.
+        If other changes have been committed in between, the index is reloaded on the next check instead.
+
+        Args:
+            version (int): The index's version after the change.
+            change (function): Function that changes the index in place and returns the affected usernames.
+        """
+        with self._lock:
+            if self._version is None or version is None:
+                return
+            if version != self._version + 1:
+                self._checked = 0.0
+                return
+            for username in set(change()):
+                self._rebuild(username)
+            self._version = version
+
+    def grant(self, username: str, label: str, version: int):
+        """Adds a permission on a label or pattern committed by this process."""
+        grants = self._patterns if isPattern(label) else self._labels
+
+        def change():
+            grants.setdefault(username, set()).add(label)
+            return [username]
+
+        self._apply(version, change)
+
+    def revoke(self, username: str, label: str, version: int):
+        """Removes a permission on a label or pattern deleted by this process."""
+        grants = self._patterns if isPattern(label) else self._labels
+
+        def change():
+            grants.get(username, set()).discard(label)
+            return [username]
+
+        self._apply(version, change)
+
+    def removeUser(self, username: str, version: int):
+        """Removes all permissions and role memberships of a user deleted by this process."""
+
+        def change():
+            self._labels.pop(username, None)
+            self._patterns.pop(username, None)
+            for role in self._userRoles.pop(username, ()):
+                self._roleMembers.get(role, set()).discard(username)
+            return [username]
+
+        self._apply(version, change)
+
+    def removeLabel(self, label: str, version: int):
+        """Removes all direct permissions for credentials deleted by this process."""
+
+        def change():
+            affected = [username for username, labels in self._labels.items() if label in labels]
+            for username in affected:
+                self._labels[username].discard(label)
+            return affected
+
+        self._apply(version, change)
+
+    def grantRole(self, role: str, labels: list, version: int):
+        """Adds labels or patterns to a role, committed by this process."""
+
+        def change():
+            self._roleGrants.setdefault(role, set()).update(labels)
+            return self._roleMembers.get(role, ())
+
+        self._apply(version, change)
+
+    def revokeRole(self, role: str, labels: list, version: int):
+        """Removes labels or patterns from a role, committed by this process."""
+
+        def change():
+            self._roleGrants.get(role, set()).difference_update(labels)
+            return self._roleMembers.get(role, ())
+
+        self._apply(version, change)
+
+    def addMembers(self, role: str, usernames: list, version: int):
+        """Adds users to a role, committed by this process."""
+
+        def change():
+            self._roleMembers.setdefault(role, set()).update(usernames)
+            for username in usernames:
+                self._userRoles.setdefault(username, set()).add(role)
+            return usernames
+
+        self._apply(version, change)
+
+    def removeMembers(self, role: str, usernames: list, version: int):
+        """Removes users from a role, committed by this process."""
+
+        def change():
+            self._roleMembers.get(role, set()).difference_update(usernames)
+            for username in usernames:
+                self._userRoles.get(username, set()).discard(role)
+            return usernames
+
+        self._apply(version, change)
+
+    def removeRole(self, role: str, version: int):
+        """Removes a role deleted by this process."""
+
+        def change():
+            self._roleGrants.pop(role, None)
+            members = self._roleMembers.pop(role, set())
+            for username in members:
+                self._userRoles.get(username, set()).discard(role)
+            return members
+
+        self._apply(version, change)
+
+
+def _group(rows) -> dict:
+    """Groups (key, value) rows into a dictionary of sets."""
+    groups = {}
+    for key, value in rows:
+        groups.setdefault(key, set()).add(value)
+    return groups
+
+
+def _compile(patterns) -> PrefixTrie:
+    """Compiles a user's label patterns into a prefix trie."""
+    return PrefixTrie(patternPrefix(pattern) for pattern in patterns)
+
+
+# Permission index of this process, loaded by the CM server
+INDEX = PermissionIndex()
+
+
+class Permission:
+    """This class handles the creation of permission objects which grant user access to specific credentials."""
+
+    def __init__(self, uId, crId, username=None):
+        """Constructor for permission objects
+
+        Args:
+            uId (int): User ID for the user that shall be granted access.
+            crId (int): Credentials ID for the credentials to be accessed.
+            username (str, optional): Username of the user, recorded in the change log.
+        """
+        self.uId = uId
+        self.crId = crId
+        self.username = username
+
+    def putPermission(self, cursor=None) -> int:
+        """Puts the permission into the cm.permissions table.
+
+        Args:
+            cursor (MySQLCursor, optional): Cursor of the current transaction. Defaults to a transaction of its own.
+
+        Returns:
+            int: The permission index's new version, or None if nothing was inserted.
+        """
+        if cursor is None:
+            try:
+                with cn.transaction() as cursor:
+                    return self.putPermission(cursor)
+            except mysql.connector.Error as e:
+                print(f"Error: {e}")
+                return None
+
+        # Check if permission already exists (unique index on uid & cr_id)
+        selectQuery = "SELECT perm_id FROM permissions WHERE uid=%s AND cr_id=%s"
+        cursor.execute(selectQuery, (self.uId, self.crId))
+        result = cursor.fetchone()
+        if result:
+            print("Permission already exists.")
+            return None
+
+        # Else, Insert the permissions into the table
+        insertQuery = "INSERT INTO permissions (uid, cr_id) VALUES (%s, %s)"
+        cursor.execute(
+            insertQuery,
+            (self.uId, self.crId),
+        )
+        version = versions.bumpVersion(cursor, VERSIONNAME)
+        changes.record(cursor, changes.PERMISSIONS, self.username)
+        return version
+
 
 def createPermission(label, username):
     """Given a credentials label and a credentials manager username,
     tries to create a permission object that grants this user access to the credentials identified by this label.
+    Labels ending with a wildcard (e.g. billing/*) grant access to all credentials whose label starts with the prefix.
 
     Args:
-        label (str): Credentials label.
+        label (str): Credentials label or pattern.
         username (str): Credentials Manager username.
     """
+    if isPattern(label):
+        createPatternPermission(label, username)
+        return
     try:
-        # Connect to the MariaDB database
-        connection = mysql.connector.connect(**cn.DBCONFIG)
-        cursor = connection.cursor()
-
-        # Get the uid for the given username from the users table
-        uId = fetchUid(username)
-
-        # Get the cr_id for the given label from the credentials table
-        crId = fetchCrid(label)
-
-        # Put permission into CM database
-        permission = Permission(uId, crId)
-        permission.putPermission()
+        # Look up the user & credentials and put the permission in a single transaction
+        with cn.transaction() as cursor:
+            uId = fetchUid(username, cursor)
+            crId = fetchCrid(label, cursor)
+            if uId is None or crId is None:
+                return
+            version = Permission(uId, crId, username).putPermission(cursor)
+        if version is None:
+            return
+        INDEX.grant(username, label, version)
         print(f"Granted access to '{label}' for user '{username}'.")
 
     except mysql.connector.Error as e:
         print(f"Error: {e}")
-    finally:
-        # Close connection gracefully
-        if cursor:
-            cursor.close()
-        if connection:
-            connection.close()
 
 
 def deletePermission(label, username):
     """Deletes entry for permission with specified ID from the CM database.
 
     Args:
-        label (str): Unique credentials label.
+        label (str): Unique credentials label or pattern.
         username (str): Unique CM username.
     """
+    if isPattern(label):
+        deletePatternPermission(label, username)
+        return
     try:
-        # Connect to the MariaDB database
-        connection = mysql.connector.connect(**cn.DBCONFIG)
-        cursor = connection.cursor()
+        with cn.transaction() as cursor:
+            uId = fetchUid(username, cursor)
+            crId = fetchCrid(label, cursor)
+            if uId is None or crId is None:
+                return
 
-        # Get the uid for the given username from the users table
-        uId = fetchUid(username)
+            # Delete Permission, if it exists
+            deleteQuery = "DELETE FROM permissions WHERE cr_id = %s AND uid = %s"
+            cursor.execute(deleteQuery, (crId, uId))
+            if not cursor.rowcount:
+                print("Permission doesn't exist.")
+                return
+            version = versions.bumpVersion(cursor, VERSIONNAME)
+            changes.record(cursor, changes.PERMISSIONS, username)
 
-        # Get the cr_id for the given label from the credentials table
-        crId = fetchCrid(label)
+        INDEX.revoke(username, label, version)
+        print(f"Removed access to '{label}' from user '{username}'.")
 
-        # Check if permission exists
-        selectQuery = "SELECT * FROM permissions WHERE cr_id = %s AND uid = %s"
-        cursor.execute(selectQuery, (crId, uId))
-        result = cursor.fetchone()
-        if not result:
-            print("Permission doesn't exist.")
-            return
+    except mysql.connector.Error as e:
+        print(f"Error: {e}")
 
-        # Delete Permission
-        deleteQuery = "DELETE FROM permissions WHERE cr_id = %s AND uid = %s"
-        cursor.execute(deleteQuery, (crId, uId))
 
-        connection.commit()
-        print(f"Removed access to '{label}' from user '{username}'.")
+def createPatternPermission(pattern, username):
+    """Grants a user access to all credentials whose label matches a pattern, including credentials created later.
+
+    Args:
+        pattern (str): Label pattern, e.g. billing/*.
+        username (str): Credentials Manager username.
+    """
+    if patternPrefix(pattern) is None:
+        print(f"Invalid pattern '{pattern}'. Only a single '{WILDCARD}' at the end of the label is supported.")
+        return
+    try:
+        with cn.transaction() as cursor:
+            uId = fetchUid(username, cursor)
+            if uId is None:
+                return
+
+            # Check if permission already exists.
+            selectQuery = "SELECT pattern_id FROM permission_patterns WHERE uid = %s AND pattern = %s"
+            cursor.execute(selectQuery, (uId, pattern))
+            if cursor.fetchone():
+                print("Permission already exists.")
+                return
+
+            insertQuery = "INSERT INTO permission_patterns (uid, pattern) VALUES (%s, %s)"
+            cursor.execute(insertQuery, (uId, pattern))
+            version = versions.bumpVersion(cursor, VERSIONNAME)
+            changes.record(cursor, changes.PERMISSIONS, username)
+
+        INDEX.grant(username, pattern, version)
+        print(f"Granted access to '{pattern}' for user '{username}'.")
 
     except mysql.connector.Error as e:
         print(f"Error: {e}")
-    finally:
-        # Close connection gracefully
-        if cursor:
-            cursor.close()
-        if connection:
-            connection.close()
 
 
-def printPermissions():
-    """Pretty prints content of cm.permissions table.
+def deletePatternPermission(pattern, username):
+    """Removes a user's access to the credentials matching a pattern.
+    Permissions on single labels that match the pattern are kept.
+
+    Args:
+        pattern (str): Label pattern, e.g. billing/*.
+        username (str): Credentials Manager username.
     """
     try:
-        # Connect to the MariaDB database
-        connection = mysql.connector.connect(**cn.DBCONFIG)
-        cursor = connection.cursor()
+        with cn.transaction() as cursor:
+            uId = fetchUid(username, cursor)
+            if uId is None:
+                return
+
+            # Delete the permission, if it exists
+            deleteQuery = "DELETE FROM permission_patterns WHERE uid = %s AND pattern = %s"
+            cursor.execute(deleteQuery, (uId, pattern))
+            if not cursor.rowcount:
+                print("Permission doesn't exist.")
+                return
+            version = versions.bumpVersion(cursor, VERSIONNAME)
+            changes.record(cursor, changes.PERMISSIONS, username)
 
-        # Get result & pretty print
-        cursor.execute("SELECT * FROM permissions")
-        result = cursor.fetchall()
+        INDEX.revoke(username, pattern, version)
+        print(f"Removed access to '{pattern}' from user '{username}'.")
 
-        fields = [i[0] for i in cursor.description]
-        print(tabulate(result, headers=fields, tablefmt="psql"))
     except mysql.connector.Error as e:
         print(f"Error: {e}")
-    finally:
-        # Close connection gracefully
-        if cursor:
-            cursor.close()
-        if connection:
-            connection.close()
+
+
+# Effective permissions of all users: every granted label, and every pattern and role grant together with
+# the labels it currently expands to (an empty label if it doesn't match any). Patterns only end with WILDCARD.
+# Direct permissions, patterns and role grants, each paged on its own by the listing
+_EFFECTIVEQUERY = (
+    "SELECT u.username, c.label AS granted, c.label FROM permissions p "
+    "JOIN users u ON u.uid = p.uid JOIN credentials c ON c.cr_id = p.cr_id",
+    "SELECT u.username, pp.pattern AS granted, COALESCE(c.label, '') AS label FROM permission_patterns pp "
+    "JOIN users u ON u.uid = pp.uid LEFT JOIN credentials c "
+    "ON BINARY LEFT(c.label, CHAR_LENGTH(pp.pattern) - 1) = LEFT(pp.pattern, CHAR_LENGTH(pp.pattern) - 1)",
+    "SELECT u.username, CONCAT(g.label, ' (role ', r.name, ')') AS granted, COALESCE(c.label, '') AS label "
+    "FROM role_grants g JOIN roles r ON r.role_id = g.role_id JOIN role_members m ON m.role_id = g.role_id "
+    "JOIN users u ON u.uid = m.uid LEFT JOIN credentials c ON IF(RIGHT(g.label, 1) = '*', "
+    "BINARY LEFT(c.label, CHAR_LENGTH(g.label) - 1) = LEFT(g.label, CHAR_LENGTH(g.label) - 1), BINARY c.label = g.label)",
+)
+
+
+def printPermissions(options: listing.ListOptions = None):
+    """Pretty prints the effective permissions of users, ordered by username and label. Direct permissions,
+    patterns and roles are read with one query each, which resolves usernames and labels and expands patterns and roles.
+
+    Args:
+        options (ListOptions, optional): USER and LABEL filters, page and output mode. Defaults to the first page.
+    """
+    listing.printListing(
+        "LIST PERMISSIONS",
+        _EFFECTIVEQUERY,
+        ("username", "label", "granted"),
+        {"USER": "username", "LABEL": "label"},
+        options or listing.ListOptions(),
+        ["username", "grant", "label"],
+    )
 
 
 def verifyPermission(username, label) -> bool:
     """Verifies if a user has access to the credentials with the given label.
+    Uses the in-memory permission index if it has been loaded, else the database.
 
     Args:
         username (str): Unique CM username.
@@ -159,23 +558,37 @@ def verifyPermission(username, label) -> bool:
     Returns:
         bool: True, if user has access.
     """
+    if INDEX.loaded:
+        return INDEX.check(username, label)
+
+    connection = None
+    cursor = None
     try:
         # Connect to the MariaDB database
-        connection = mysql.connector.connect(**cn.DBCONFIG)
+        connection = cn.connect(readOnly=True)
         cursor = connection.cursor()
 
-        # fetch uid and crid
-        uId = fetchUid(username)
-        crId = fetchCrid(label)
-
-        selectQuery = "SELECT perm_id FROM permissions WHERE uid = %s AND cr_id = %s"
-        cursor.execute(selectQuery, (uId, crId))
+        selectQuery = (
+            "SELECT p.perm_id FROM permissions p "
+            "JOIN users u ON u.uid = p.uid JOIN credentials c ON c.cr_id = p.cr_id "
+            "WHERE u.username = %s AND c.label = %s"
+        )
+        cursor.execute(selectQuery, (username, label))
         result = cursor.fetchone()
+        if result:
+            return True
 
-        if not result:
-            return False
-        else:
+        # Permissions on patterns and through roles
+        selectQuery = (
+            "SELECT pp.pattern FROM permission_patterns pp JOIN users u ON u.uid = pp.uid WHERE u.username = %s "
+            "UNION SELECT g.label FROM role_grants g JOIN role_members m ON m.role_id = g.role_id "
+            "JOIN users u ON u.uid = m.uid WHERE u.username = %s"
+        )
+        cursor.execute(selectQuery, (username, username))
+        grants = [row[0] for row in cursor.fetchall()]
+        if label in grants:
             return True
+        return _compile(grant for grant in grants if isPattern(grant)).matches(label)
 
     except mysql.connector.Error as e:
         print(f"Error: {e}")
@@ -187,71 +600,55 @@ def verifyPermission(username, label) -> bool:
             connection.close()
 
 
-def fetchUid(username) -> int:
+def fetchUid(username, cursor=None) -> int:
     """Fetches user ID for a given username from the cm.users table.
 
     Args:
         username (str): Unique CM username.
+        cursor (MySQLCursor, optional): Cursor of the current transaction. Defaults to a transaction of its own.
 
     Returns:
         int: CM User ID.
     """
-    try:
-        # Connect to the MariaDB database
-        connection = mysql.connector.connect(**cn.DBCONFIG)
-        cursor = connection.cursor()
-
-        # Get the uid for the given username from the users table
-        selectQuery = "SELECT uid FROM users WHERE username = %s"
-        cursor.execute(selectQuery, (username,))
-        result = cursor.fetchone()
-
-        if not result:
-            print("User doesn't exist.")
-            return None
-        else:
-            uId = result[0]
-            return uId
-    except mysql.connector.Error as e:
-        print(f"Error: {e}")
-    finally:
-        # Close connection gracefully
-        if cursor:
-            cursor.close()
-        if connection:
-            connection.close()
+    return _fetchId("SELECT uid FROM users WHERE username = %s", username, "User doesn't exist.", cursor)
 
 
-def fetchCrid(label) -> int:
+def fetchCrid(label, cursor=None) -> int:
     """Fetches credentials ID for a given credentials label from the cm.credentials table.
 
     Args:
         label (str): Unique credentials label.
+        cursor (MySQLCursor, optional): Cursor of the current transaction. Defaults to a transaction of its own.
 
     Returns:
         int: Credentials ID.
     """
-    try:
-        # Connect to the MariaDB database
-        connection = mysql.connector.connect(**cn.DBCONFIG)
-        cursor = connection.cursor()
+    return _fetchId("SELECT cr_id FROM credentials WHERE label = %s", label, "Credentials don't exist.", cursor)
 
-        # Get the cr_id for the given label from the credentials table
-        selectQuery = "SELECT cr_id FROM credentials WHERE label = %s"
-        cursor.execute(selectQuery, (label,))
-        result = cursor.fetchone()
 
-        if not result:
-            print("Credentials don't exist.")
+def _fetchId(selectQuery, key, missing, cursor=None) -> int:
+    """Fetches an ID by a unique, indexed key.
+
+    Args:
+        selectQuery (str): Query selecting the ID, with the key as placeholder.
+        key (str): Unique key.
+        missing (str): Message printed if there is no such row.
+        cursor (MySQLCursor, optional): Cursor of the current transaction. Defaults to a transaction of its own.
+
+    Returns:
+        int: The ID, or None.
+    """
+    if cursor is None:
+        try:
+            with cn.transaction() as cursor:
+                return _fetchId(selectQuery, key, missing, cursor)
+        except mysql.connector.Error as e:
+            print(f"Error: {e}")
             return None
-        else:
-            crId = result[0]
-            return crId
-    except mysql.connector.Error as e:
-        print(f"Error: {e}")
-    finally:
-        # Close connection gracefully
-        if cursor:
-            cursor.close()
-        if connection:
-            connection.close()
+
+    cursor.execute(selectQuery, (key,))
+    result = cursor.fetchone()
+    if not result:
+        print(missing)
+        return None
+    return result[0]
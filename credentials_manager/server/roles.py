@@ -0,0 +1,276 @@
+"""This module manages roles. Users that need the same credentials become members of a role,
+and the role is granted access to labels or label patterns (e.g. billing/*) once for all of its members.
+All commands work on several users or labels at once, in a single transaction."""
+import mysql.connector
+import connector as cn
+import changes
+import permissions
+import versions
+from tabulate import tabulate
+
+
+def createRole(name):
+    """Creates a new role without members or grants.
+
+    Args:
+        name (str): Unique role name.
+    """
+    connection = None
+    cursor = None
+    try:
+        # Connect to the MariaDB database
+        connection = cn.connect()
+        cursor = connection.cursor()
+
+        if fetchRoleId(cursor, name) is not None:
+            print(f"Role '{name}' already exists.")
+            return
+
+        cursor.execute("INSERT INTO roles (name) VALUES (%s)", (name,))
+        connection.commit()
+        print(f"Created role '{name}'.")
+    except mysql.connector.Error as e:
+        print(f"Error: {e}")
+    finally:
+        # Close connection gracefully
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+
+def deleteRole(name):
+    """Deletes a role. Its members lose all permissions granted through it.
+
+    Args:
+        name (str): Unique role name.
+    """
+    connection = None
+    cursor = None
+    try:
+        # Connect to the MariaDB database
+        connection = cn.connect()
+        cursor = connection.cursor()
+
+        if fetchRoleId(cursor, name) is None:
+            print(f"Role '{name}' doesn't exist.")
+            return
+
+        # Grants and memberships are deleted along with the role
+        cursor.execute("DELETE FROM roles WHERE name = %s", (name,))
+        version = versions.bumpVersion(cursor, permissions.VERSIONNAME)
+        changes.record(cursor, changes.PERMISSIONS, name)
+        connection.commit()
+        permissions.INDEX.removeRole(name, version)
+        print(f"Deleted role '{name}'.")
+    except mysql.connector.Error as e:
+        print(f"Error: {e}")
+    finally:
+        # Close connection gracefully
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+
+def grantRole(name, labels):
+    """Grants a role access to credentials labels or label patterns.
+
+    Args:
+        name (str): Unique role name.
+        labels (list[str]): Credentials labels or patterns (e.g. billing/*).
+    """
+    invalid = [label for label in labels if permissions.isPattern(label) and permissions.patternPrefix(label) is None]
+    if invalid:
+        print(f"Invalid patterns: {', '.join(invalid)}. Only a single '{permissions.WILDCARD}' at the end of the label is supported.")
+        return
+    _changeRole(
+        name,
+        "INSERT IGNORE INTO role_grants (role_id, label) VALUES (%s, %s)",
+        labels,
+        permissions.INDEX.grantRole,
+        f"Granted role '{name}' access to {len(labels)} label(s).",
+    )
+
+
+def revokeRole(name, labels):
+    """Removes a role's access to credentials labels or label patterns.
+
+    Args:
+        name (str): Unique role name.
+        labels (list[str]): Credentials labels or patterns, as they have been granted.
+    """
+    _changeRole(
+        name,
+        "DELETE FROM role_grants WHERE role_id = %s AND label = %s",
+        labels,
+        permissions.INDEX.revokeRole,
+        f"Removed access to {len(labels)} label(s) from role '{name}'.",
+    )
+
+
+def addMembers(name, usernames):
+    """Adds users to a role.
+
+    Args:
+        name (str): Unique role name.
+        usernames (list[str]): Unique CM usernames.
+    """
+    _changeMembers(
+        name,
+        "INSERT IGNORE INTO role_members (role_id, uid) VALUES (%s, %s)",
+        usernames,
+        permissions.INDEX.addMembers,
+        f"Added {{}} user(s) to role '{name}'.",
+    )
+
+
+def removeMembers(name, usernames):
+    """Removes users from a role.
+
+    Args:
+        name (str): Unique role name.
+        usernames (list[str]): Unique CM usernames.
+    """
+    _changeMembers(
+        name,
+        "DELETE FROM role_members WHERE role_id = %s AND uid = %s",
+        usernames,
+        permissions.INDEX.removeMembers,
+        f"Removed {{}} user(s) from role '{name}'.",
+    )
+
+
+def _changeRole(name, query, labels, apply, message):
+    """Executes a query for each label of a role in one transaction and updates the permission index.
+
+    Args:
+        name (str): Unique role name.
+        query (str): Query with the placeholders role_id and label.
+        labels (list[str]): Credentials labels or patterns.
+        apply (function): PermissionIndex method applying the change.
+        message (str): Message printed on success.
+    """
+    if not labels:
+        print("No labels given.")
+        return
+    connection = None
+    cursor = None
+    try:
+        # Connect to the MariaDB database
+        connection = cn.connect()
+        cursor = connection.cursor()
+
+        roleId = fetchRoleId(cursor, name)
+        if roleId is None:
+            print(f"Role '{name}' doesn't exist.")
+            return
+
+        cursor.executemany(query, [(roleId, label) for label in labels])
+        version = versions.bumpVersion(cursor, permissions.VERSIONNAME)
+        changes.record(cursor, changes.PERMISSIONS, name)
+        connection.commit()
+        apply(name, labels, version)
+        print(message)
+    except mysql.connector.Error as e:
+        print(f"Error: {e}")
+    finally:
+        # Close connection gracefully
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+
+def _changeMembers(name, query, usernames, apply, message):
+    """Executes a query for each member of a role in one transaction and updates the permission index.
+
+    Args:
+        name (str): Unique role name.
+        query (str): Query with the placeholders role_id and uid.
+        usernames (list[str]): Unique CM usernames.
+        apply (function): PermissionIndex method applying the change.
+        message (str): Message printed on success, formatted with the number of users.
+    """
+    if not usernames:
+        print("No users given.")
+        return
+    connection = None
+    cursor = None
+    try:
+        # Connect to the MariaDB database
+        connection = cn.connect()
+        cursor = connection.cursor()
+
+        roleId = fetchRoleId(cursor, name)
+        if roleId is None:
+            print(f"Role '{name}' doesn't exist.")
+            return
+
+        # Resolve all usernames with a single query
+        placeholders = ", ".join(["%s"] * len(usernames))
+        cursor.execute(f"SELECT username, uid FROM users WHERE username IN ({placeholders})", tuple(usernames))
+        uIds = dict(cursor.fetchall())
+        unknown = [username for username in usernames if username not in uIds]
+        if unknown:
+            print(f"Users don't exist: {', '.join(unknown)}")
+            return
+
+        cursor.executemany(query, [(roleId, uIds[username]) for username in usernames])
+        version = versions.bumpVersion(cursor, permissions.VERSIONNAME)
+        changes.record(cursor, changes.PERMISSIONS, name)
+        connection.commit()
+        apply(name, usernames, version)
+        print(message.format(len(usernames)))
+    except mysql.connector.Error as e:
+        print(f"Error: {e}")
+    finally:
+        # Close connection gracefully
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+
+def printRoles():
+    """Pretty prints all roles with their members and grants."""
+    connection = None
+    cursor = None
+    try:
+        # Connect to the MariaDB database
+        connection = cn.connect()
+        cursor = connection.cursor()
+
+        cursor.execute(
+            "SELECT r.name, "
+            "(SELECT GROUP_CONCAT(u.username ORDER BY u.username SEPARATOR ', ') FROM role_members m "
+            "JOIN users u ON u.uid = m.uid WHERE m.role_id = r.role_id), "
+            "(SELECT GROUP_CONCAT(g.label ORDER BY g.label SEPARATOR ', ') FROM role_grants g "
+            "WHERE g.role_id = r.role_id) "
+            "FROM roles r ORDER BY r.name"
+        )
+        result = cursor.fetchall()
+        print(tabulate(result, headers=["role", "members", "grants"], tablefmt="psql"))
+    except mysql.connector.Error as e:
+        print(f"Error: {e}")
+    finally:
+        # Close connection gracefully
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+
+def fetchRoleId(cursor, name) -> int:
+    """Fetches the role ID for a given role name from the cm.roles table.
+
+    Args:
+        cursor (MySQLCursor): Cursor of the current transaction.
+        name (str): Unique role name.
+
+    Returns:
+        int: Role ID, or None if the role doesn't exist.
+    """
+    cursor.execute("SELECT role_id FROM roles WHERE name = %s", (name,))
+    result = cursor.fetchone()
+    return result[0] if result else None
@@ -4,6 +4,7 @@ import mysql.connector
 import credentials as cr
 import crypto
 import keys
+import changes
 
 
 def rotationHandler(label, password=None):
@@ -194,7 +195,7 @@ def updateCredentialsAndDatakey(
     """
     try:
         # Connect to the MariaDB database
-        connection = mysql.connector.connect(**cn.DBCONFIG)
+        connection = cn.connect()
         cursor = connection.cursor()
 
         # Update the credentials for the given label
@@ -210,19 +211,22 @@ def updateCredentialsAndDatakey(
         crId = result[0]
 
         # Update the data key for the given cr_id
-        updateDataKeyQuery = "UPDATE data_keys SET data_key = %s, key_iv = %s, cr_iv = %s WHERE cr_id = %s"
+        updateDataKeyQuery = "UPDATE data_keys SET data_key = %s, key_iv = %s, cr_iv = %s, master_key = %s WHERE cr_id = %s"
         cursor.execute(
             updateDataKeyQuery,
             (
                 newDataKey.dataKey,
                 newDataKey.keyIv,
                 newDataKey.crIv,
+                newDataKey.masterKey,
                 crId,
             ),
         )
+        changes.record(cursor, changes.CREDENTIALS, label)
 
-        # Commit the changes
+        # Let the CM servers know, commit the changes, and read them from the primary until the replicas have caught up
         connection.commit()
+        cn.markWritten(label)
     except Exception:
         raise RotationError("Can't update credentials or data key.")
     finally:
@@ -0,0 +1,135 @@
+"""This module implements short-lived session tokens for CM clients. A client verifies its password once
+with an AUTH request and receives a token, which it presents instead of its password in all following packets.
+Tokens are signed with HMAC-SHA256 and bound to the client's certificate, so validating them needs neither
+the CM database nor bcrypt."""
+import os
+import json
+import time
+import hmac
+import base64
+import hashlib
+
+
+class SessionManager:
+    """Issues and validates session tokens."""
+
+    def __init__(self, key: bytes, ttl: int = 300):
+        """Constructor for SessionManager objects.
+
+        Args:
+            key (bytes): Secret HMAC key. CM servers that share a key accept each other's tokens.
+            ttl (int, optional): Lifetime of a token in seconds. Defaults to 300.
+        """
+        self.key = key
+        self.ttl = ttl
+        # Time of the last revocation by username
+        self._revoked = {}
+
+    def _sign(self, payload: bytes) -> bytes:
+        return hmac.new(self.key, payload, hashlib.sha256).digest()
+
+    def issueToken(self, username: str, fingerprint: str) -> str:
+        """Issues a token for an authenticated user.
+
+        Args:
+            username (str): Unique CM username.
+            fingerprint (str): SHA-256 fingerprint of the client's certificate.
+
+        Returns:
+            str: Session token.
+        """
+        payload = json.dumps(
+            {"u": username, "f": fingerprint, "e": int(time.time()) + self.ttl},
+            separators=(",", ":"),
+        ).encode()
+        return f"{_encode(payload)}.{_encode(self._sign(payload))}"
+
+    def revoke(self, username: str):
+        """Revokes all tokens issued to a user until now, e.g. because the user has been deleted.
+
+        Args:
+            username (str): Unique CM username.
+        """
+        now = time.time()
+        # Revocations older than a token's lifetime don't matter anymore
+        revoked = {user: at for user, at in self._revoked.items() if at > now - self.ttl}
+        revoked[username] = now
+        self._revoked = revoked
+
+    def validateToken(self, token: str, fingerprint: str) -> str:
+        """Validates a token presented by a client.
+
+        Args:
+            token (str): Session token.
+            fingerprint (str): SHA-256 fingerprint of the certificate of the connection the token was sent over.
+
+        Returns:
+            str: The token's username, or None if the token is invalid, expired, revoked or bound to another certificate.
+        """
+        return self.checkToken(token, fingerprint)[0]
+
+    def checkToken(self, token: str, fingerprint: str) -> tuple:
+        """Validates a token presented by a client, and tells stale tokens apart from forged or stolen ones.
+
+        Args:
+            token (str): Session token.
+            fingerprint (str): SHA-256 fingerprint of the certificate of the connection the token was sent over.
+
+        Returns:
+            str: The token's username, or None if the token isn't valid.
+            bool: True if the token was issued by this server for this certificate, but has expired or been revoked.
+        """
+        try:
+            payload, signature = token.split(".")
+            payload, signature = _decode(payload), _decode(signature)
+            if not hmac.compare_digest(signature, self._sign(payload)):
+                return None, False
+            claims = json.loads(payload)
+            if not hmac.compare_digest(claims["f"], fingerprint):
+                return None, False
+            if claims["e"] < time.time():
+                return None, True
+            revoked = self._revoked.get(claims["u"])
+            if revoked is not None and claims["e"] - self.ttl < revoked:
+                return None, True
+            return claims["u"], False
+        except (ValueError, TypeError, KeyError):
+            return None, False
+
+
+def certificateFingerprint(sslSocket) -> str:
+    """Returns the SHA-256 fingerprint of the peer certificate of a TLS connection.
+
+    Args:
+        sslSocket (SSLSocket): Connection with a verified client certificate.
+
+    Returns:
+        str: Hex encoded fingerprint.
+    """
+    return hashlib.sha256(sslSocket.getpeercert(binary_form=True)).hexdigest()
+
+
+def loadKey(path: str) -> bytes:
+    """Loads the HMAC key for session tokens. If the key file doesn't exist yet, a random key is created.
+
+    Args:
+        path (str): Path to the key file.
+
+    Returns:
+        bytes: Secret HMAC key.
+    """
+    if not os.path.exists(path):
+        # Only the server's user may read the key
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(os.urandom(32))
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
@@ -0,0 +1,172 @@
+"""This module writes and restores snapshots of the data key cache, so that a restarted CM server is warm
+without decrypting every key with the HSM again. A snapshot is encrypted with AES-GCM under a random snapshot key,
+which is itself encrypted with the HSM root key. Restoring it costs one HSM call. Snapshots expire, can't be
+tampered with unnoticed, and only keys that still match the data_keys table are restored."""
+import os
+import json
+import time
+import base64
+import mysql.connector
+import connector as cn
+import keys
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# Version of the snapshot file format
+FORMAT = 2
+
+
+def write(path: str, ttl: int = 600) -> int:
+    """Writes a snapshot of the data key cache. Only the server's user may read the file.
+
+    Args:
+        path (str): Path of the snapshot file.
+        ttl (int, optional): Seconds the snapshot may be restored from. Defaults to 600.
+
+    Returns:
+        int: Number of keys in the snapshot.
+
+    Raises:
+        HsmError: The snapshot key couldn't be encrypted.
+    """
+    entries = keys.CACHE.entries()
+    if not entries:
+        return 0
+
+    # Random snapshot key, only the HSM can decrypt it again
+    snapshotKey = AESGCM.generate_key(bit_length=256)
+    wrappedKey = keys.DataKey(snapshotKey, keys.generateIv(), b"").encryptDataKey()
+
+    header = {
+        "format": FORMAT,
+        "expires": int(time.time()) + ttl,
+        "wrapped_key": _encode(wrappedKey.dataKey),
+        "key_iv": _encode(wrappedKey.keyIv),
+        "master_key": wrappedKey.masterKey,
+        "nonce": _encode(os.urandom(12)),
+    }
+    plaintext = json.dumps(
+        [
+            {
+                "label": label,
+                "encrypted_key": _encode(encrypted.dataKey),
+                "key_iv": _encode(encrypted.keyIv),
+                "cr_iv": _encode(encrypted.crIv),
+                "key": _encode(decrypted.dataKey),
+            }
+            for label, encrypted, decrypted in entries
+        ]
+    ).encode()
+    # The header is authenticated as well, so that the expiry can't be changed
+    ciphertext = AESGCM(snapshotKey).encrypt(_decode(header["nonce"]), plaintext, _aad(header))
+
+    temporary = f"{path}.tmp"
+    fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump({**header, "ciphertext": _encode(ciphertext)}, f)
+    os.replace(temporary, path)
+    return len(entries)
+
+
+def restore(path: str) -> int:
+    """Restores a snapshot into the data key cache and deletes it. Keys whose encrypted form in the data_keys
+    table has changed since the snapshot was written (e.g. by a rotation) are skipped.
+
+    Args:
+        path (str): Path of the snapshot file.
+
+    Returns:
+        int: Number of restored keys. 0 if there is no snapshot, or it is expired or invalid.
+    """
+    if not os.path.exists(path):
+        return 0
+    try:
+        with open(path, "r") as f:
+            snapshot = json.load(f)
+    finally:
+        # A snapshot is only restored once
+        os.remove(path)
+
+    header = {key: snapshot.get(key) for key in ("format", "expires", "wrapped_key", "key_iv", "master_key", "nonce")}
+    if header["format"] != FORMAT or not isinstance(header["expires"], int):
+        print("Invalid cache snapshot.")
+        return 0
+    if header["expires"] < time.time():
+        print("Cache snapshot expired.")
+        return 0
+
+    try:
+        wrappedKey = keys.DataKey(
+            _decode(header["wrapped_key"]), _decode(header["key_iv"]), b"", header["master_key"]
+        )
+        snapshotKey = wrappedKey.decryptDataKey().dataKey
+        plaintext = AESGCM(snapshotKey).decrypt(
+            _decode(header["nonce"]), _decode(snapshot.get("ciphertext") or ""), _aad(header)
+        )
+    except (InvalidTag, TypeError, ValueError, keys.HsmError) as e:
+        print(f"Invalid cache snapshot: {e!r}")
+        return 0
+    entries = json.loads(plaintext)
+
+    # Only restore keys that are still current
+    current = _fetchEncryptedKeys([entry["label"] for entry in entries])
+    restored = 0
+    for entry in entries:
+        encrypted = keys.DataKey(_decode(entry["encrypted_key"]), _decode(entry["key_iv"]), _decode(entry["cr_iv"]))
+        stored = current.get(entry["label"])
+        if stored is None or (stored.dataKey, stored.keyIv, stored.crIv) != (
+            encrypted.dataKey,
+            encrypted.keyIv,
+            encrypted.crIv,
+        ):
+            continue
+        decrypted = keys.DataKey(_decode(entry["key"]), encrypted.keyIv, encrypted.crIv)
+        keys.CACHE.put(entry["label"], encrypted, decrypted)
+        restored += 1
+    return restored
+
+
+def _fetchEncryptedKeys(labels: list) -> dict:
+    """Fetches the encrypted data keys of the given labels.
+
+    Args:
+        labels (list[str]): Credentials labels.
+
+    Returns:
+        dict: Encrypted DataKey by label.
+    """
+    if not labels:
+        return {}
+    connection = None
+    cursor = None
+    try:
+        connection = cn.connect(readOnly=True)
+        cursor = connection.cursor()
+        placeholders = ", ".join(["%s"] * len(labels))
+        cursor.execute(
+            "SELECT c.label, d.data_key, d.key_iv, d.cr_iv FROM credentials c "
+            f"JOIN data_keys d ON d.cr_id = c.cr_id WHERE c.label IN ({placeholders})",
+            tuple(labels),
+        )
+        return {label: keys.DataKey(bytes(dataKey), bytes(keyIv), bytes(crIv)) for label, dataKey, keyIv, crIv in cursor}
+    except mysql.connector.Error as e:
+        print(f"Error: {e}")
+        return {}
+    finally:
+        # Close connection gracefully
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+
+def _aad(header: dict) -> bytes:
+    return json.dumps(header, sort_keys=True).encode()
+
+
+def _encode(data: bytes) -> str:
+    return base64.b64encode(bytes(data)).decode()
+
+
+def _decode(data: str) -> bytes:
+    return base64.b64decode(data)
@@ -0,0 +1,104 @@
+"""This module counts how often the credentials of every label are requested. The counters are kept in memory
+and flushed to the cm.label_stats table periodically, in one batch. At startup, the CM server uses these
+statistics to prewarm its caches with the most requested labels before it accepts traffic."""
+import time
+import threading
+import mysql.connector
+import connector as cn
+from collections import Counter
+
+
+class AccessStats:
+    """Per-label access counters."""
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, label: str):
+        """Counts a request for the credentials with the given label.
+
+        Args:
+            label (str): Unique credentials label.
+        """
+        with self._lock:
+            self._counts[label] += 1
+
+    def flush(self):
+        """Adds the counters to the cm.label_stats table and resets them.
+        If the database can't be reached, the counters are kept for the next flush."""
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+        if not counts:
+            return
+
+        connection = None
+        cursor = None
+        try:
+            connection = cn.connect()
+            cursor = connection.cursor()
+            cursor.executemany(
+                "INSERT INTO label_stats (label, accesses, last_access) VALUES (%s, %s, NOW()) "
+                "ON DUPLICATE KEY UPDATE accesses = accesses + VALUES(accesses), last_access = NOW()",
+                list(counts.items()),
+            )
+            connection.commit()
+        except mysql.connector.Error as e:
+            print(f"Error: {e}")
+            with self._lock:
+                self._counts.update(counts)
+        finally:
+            # Close connection gracefully
+            if cursor:
+                cursor.close()
+            if connection:
+                connection.close()
+
+    def start(self, interval: float = 60):
+        """Flushes the counters every interval seconds in a background thread.
+
+        Args:
+            interval (float, optional): Seconds between two flushes. Defaults to 60.
+        """
+
+        def flush():
+            while True:
+                time.sleep(interval)
+                self.flush()
+
+        threading.Thread(target=flush, daemon=True).start()
+
+
+def topLabels(count: int) -> list:
+    """Fetches the most requested labels that still exist.
+
+    Args:
+        count (int): Maximum number of labels.
+
+    Returns:
+        list[str]: Labels, the most requested first.
+    """
+    connection = None
+    cursor = None
+    try:
+        connection = cn.connect(readOnly=True)
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT s.label FROM label_stats s JOIN credentials c ON c.label = s.label "
+            "ORDER BY s.accesses DESC LIMIT %s",
+            (count,),
+        )
+        return [row[0] for row in cursor.fetchall()]
+    except mysql.connector.Error as e:
+        print(f"Error: {e}")
+        return []
+    finally:
+        # Close connection gracefully
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()
+
+
+# Access counters of this process
+STATS = AccessStats()
@@ -1,8 +1,13 @@
-import bcrypt
+import hmac
 import mysql.connector
 import connector as cn
 import crypto
-from tabulate import tabulate
+import hashing
+import identities
+import changes
+import permissions
+import versions
+import listing
 
 
 class cmUser:
@@ -18,119 +23,144 @@ class cmUser:
         self.cmUsername = cmUsername
         self.cmPassword = cmPassword
 
-    def fetchUser(self) -> bool:
+    def fetchUser(self, cursor=None) -> bool:
         """Checks if a user exists in the CM database.
 
+        Args:
+            cursor (MySQLCursor, optional): Cursor of the current transaction. Defaults to a transaction of its own.
+
         Returns:
             bool: True if user exists.
         """
-        try:
-            # Connect to the MariaDB database
-            connection = mysql.connector.connect(**cn.DBCONFIG)
-            cursor = connection.cursor()
-
-            # Get the salt and hashed password from the database for the given username
-            selectQuery = "SELECT * FROM users WHERE username = %s"
-            cursor.execute(selectQuery, (self.cmUsername,))
-            result = cursor.fetchone()
-
-            # If user doesn't exist
-            if not result:
+        if cursor is None:
+            try:
+                with cn.transaction() as cursor:
+                    return self.fetchUser(cursor)
+            except mysql.connector.Error as e:
+                print(f"Error: {e}")
                 return False
-            else:
-                return True
-        except mysql.connector.Error as e:
-            print(f"Error: {e}")
-            return False
-        finally:
-            # Close connection gracefully
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
 
-    def putUser(self, salt, hashedPassword):
+        # Look the username up in its unique index
+        selectQuery = "SELECT 1 FROM users WHERE username = %s"
+        cursor.execute(selectQuery, (self.cmUsername,))
+        return cursor.fetchone() is not None
+
+    def putUser(self, salt, hashedPassword, cursor=None):
         """Function to store the cmUser, salt and password in the credentials_manager.users table
 
         Args:
             salt (bytes): Salt that was used to create salted and hashed password.
             hashedPassword (bytes): A salted and hashed password
+            cursor (MySQLCursor, optional): Cursor of the current transaction. Defaults to a transaction of its own.
+
+        Returns:
+            bool: True if the user has been inserted.
         """
-        try:
-            # Connect to the MariaDB database
-            connection = mysql.connector.connect(**cn.DBCONFIG)
-            cursor = connection.cursor()
+        if cursor is None:
+            try:
+                with cn.transaction() as cursor:
+                    return self.putUser(salt, hashedPassword, cursor)
+            except mysql.connector.Error as e:
+                print(f"Error: {e}")
+                return False
 
-            # Check if user already exsists:
-            if self.fetchUser():
-                print(f"User '{self.cmUsername}' already exists.")
-                return
+        # Check if user already exsists:
+        if self.fetchUser(cursor):
+            print(f"User '{self.cmUsername}' already exists.")
+            return False
 
-            # Else, Insert the user and their salted/hashed password into the table
-            insertQuery = (
-                "INSERT INTO users (username, salt, password) VALUES (%s, %s, %s)"
-            )
-            cursor.execute(insertQuery, (self.cmUsername, salt, hashedPassword))
-            connection.commit()
-
-        except mysql.connector.Error as e:
-            print(f"Error: {e}")
-        finally:
-            # Close the cursor and connection
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
+        # Else, Insert the user and their salted/hashed password into the table
+        insertQuery = (
+            "INSERT INTO users (username, salt, password) VALUES (%s, %s, %s)"
+        )
+        cursor.execute(insertQuery, (self.cmUsername, salt, hashedPassword))
+        return True
 
     def deleteUser(self):
         """Deletes the cmUser from the cm.users table"""
         try:
-            # Connect to the MariaDB database
-            connection = mysql.connector.connect(**cn.DBCONFIG)
-            cursor = connection.cursor()
-
-            # Check if user already exsists:
-            if not self.fetchUser():
-                print(f"User '{self.cmUsername}' doesn't exist.")
-                return
+            with cn.transaction() as cursor:
+                # Delete the user and their salted/hashed password from the table, if they exist
+                deleteQuery = "DELETE FROM users WHERE username = %s;"
+                cursor.execute(deleteQuery, (self.cmUsername,))
+                if not cursor.rowcount:
+                    print(f"User '{self.cmUsername}' doesn't exist.")
+                    return
+                versions.bumpVersion(cursor, identities.VERSIONNAME)
+                # The user's permissions are deleted along with them
+                version = versions.bumpVersion(cursor, permissions.VERSIONNAME)
+                changes.record(cursor, changes.USER, self.cmUsername)
+
+            permissions.INDEX.removeUser(self.cmUsername, version)
+            print(f"Deleted User {self.cmUsername}")
+        except mysql.connector.Error as e:
+            print(f"Error: {e}")
 
-            # Delete the user and their salted/hashed password from the table
-            insertQuery = "DELETE FROM users WHERE username = %s;"
-            cursor.execute(insertQuery, (self.cmUsername,))
-            connection.commit()
+    def setAuthMode(self, authMode: str, fingerprint: str = None, subject: str = None):
+        """Sets how the user is authenticated. In "password" mode the user authenticates with their password,
+        in "certificate" mode by the client certificate with the given fingerprint or subject.
 
-            print(f"Deleted User {self.cmUsername}")
+        Args:
+            authMode (str): "password" or "certificate".
+            fingerprint (str, optional): SHA-256 fingerprint of the user's client certificate.
+            subject (str, optional): RFC 4514 subject of the user's client certificate.
+        """
+        if authMode not in identities.AUTHMODES:
+            print(f"Invalid auth mode '{authMode}'.")
+            return
+        try:
+            with cn.transaction() as cursor:
+                # Check if user exsists:
+                if not self.fetchUser(cursor):
+                    print(f"User '{self.cmUsername}' doesn't exist.")
+                    return
+
+                # Update the user's auth mode & certificate, and let the CM servers know
+                updateQuery = "UPDATE users SET auth_mode = %s, cert_fingerprint = %s, cert_subject = %s WHERE username = %s"
+                cursor.execute(updateQuery, (authMode, fingerprint, subject, self.cmUsername))
+                versions.bumpVersion(cursor, identities.VERSIONNAME)
+                changes.record(cursor, changes.USER, self.cmUsername)
+
+            print(f"Set auth mode of user '{self.cmUsername}' to '{authMode}'.")
         except mysql.connector.Error as e:
             print(f"Error: {e}")
-        finally:
-            # Close the cursor and connection
-            if cursor:
-                cursor.close()
-            if connection:
-                connection.close()
 
     def createUser(self):
-        """Creates a new entry in the cm.users table."""
-        # Check if user already exsits
-        if self.fetchUser():
-            print(f"User '{self.cmUsername}' already exists.")
-        else:
-            tuple = crypto.hashAndSaltPassword(self.cmPassword)
-            salt = tuple[0]
-            hashedPassword = tuple[1]
-            self.putUser(salt, hashedPassword)
+        """Creates a new entry in the cm.users table. The password is hashed before the transaction is opened,
+        so the transaction doesn't hold its connection and locks while bcrypt runs."""
+        try:
+            # Check if user already exsits, before the password is hashed
+            if self.fetchUser():
+                print(f"User '{self.cmUsername}' already exists.")
+                return
+            salt, hashedPassword = crypto.hashAndSaltPassword(self.cmPassword)
+
+            with cn.transaction() as cursor:
+                # The user may have been created while the password was hashed
+                if self.fetchUser(cursor):
+                    print(f"User '{self.cmUsername}' already exists.")
+                    return
+                if not self.putUser(salt, hashedPassword, cursor):
+                    return
 
             print(f"Created user {self.cmUsername}")
+        except mysql.connector.Error as e:
+            print(f"Error: {e}")
 
     def authenticateUser(self) -> bool:
         """Takes in a user and and tries to authenticate them by comparing their password to the corresponding stored salted hash.
 
         Returns:
             bool: True if authentication successful.
+
+        Raises:
+            HashingBusy: The hashing pool is overloaded.
         """
+        connection = None
+        cursor = None
         try:
-            # Connect to the MariaDB database
-            connection = mysql.connector.connect(**cn.DBCONFIG)
+            # Connect to the MariaDB database (a read replica, if there is one)
+            connection = cn.connect(readOnly=True)
             cursor = connection.cursor()
 
             # Get the salt and hashed password from the database for the given username
@@ -145,12 +175,19 @@ class cmUser:
             salt = result[0]
             storedHash = result[1]
 
-            # Hash the provided password with the retrieved salt
-            hashedPassword = bcrypt.hashpw(self.cmPassword.encode("utf-8"), salt)
+            # Hash the provided password with the retrieved salt (on the hashing pool), within the request's deadline
+            hashedPassword = hashing.hashpw(self.cmPassword.encode("utf-8"), salt, cn.remaining())
 
             # Compare the computed hash with the stored hash
-            return hashedPassword == storedHash
+            return hmac.compare_digest(hashedPassword, storedHash)
 
+        except hashing.HashingBusy:
+            # Let the server tell the client to come back later
+            raise
+        except (TimeoutError, cn.DeadlineExceeded) as e:
+            # Not a failed authentication, the server answers that the deadline has been exceeded
+            print(e)
+            return False
         except Exception as e:
             # Catch all errors. Don't print traceback.
             print(e)
@@ -163,32 +200,26 @@ class cmUser:
                 connection.close()
 
 
-def printUsers():
-    """Pretty print the cm.users table
+def printUsers(options: listing.ListOptions = None):
+    """Pretty print the cm.users table, ordered by username.
+
+    Args:
+        options (ListOptions, optional): USER filter, page and output mode. Defaults to the first page.
     """
-    try:
-        # Connect to the MariaDB database
-        connection = mysql.connector.connect(**cn.DBCONFIG)
-        cursor = connection.cursor()
-
-        # Get result & pretty print
-        cursor.execute("SELECT uid, username, password FROM users")
-        result = cursor.fetchall()
-
-        # For pretty printing we truncate the long hashed password string.
-        modifiedResult = []
-        for row in result:
-            uid, username, password = row
-            password = password.decode('utf-8')[:16] 
-            modifiedResult.append((uid, username, password))
-
-        fields = [i[0] for i in cursor.description]
-        print(tabulate(modifiedResult, headers=fields, tablefmt="psql"))
-    except mysql.connector.Error as e:
-        print(f"Error: {e}")
-    finally:
-        # Close connection gracefully
-        if cursor:
-            cursor.close()
-        if connection:
-            connection.close()
+
+    # For pretty printing we truncate the long hashed password & fingerprint strings.
+    def formatRow(row):
+        uid, username, password, authMode, fingerprint = row
+        password = password.decode('utf-8')[:16]
+        fingerprint = fingerprint[:16] if fingerprint else None
+        return (uid, username, password, authMode, fingerprint)
+
+    listing.printListing(
+        "LIST USERS",
+        "SELECT uid, username, password, auth_mode, cert_fingerprint FROM users",
+        ("username",),
+        {"USER": "username"},
+        options or listing.ListOptions(),
+        ["uid", "username", "password", "auth_mode", "cert_fingerprint"],
+        formatRow,
+    )
@@ -0,0 +1,56 @@
+"""This module manages the cm.cm_versions table. Every in-memory index of the CM server (e.g. the certificate
+identities) has a version number there, which is increased by every change to the underlying tables.
+Servers compare this number with the version they have loaded to notice changes made by other processes."""
+import mysql.connector
+import connector as cn
+
+
+def bumpVersion(cursor, name: str) -> int:
+    """Increases the version of an index. Call this with the cursor of the transaction that changes the index's tables.
+
+    Args:
+        cursor (MySQLCursor): Cursor of the changing transaction.
+        name (str): Name of the index.
+
+    Returns:
+        int: The index's new version.
+    """
+    cursor.execute(
+        "INSERT INTO cm_versions (name, version) VALUES (%s, 1) "
+        "ON DUPLICATE KEY UPDATE version = version + 1",
+        (name,),
+    )
+    cursor.execute("SELECT version FROM cm_versions WHERE name = %s", (name,))
+    return cursor.fetchone()[0]
+
+
+def fetchVersion(name: str, cursor=None) -> int:
+    """Fetches the current version of an index.
+
+    Args:
+        name (str): Name of the index.
+        cursor (MySQLCursor, optional): Cursor of the transaction that loads the index, so that the version
+            matches the loaded data even if it is read from a replica. Defaults to a new read-only connection.
+
+    Returns:
+        int: Current version, 0 if the index has never been changed, None if the database can't be reached.
+    """
+    if cursor is not None:
+        cursor.execute("SELECT version FROM cm_versions WHERE name = %s", (name,))
+        result = cursor.fetchone()
+        return result[0] if result else 0
+
+    connection = None
+    try:
+        connection = cn.connect(readOnly=True)
+        cursor = connection.cursor()
+        return fetchVersion(name, cursor)
+    except mysql.connector.Error as e:
+        print(f"Error: {e}")
+        return None
+    finally:
+        # Close connection gracefully
+        if cursor:
+            cursor.close()
+        if connection:
+            connection.close()